@@ -0,0 +1,201 @@
+"""Serve Mustard Mine on asyncio, as an alternative to gevent and flask_sockets
+
+	pip install uvicorn
+	uvicorn asgi:app --port 5000      (or just: python3 asgi.py)
+
+Countdown overlays - the control socket and the event streams - are handled
+natively on the event loop, so each one held open costs a coroutine rather
+than a thread. Everything else is the unchanged Flask app, run through a
+small WSGI adapter on a thread pool, so that blocking database and Twitch
+calls never stall the loop. Keep this to one process, like the Procfile's
+-w 1: the schedule, caches, and overlay registry are all per-process.
+"""
+import asyncio
+import concurrent.futures
+import os
+import queue
+import re
+import sys
+import tempfile
+os.environ["MUSTARD_ASYNC"] = "1" # Before importing mustard, so it skips gevent
+import mustard
+
+THREADS = mustard.ASYNC_THREADS # Requests (not overlays) handled at once
+BODY_SPOOL = 1024 * 1024 # Request bodies bigger than this are buffered on disk
+EVENTS_PATH = re.compile("^/countdown/([^/]+)/events$")
+pool = concurrent.futures.ThreadPoolExecutor(THREADS, thread_name_prefix="wsgi")
+
+class LoopQueue(queue.Queue):
+	"""Thread-safe queue that an event loop task can wait on
+
+	Anything may put() to it, from any thread, exactly as to a queue.Queue;
+	the task that owns it waits with get_async().
+	"""
+	def __init__(self, loop, maxsize=0):
+		super().__init__(maxsize)
+		self.loop = loop
+		self.ready = asyncio.Event()
+
+	def _put(self, item):
+		super()._put(item)
+		self.loop.call_soon_threadsafe(self.ready.set)
+
+	async def get_async(self, timeout=None):
+		"""Get the next item, raising queue.Empty if none within timeout seconds"""
+		while True:
+			try: return self.get_nowait()
+			except queue.Empty: pass
+			# Any put() after this point sets the event again, so nothing is missed
+			self.ready.clear()
+			if self.qsize(): continue
+			try: await asyncio.wait_for(self.ready.wait(), timeout)
+			except asyncio.TimeoutError: raise queue.Empty
+
+class ControlSocket:
+	"""Stands in for a gevent websocket in mustard.timer_sockets
+
+	send() may be called from any thread; a task on the loop does the writing.
+	An overlay too far behind to keep up gets disconnected (and will reconnect).
+	"""
+	def __init__(self, loop):
+		self.outbox = LoopQueue(loop, mustard.SSE_BACKLOG)
+
+	def send(self, text):
+		try: self.outbox.put_nowait(text)
+		except queue.Full: pass # The writer will find it still full and give up
+
+async def control_socket(scope, receive, send):
+	loop = asyncio.get_event_loop()
+	if (await receive())["type"] != "websocket.connect": return
+	await send({"type": "websocket.accept"})
+	ws = ControlSocket(loop)
+	async def write():
+		while True:
+			if ws.outbox.full():
+				await send({"type": "websocket.close", "code": 1013})
+				return
+			await send({"type": "websocket.send", "text": await ws.outbox.get_async()})
+	writer = asyncio.ensure_future(write())
+	timerid = None
+	try:
+		while True:
+			message = await receive()
+			if message["type"] == "websocket.disconnect": break
+			# Initializing looks the timer up in the database, so off the loop with it
+			timerid = await loop.run_in_executor(pool, mustard.control_message, ws, timerid, message.get("text"))
+	finally:
+		writer.cancel()
+		mustard.socket_closed(ws, timerid)
+
+async def event_stream(scope, receive, send, timerid):
+	loop = asyncio.get_event_loop()
+	headers = dict(scope["headers"])
+	last = headers.get(b"last-event-id", b"").decode("latin-1")
+	await loop.run_in_executor(pool, mustard.register_overlay, timerid)
+	stream = LoopQueue(loop, mustard.SSE_BACKLOG)
+	mustard.timer_streams[timerid].append(stream)
+	async def write():
+		preamble, sent = mustard.stream_preamble(timerid, last)
+		await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]
+			+ [(k.lower().encode("ascii"), v.encode("ascii")) for k, v in mustard.SSE_HEADERS.items()]})
+		await send({"type": "http.response.body", "body": preamble.encode("utf-8"), "more_body": True})
+		while True:
+			try: n, data = await stream.get_async(mustard.SSE_KEEPALIVE)
+			except queue.Empty:
+				await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+				continue
+			if n is None: break # Too far behind; let it reconnect
+			if n > sent: await send({"type": "http.response.body", "body": mustard.sse_event(n, data).encode("utf-8"), "more_body": True})
+		await send({"type": "http.response.body", "body": b""})
+	async def disconnected():
+		while (await receive())["type"] != "http.disconnect": pass
+	tasks = [asyncio.ensure_future(write()), asyncio.ensure_future(disconnected())]
+	try: await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+	finally:
+		for task in tasks: task.cancel()
+		mustard.stream_closed(timerid, stream)
+
+def wsgi_environ(scope, body, length):
+	environ = {
+		"REQUEST_METHOD": scope["method"],
+		"SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+		"PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+		"QUERY_STRING": scope["query_string"].decode("latin-1"),
+		"SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+		"SERVER_NAME": (scope.get("server") or ("localhost", 80))[0],
+		"SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+		"REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+		"wsgi.version": (1, 0),
+		"wsgi.url_scheme": scope.get("scheme", "http"),
+		"wsgi.input": body,
+		"wsgi.errors": sys.stderr,
+		"wsgi.multithread": True,
+		"wsgi.multiprocess": False,
+		"wsgi.run_once": False,
+	}
+	for name, value in scope["headers"]:
+		name = name.decode("latin-1").upper().replace("-", "_")
+		value = value.decode("latin-1")
+		if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"): name = "HTTP_" + name
+		environ[name] = environ[name] + "," + value if name in environ else value
+	# The body has already been read in full (and de-chunked), so its length is known
+	environ.pop("HTTP_TRANSFER_ENCODING", None)
+	environ["CONTENT_LENGTH"] = str(length)
+	return environ
+
+async def wsgi(scope, receive, send):
+	"""Run a request through the Flask app on the pool, streaming the response back"""
+	loop = asyncio.get_event_loop()
+	with tempfile.SpooledTemporaryFile(BODY_SPOOL) as body:
+		while True:
+			message = await receive()
+			if message["type"] == "http.disconnect": return
+			body.write(message.get("body", b""))
+			if not message.get("more_body"): break
+		length = body.tell()
+		body.seek(0)
+		await loop.run_in_executor(pool, run_wsgi, wsgi_environ(scope, body, length), send, loop)
+
+def run_wsgi(environ, send, loop):
+	"""Call the Flask app (on a pool thread), passing the response to the loop to send"""
+	def call(message):
+		asyncio.run_coroutine_threadsafe(send(message), loop).result()
+	response = []
+	def start_response(status, headers, exc_info=None):
+		if exc_info and sent_headers: raise exc_info[1].with_traceback(exc_info[2])
+		response[:] = [int(status.split(" ", 1)[0]), [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers]]
+	sent_headers = False
+	result = mustard.app(environ, start_response)
+	try:
+		for chunk in result:
+			if not chunk: continue
+			if not sent_headers:
+				call({"type": "http.response.start", "status": response[0], "headers": response[1]})
+				sent_headers = True
+			call({"type": "http.response.body", "body": chunk, "more_body": True})
+		if not sent_headers: call({"type": "http.response.start", "status": response[0], "headers": response[1]})
+		call({"type": "http.response.body", "body": b""})
+	finally:
+		if hasattr(result, "close"): result.close()
+
+async def app(scope, receive, send):
+	if scope["type"] == "lifespan":
+		while True:
+			message = await receive()
+			if message["type"] == "lifespan.startup": await send({"type": "lifespan.startup.complete"})
+			elif message["type"] == "lifespan.shutdown":
+				pool.shutdown(wait=False)
+				await send({"type": "lifespan.shutdown.complete"})
+				return
+	elif scope["type"] == "websocket":
+		if scope["path"] == "/countdown_ctrl": await control_socket(scope, receive, send)
+		else: await send({"type": "websocket.close", "code": 1008})
+	else:
+		m = EVENTS_PATH.match(scope["path"])
+		if m and scope["method"] == "GET": await event_stream(scope, receive, send, m.group(1))
+		else: await wsgi(scope, receive, send)
+
+if __name__ == "__main__":
+	try: import uvicorn
+	except ImportError: sys.exit("The asyncio server needs uvicorn: pip install uvicorn")
+	uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "5000")))
@@ -0,0 +1,59 @@
+"""Fingerprinted, precompressed static files
+
+At startup, every file in static/ is read, hashed, and compressed. Pages
+link to /assets/NAME.HASH.EXT (see url()), and since the content at such a
+URL can never change, it is served with an immutable, year-long cache
+lifetime: a returning browser fetches nothing, and a deploy that changes a
+file changes its URL, so no browser is ever left running stale code.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+try:
+	import brotli
+except ImportError:
+	brotli = None # Optional; gzip alone is fine
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+COMPRESSIBLE = (".js", ".css", ".svg", ".html", ".json")
+
+class Asset:
+	def __init__(self, name, data):
+		self.digest = hashlib.sha256(data).hexdigest()[:12]
+		base, ext = os.path.splitext(name)
+		self.name = "%s.%s%s" % (base, self.digest, ext)
+		self.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+		self.bodies = {"identity": data}
+		if name.endswith(COMPRESSIBLE):
+			self.bodies["gzip"] = gzip.compress(data, 9)
+			if brotli: self.bodies["br"] = brotli.compress(data, quality=11)
+
+	def etag(self, encoding):
+		return "%s-%s" % (self.digest, encoding)
+
+	def negotiate(self, accept_encoding):
+		return negotiate(self.bodies, accept_encoding)
+
+def negotiate(bodies, accept_encoding):
+	"""Pick the best encoding of bodies that the client accepts; returns (encoding, body)"""
+	accepted = {part.split(";")[0].strip() for part in accept_encoding.split(",")}
+	for encoding in ("br", "gzip"):
+		if encoding in accepted and encoding in bodies: return encoding, bodies[encoding]
+	return "identity", bodies["identity"]
+
+def build(directory=STATIC):
+	"""Read and process every asset; returns {original name: Asset}"""
+	ret = {}
+	for name in sorted(os.listdir(directory)):
+		path = os.path.join(directory, name)
+		if name.startswith(".") or not os.path.isfile(path): continue
+		with open(path, "rb") as f: ret[name] = Asset(name, f.read())
+	return ret
+
+manifest = build()
+by_hashed_name = {asset.name: asset for asset in manifest.values()}
+
+def url(name):
+	"""The URL to use in pages for a file in static/"""
+	return "/assets/" + manifest[name].name
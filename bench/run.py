@@ -0,0 +1,214 @@
+# Micro-benchmarks for the hot paths in database.py and utils.py.
+#
+# Runs against a throwaway PostgreSQL cluster (initdb + pg_ctl must be on the
+# PATH) loaded with synthetic data, unless BENCH_DATABASE_URI names an existing
+# EMPTY database to use instead - it will be filled with junk. Results go to
+# bench/results/<commit>.json, and are compared against the previous results
+# file (or --compare FILE) so that regressions show up between commits.
+#
+#   python3 bench/run.py [--users 100000] [--only find_next_event,make_backup]
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, "bench", "results")
+TIMEZONES = ["America/New_York", "America/Los_Angeles", "Europe/London", "Europe/Berlin",
+	"Australia/Melbourne", "Asia/Tokyo", "UTC"]
+WORDS = "mustard mine speed run chill art code science retro indie puzzle horror chat music cozy".split()
+
+@contextlib.contextmanager
+def throwaway_postgres():
+	"""Spin up a private PostgreSQL cluster for the duration"""
+	if os.environ.get("BENCH_DATABASE_URI"):
+		yield os.environ["BENCH_DATABASE_URI"]
+		return
+	for tool in ("initdb", "pg_ctl"):
+		if not shutil.which(tool): sys.exit("%s not found - install PostgreSQL or set BENCH_DATABASE_URI" % tool)
+	tmp = tempfile.mkdtemp(prefix="mustard-bench-")
+	data = os.path.join(tmp, "data")
+	with socket.socket() as s:
+		s.bind(("localhost", 0))
+		port = s.getsockname()[1]
+	subprocess.run(["initdb", "-D", data, "-U", "bench", "--auth=trust"], check=True, stdout=subprocess.DEVNULL)
+	subprocess.run(["pg_ctl", "-D", data, "-w", "-l", os.path.join(tmp, "log"),
+		"-o", "-p %d -k %s -c listen_addresses='' -c fsync=off" % (port, tmp), "start"],
+		check=True, stdout=subprocess.DEVNULL)
+	try:
+		yield "postgresql://bench@/postgres?host=%s&port=%d" % (tmp, port)
+	finally:
+		subprocess.run(["pg_ctl", "-D", data, "-m", "immediate", "stop"], stdout=subprocess.DEVNULL)
+		shutil.rmtree(tmp, ignore_errors=True)
+
+def copy_rows(cur, table, columns, rows):
+	"""Bulk-load rows with COPY, which is far faster than inserts at this scale"""
+	esc = lambda v: str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+	buf = io.StringIO("".join("\t".join(esc(v) for v in row) + "\n" for row in rows))
+	cur.copy_expert("copy mustard.%s (%s) from stdin" % (table, ", ".join(columns)), buf)
+
+def random_schedule(rng):
+	days = []
+	for day in range(7):
+		times = sorted({"%02d:%02d" % (rng.randrange(24), rng.choice((0, 15, 30, 45))) for _ in range(rng.choice((0, 0, 1, 1, 2)))})
+		days.append(" ".join(times))
+	return ",".join(days)
+
+def populate(database, nusers, rng):
+	"""Fill the tables with data at roughly production-like ratios
+
+	Every user has a schedule; setups average three per user, timers a bit
+	over one, and the tag catalogue is about the size of Twitch's.
+	"""
+	tags = [("tag-%04d" % i, "%s %s %d" % (rng.choice(WORDS).title(), rng.choice(WORDS).title(), i),
+		"Synthetic tag number %d" % i) for i in range(600)]
+	database.replace_all_tags(tags)
+	tagnames = [t[1] for t in tags]
+	users, setups, timers, timerids = [], [], [], []
+	for twitchid in range(1, nusers + 1):
+		users.append((twitchid, rng.choice(TIMEZONES), random_schedule(rng), 0, "Check mic\nCheck camera"))
+		for _ in range(rng.choice((1, 2, 3, 3, 4, 5))):
+			setups.append((twitchid, " ".join(rng.sample(WORDS, 2)).title(), " ".join(rng.sample(WORDS, 6)),
+				", ".join(rng.sample(tagnames, 5)), "Going live! #" + rng.choice(WORDS)))
+		for _ in range(rng.choice((1, 1, 1, 1, 2))):
+			id = database.generate_timer_id()
+			timerids.append(id)
+			timers.append((id, twitchid, "Starting soon", rng.choice((0, 0, 300, -300)), 3600, ""))
+	with database.postgres, database.postgres.cursor() as cur:
+		copy_rows(cur, "users", ("twitchid", "sched_timezone", "schedule", "sched_tweet", "checklist"), users)
+		copy_rows(cur, "setups", ("twitchid", "category", "title", "tags", "tweet"), setups)
+		copy_rows(cur, "timers", ("id", "twitchid", "title", "delta", "maxtime", "styling"), timers)
+	database.postgres.autocommit = True
+	with database.postgres.cursor() as cur: cur.execute("vacuum analyze")
+	database.postgres.autocommit = False
+	return {"users": len(users), "setups": len(setups), "timers": len(timers), "tags": len(tags),
+		"timerids": timerids, "tagnames": tagnames, "schedules": [u[1:3] for u in users]}
+
+def measure(func, calls, setup=None):
+	"""Time individual calls; returns per-call stats in microseconds"""
+	samples = []
+	for i in range(calls):
+		args = setup(i) if setup else ()
+		start = time.perf_counter()
+		func(*args)
+		samples.append((time.perf_counter() - start) * 1e6)
+	samples.sort()
+	return {"calls": calls, "min_us": samples[0], "median_us": statistics.median(samples),
+		"mean_us": statistics.mean(samples), "p99_us": samples[min(calls - 1, int(calls * 0.99))]}
+
+def two_query_timer_details(database, id):
+	"""get_public_timer_details as it was before it became one prepared statement, for comparison"""
+	with database.postgres, database.postgres.cursor(cursor_factory=database.psycopg2.extras.RealDictCursor) as cur:
+		cur.execute("select twitchid, title, delta, maxtime, styling from mustard.timers where id=%s", (id,))
+		info = cur.fetchone()
+		if not info: return None
+		info = {**info}
+		twitchid = info.pop("twitchid")
+		cur.execute("select sched_timezone, schedule from mustard.users where twitchid=%s", (twitchid,))
+		sched = cur.fetchone()
+		info["next_event"] = database.find_next_event(sched["sched_timezone"], sched["schedule"], info["delta"])
+		return info
+
+def benchmarks(database, utils, data, rng):
+	"""Yield (name, func, calls, setup) for every benchmark"""
+	schedules, timerids, tagnames = data["schedules"], data["timerids"], data["tagnames"]
+	yield "find_next_event", database.find_next_event, 20000, lambda i: rng.choice(schedules)
+	yield "get_public_timer_details", database.get_public_timer_details, 5000, lambda i: (rng.choice(timerids),)
+	yield "get_public_timer_details (two queries)", two_query_timer_details, 5000, lambda i: (database, rng.choice(timerids))
+	yield "find_tags_by_prefix", database.find_tags_by_prefix, 2000, lambda i: (rng.choice(WORDS)[:rng.randrange(1, 4)],)
+	yield "get_tag_ids", database.get_tag_ids, 5000, lambda i: (rng.sample(tagnames, 5),)
+	def backup(twitchid):
+		with database.snapshot() as cur: "".join(database.generate_backup(cur, twitchid))
+	yield "make_backup", backup, 1000, lambda i: (rng.randrange(1, data["users"] + 1),)
+	# Restore each user's own backup over the top of itself, as a user would
+	def restore_args(i):
+		twitchid = rng.randrange(1, data["users"] + 1)
+		with database.snapshot() as cur:
+			return twitchid, json.loads("".join(database.generate_backup(cur, twitchid)))
+	yield "restore_from_json", database.restore_from_json, 500, restore_args
+
+	# The scheduler's queue at scale: 100k future events, then operations on it.
+	# The pump thread just sleeps, since nothing is due for a day.
+	sched = utils.Scheduler()
+	when = time.time() + 86400
+	def noop(*args): pass
+	yield "Scheduler.put", sched.put, 100000, lambda i: (when + i, noop, ("token", "secret"), "Tweet %d" % i)
+	yield "Scheduler.search", sched.search, 200, lambda i: (noop,)
+	yield "Scheduler.remove", sched.remove, 20000, lambda i: (rng.randrange(1, sched.counter + 1),)
+	yield "Scheduler.search (after removals)", sched.search, 200, lambda i: (noop,)
+
+def git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+			capture_output=True, text=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+
+def compare(results, previous):
+	print("\nCompared with %s:" % previous["commit"])
+	for name, cur in results.items():
+		old = previous["results"].get(name)
+		if not old: continue
+		change = (cur["median_us"] - old["median_us"]) / old["median_us"] * 100
+		flag = "  <-- REGRESSION" if change > 10 else ""
+		print("  %-36s %+7.1f%%%s" % (name, change, flag))
+
+def main():
+	parser = argparse.ArgumentParser(description="Mustard Mine micro-benchmarks")
+	parser.add_argument("--users", type=int, default=100000)
+	parser.add_argument("--only", help="Comma-separated benchmark names")
+	parser.add_argument("--compare", help="Results file to compare against (default: most recent other)")
+	parser.add_argument("--seed", type=int, default=1234)
+	args = parser.parse_args()
+	rng = random.Random(args.seed)
+	os.chdir(ROOT) # database.py looks for template.json in the current directory
+	sys.path.insert(0, ROOT)
+	with throwaway_postgres() as uri:
+		# database.py wants a config module; give it just what it needs.
+		config = types.ModuleType("config")
+		config.DATABASE_URI = uri
+		sys.modules["config"] = config
+		import database, utils
+		print("Populating %d users..." % args.users)
+		start = time.perf_counter()
+		data = populate(database, args.users, rng)
+		print("Populated in %.1fs: %s" % (time.perf_counter() - start,
+			", ".join("%d %s" % (data[k], k) for k in ("users", "setups", "timers", "tags"))))
+		with database.postgres, database.postgres.cursor() as cur:
+			cur.execute("show server_version")
+			server = cur.fetchone()[0]
+		only = args.only and set(args.only.split(","))
+		results = {}
+		for name, func, calls, setup in benchmarks(database, utils, data, rng):
+			if only and name not in only: continue
+			results[name] = measure(func, calls, setup)
+			print("%-36s median %9.1fus  p99 %9.1fus" % (name, results[name]["median_us"], results[name]["p99_us"]))
+	commit = git_commit()
+	doc = {"commit": commit, "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		"python": platform.python_version(), "postgres": server, "seed": args.seed,
+		"dataset": {k: data[k] for k in ("users", "setups", "timers", "tags")}, "results": results}
+	os.makedirs(RESULTS, exist_ok=True)
+	fn = os.path.join(RESULTS, commit + ".json")
+	previous = args.compare
+	if not previous:
+		others = [os.path.join(RESULTS, f) for f in os.listdir(RESULTS) if f.endswith(".json") and f != commit + ".json"]
+		previous = max(others, key=os.path.getmtime, default=None)
+	with open(fn, "w") as f: json.dump(doc, f, indent="\t")
+	print("\nResults saved to", os.path.relpath(fn, ROOT))
+	if previous:
+		with open(previous) as f: compare(results, json.load(f))
+
+if __name__ == "__main__":
+	main()
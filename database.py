@@ -2,9 +2,13 @@ import psycopg2.extras
 import config
 import contextlib
 import collections
+import functools
 import json
+import logging
 import os
 import base64
+import threading
+import time
 import pytz
 from datetime import datetime, timedelta
 
@@ -12,13 +16,196 @@ from datetime import datetime, timedelta
 # creates its own dedicated cursor. This means that these functions should be thread
 # safe; psycopg2 has thread-safe connections but not thread-safe cursors.
 assert psycopg2.threadsafety >= 2
-postgres = psycopg2.connect(config.DATABASE_URI)
+
+# Observers of every statement executed, called as hook(sql, args, duration, rowcount).
+# Anything here runs on every query, so keep it cheap.
+log = logging.getLogger("mustard.database")
+query_hooks = []
+
+@functools.lru_cache()
+def _timed(factory):
+	class TimedCursor(factory):
+		def execute(self, sql, args=None):
+			start = time.perf_counter()
+			try:
+				return super().execute(sql, args)
+			finally:
+				duration = time.perf_counter() - start
+				for hook in query_hooks: hook(sql, args, duration, self.rowcount)
+	return TimedCursor
+
+class TimedConnection(psycopg2.extensions.connection):
+	"""Connection whose cursors, of whatever factory, report to query_hooks"""
+	def __init__(self, *args, **kw):
+		super().__init__(*args, **kw)
+		self.prepared = set() # Names of the STATEMENTS that this connection has PREPAREd
+		# The shared connection may be used from several real threads (see
+		# asgi.py), so each "with postgres:" transaction holds it exclusively.
+		self.lock = threading.RLock()
+
+	def __enter__(self):
+		self.lock.acquire()
+		try: return super().__enter__()
+		except BaseException:
+			self.lock.release()
+			raise
+
+	def __exit__(self, *exc):
+		try: return super().__exit__(*exc)
+		finally: self.lock.release()
+
+	def cursor(self, *args, cursor_factory=None, **kw):
+		return super().cursor(*args, cursor_factory=_timed(cursor_factory or psycopg2.extensions.cursor), **kw)
+
+postgres = psycopg2.connect(config.DATABASE_URI, connection_factory=TimedConnection)
+
+# The hottest reads, as server-side prepared statements: parsed and planned
+# once per connection, then only executed. name: (parameter types, query)
+STATEMENTS = {
+	"public_timer": ("text", """select t.title, t.delta, t.maxtime, t.styling, u.sched_timezone, u.schedule
+		from mustard.timers t join mustard.users u on u.twitchid = t.twitchid where t.id = $1"""),
+	"list_setups": ("integer", "select * from mustard.setups where twitchid=$1 order by id"),
+	"get_schedule": ("integer", "select sched_timezone, schedule, sched_tweet from mustard.users where twitchid=$1"),
+	"get_checklist": ("integer", "select checklist from mustard.users where twitchid=$1"),
+	"timer_channel": ("text", "select twitchid from mustard.timers where id = $1"),
+	"list_timers": ("integer", "select id, title from mustard.timers where twitchid=$1 order by id"),
+	"list_timers_full": ("integer", "select id, title, delta, maxtime, styling from mustard.timers where twitchid=$1 order by id"),
+	"tags_by_prefix": ("text", "select * from mustard.tags where english_name ilike $1 order by english_name"),
+	"tag_ids": ("text[]", "select id from mustard.tags where english_name = any($1)"),
+}
+
+def execute_prepared(cur, name, args):
+	"""Run one of the STATEMENTS, preparing it first if this connection hasn't yet"""
+	conn = cur.connection
+	if name not in conn.prepared:
+		types, sql = STATEMENTS[name]
+		cur.execute("prepare %s (%s) as %s" % (name, types, sql))
+		conn.prepared.add(name) # Survives rollbacks; it's only gone if the connection is
+	cur.execute("execute %s (%s)" % (name, ", ".join(["%s"] * len(args))), args)
+
+class Pool:
+	"""Connections to one database, handed out to one caller at a time
+
+	Connections are made as needed, up to size, and kept for reuse (along
+	with their prepared statements). Beyond that, callers wait their turn.
+	"""
+	def __init__(self, dsn, size, readonly=False):
+		self.dsn, self.readonly = dsn, readonly
+		self.idle = []
+		self.slots = threading.BoundedSemaphore(size)
+
+	@contextlib.contextmanager
+	def connection(self):
+		with self.slots:
+			conn = self.idle.pop() if self.idle else self._connect()
+			try:
+				yield conn
+			except (psycopg2.OperationalError, psycopg2.InterfaceError):
+				conn.close() # Probably broken; don't hand it out again
+				raise
+			finally:
+				if not conn.closed: self.idle.append(conn)
+
+	def _connect(self):
+		conn = psycopg2.connect(self.dsn, connection_factory=TimedConnection)
+		if self.readonly: conn.set_session(readonly=True)
+		return conn
+
+	def close(self):
+		while self.idle: self.idle.pop().close()
+
+POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 4))
+readers = Pool(config.DATABASE_URI, POOL_SIZE) # For @reads functions; writes all use postgres
+snapshots = Pool(config.DATABASE_URI, int(os.environ.get("DATABASE_SNAPSHOT_POOL_SIZE", 2))) # See snapshot()
+
+# Optionally, a read replica to take the load of read-only queries (notably
+# those from countdown overlays). Anything just written stays on the primary
+# for a little while (see pin()), and if the replica falls behind or can't be
+# reached, everything goes to the primary until it recovers.
+REPLICA_URI = os.environ.get("DATABASE_REPLICA_URI")
+PIN_WINDOW = 10 # Seconds after a write during which its data is read from the primary
+MAX_LAG = 5 # Seconds behind the primary before the replica stops being used
+LAG_CHECK_INTERVAL = 5
+RETRY_INTERVAL = 30 # Seconds before trying a replica that failed
+replica = REPLICA_URI and Pool(REPLICA_URI, POOL_SIZE, readonly=True)
+replica_lag = 0.0
+replica_checked = replica_down_until = 0.0
+recent_writes = {} # ("user"|"timer", id): time of last write
+
+def pin(kind, id):
+	"""Note that something was just written, so reads of it must come from the primary"""
+	now = time.monotonic()
+	if len(recent_writes) > 10000:
+		for key in [k for k, t in recent_writes.items() if t < now - PIN_WINDOW]: del recent_writes[key]
+	recent_writes[kind, str(id)] = now
+
+def _replica_failed(e):
+	global replica_down_until
+	log.warning("Read replica unavailable, using primary: %s", e)
+	replica.close()
+	replica_down_until = time.monotonic() + RETRY_INTERVAL
+
+def _replica_usable(key):
+	"""Decide whether it's safe to read this key from the replica"""
+	global replica_lag, replica_checked
+	if not replica: return False
+	now = time.monotonic()
+	if key and recent_writes.get(key, 0) > now - PIN_WINDOW: return False
+	if now < replica_down_until: return False
+	if now > replica_checked + LAG_CHECK_INTERVAL:
+		# Lag has to be measured against the primary: the replica alone can't
+		# tell that it has stopped receiving, and would then look current.
+		try:
+			with readers.connection() as conn, conn, conn.cursor() as cur:
+				cur.execute("select pg_current_wal_lsn()")
+				primary_lsn = cur.fetchone()[0]
+		except psycopg2.Error as e:
+			log.warning("Unable to check replica lag: %s", e)
+			return False
+		try:
+			with replica.connection() as conn, conn, conn.cursor() as cur:
+				# Once everything the primary had written is replayed, the replica
+				# is current, however long ago its last transaction was. If it has
+				# stopped receiving, the primary's position moves on without it, and
+				# its last transaction only gets older.
+				cur.execute("""select case when pg_last_wal_replay_lsn() >= %s::pg_lsn then 0
+					else extract(epoch from now() - pg_last_xact_replay_timestamp()) end""", (primary_lsn,))
+				lag = cur.fetchone()[0]
+			was_usable = replica_lag <= MAX_LAG
+			replica_lag = float("inf") if lag is None else float(lag) # None: nothing replayed yet
+			replica_checked = now
+			if was_usable and replica_lag > MAX_LAG: log.warning("Read replica %.0fs behind, using primary", replica_lag)
+			elif not was_usable and replica_lag <= MAX_LAG: log.info("Read replica caught up")
+		except psycopg2.Error as e:
+			_replica_failed(e)
+			return False
+	return replica_lag <= MAX_LAG
+
+def reads(kind=None):
+	"""Decorate a read-only function to run on a pooled connection, on the replica where possible
+
+	The function takes the connection to use as its first argument, which the
+	wrapper supplies. If kind is given, the next argument is a user or timer
+	ID, and a recent write to that (see pin()) keeps the read on the primary.
+	"""
+	def deco(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kw):
+			if _replica_usable(kind and (kind, str(args[0]))):
+				try:
+					with replica.connection() as conn: return func(conn, *args, **kw)
+				except (psycopg2.OperationalError, psycopg2.InterfaceError) as e: _replica_failed(e)
+			with readers.connection() as conn: return func(conn, *args, **kw)
+		return wrapper
+	return deco
 
 # Assumes that dict preserves insertion order (CPython 3.6+, other Python 3.7+, possible 3.5)
 # Otherwise, tables might be created in the wrong order, breaking foreign key refs.
 TABLES = {
 	"status": [ # Singleton table
 		"tags_updated timestamptz not null default '1970-1-1Z'",
+		"tags_refresh_status text not null default ''", # Outcome of the last refresh (see refresh_tags)
+		"tags_refresh_seconds real not null default 0", # and how long it took
 	],
 	"users": [
 		"twitchid integer primary key",
@@ -26,6 +213,7 @@ TABLES = {
 		"schedule varchar not null default ''",
 		"sched_tweet integer not null default 0",
 		"checklist text not null default ''",
+		"data_version integer not null default 0", # Bumped by every change to this user's data
 	],
 	"setups": [
 		"id serial primary key",
@@ -48,6 +236,11 @@ TABLES = {
 		"english_name text not null", # Twitch has localized names, but we keep only the en-us one
 		"english_desc text not null", # Ditto. If there is no en-us, we'll probably crash somewhere.
 	],
+	"sessions": [ # Server-side half of Flask sessions - see session_store.py
+		"id text primary key",
+		"data text not null", # JSON
+		"expires bigint not null", # Unix time
+	],
 }
 
 # https://postgrespro.com/list/thread-id/1544890
@@ -92,91 +285,189 @@ def create_tables():
 			cur.execute("insert into mustard.status default values")
 create_tables()
 
+def compile_template(fn="template.json"):
+	"""Compile the new-user template into one bulk provisioning statement
+
+	Validation follows restore_from_json, but is done once, at startup.
+	Returns (sql, params, timers); the caller adds "twitchid" to params, and
+	"timerids" as a list of that many fresh IDs. If the user already exists,
+	the statement does nothing at all.
+	"""
+	with open(fn) as f:
+		data = json.load(f)
+	user = {"sched_timezone": "", "schedule": "", "sched_tweet": 0, "checklist": ""}
+	sched = data.get("schedule")
+	if sched is None: pass
+	elif len(sched) == 8: user.update(schedule=",".join(sched[:-1]), sched_timezone=sched[-1]) # Old format
+	elif len(sched) == 9: user.update(schedule=",".join(sched[:-2]), sched_timezone=sched[-2], sched_tweet=int(sched[-1]))
+	else: raise ValueError("Malformed schedule in " + fn)
+	checklist = data.get("checklist", "")
+	if isinstance(checklist, list): checklist = "\n".join(checklist).strip()
+	user["checklist"] = checklist
+	params = {"user_" + k: v for k, v in user.items()}
+	sql = ["""with u as (
+		insert into mustard.users (twitchid, sched_timezone, schedule, sched_tweet, checklist)
+		values (%(twitchid)s, %(user_sched_timezone)s, %(user_schedule)s, %(user_sched_tweet)s, %(user_checklist)s)
+		on conflict do nothing returning twitchid)"""]
+	rows = []
+	for i, setup in enumerate(s for s in data.get("setups", ()) if s != ""):
+		if not setup.get("category") or not setup.get("title"): raise ValueError("Setups: Category and title are required")
+		for field in ("category", "title", "tags", "tweet"): params["s%d_%s" % (i, field)] = setup.get(field, "")
+		rows.append("(%%(s%d_category)s, %%(s%d_title)s, %%(s%d_tags)s, %%(s%d_tweet)s)" % (i, i, i, i))
+	if rows: sql.append(""", s as (insert into mustard.setups (twitchid, category, title, tags, tweet)
+		select u.twitchid, v.* from u, (values %s) as v)""" % ", ".join(rows))
+	rows = []
+	# Mirror the column defaults, since VALUES lists can't say DEFAULT here
+	for i, timer in enumerate(t for t in data.get("timers", ()) if t != ""):
+		timer = {"title": "", "delta": 0, "maxtime": 3600, "styling": "", **timer}
+		for field in ("title", "delta", "maxtime", "styling"): params["t%d_%s" % (i, field)] = timer[field]
+		rows.append("(%d, %%(t%d_title)s, %%(t%d_delta)s, %%(t%d_maxtime)s, %%(t%d_styling)s)" % (i + 1, i, i, i, i))
+	if rows: sql.append(""", t as (insert into mustard.timers (id, twitchid, title, delta, maxtime, styling)
+		select i.id, u.twitchid, v.title, v.delta, v.maxtime, v.styling from u,
+		(values %s) as v(n, title, delta, maxtime, styling)
+		join unnest(%%(timerids)s::text[]) with ordinality as i(id, n) using (n))""" % ", ".join(rows))
+	sql.append(" select count(*) from u")
+	return "".join(sql), params, len(rows)
+PROVISION_SQL, PROVISION_PARAMS, PROVISION_TIMERS = compile_template()
+
+# Users known to exist. Accounts are never deleted, so once seen, always valid.
+# Purely a shortcut, so when it gets too big, just start over.
+known_users = set()
+KNOWN_USERS_LIMIT = 100000
+
 def create_user(twitchid): # Really "ensure_user" as it's quite happy to not-create if exists
+	"""Ensure that the user exists, provisioning from the template if new
+
+	Costs nothing for a user this process has already seen, and a single
+	round trip otherwise.
+	"""
 	# TODO: Save the user's OAuth info, incl Twitter.
-	try:
-		with postgres, postgres.cursor() as cur:
-			cur.execute("insert into mustard.users values (%s)", [twitchid])
-		# As a separate transaction (it's okay if this fails), load up
-		# the template data to give some samples.
-		with open("template.json") as f:
-			data = json.load(f)
-		restore_from_json(twitchid, data)
-	except psycopg2.IntegrityError:
-		pass # TODO: Update any extra info eg Twitter OAuth
+	twitchid = int(twitchid)
+	if twitchid in known_users: return
+	if len(known_users) >= KNOWN_USERS_LIMIT: known_users.clear()
+	with postgres, postgres.cursor() as cur:
+		cur.execute(PROVISION_SQL, {**PROVISION_PARAMS, "twitchid": twitchid,
+			"timerids": [generate_timer_id() for _ in range(PROVISION_TIMERS)]})
+	data_versions.pop(twitchid, None) # Provisioning changed what there is to see
+	known_users.add(twitchid)
+
+# Cache of users' data versions: twitchid: (version, expiry). This process
+# forgets an entry whenever it changes one, but other processes (more workers,
+# or dynos) write too, and nothing tells us; so each is only trusted briefly.
+data_versions = {}
+DATA_VERSION_TTL = 5 # Seconds; how stale a 304 can be after another process's write
+
+def get_data_version(twitchid):
+	"""Get a number that changes whenever any of the user's stored data does"""
+	twitchid = int(twitchid)
+	cached = data_versions.get(twitchid)
+	if cached and cached[1] > time.monotonic(): return cached[0]
+	if len(data_versions) >= KNOWN_USERS_LIMIT: data_versions.clear()
+	with postgres, postgres.cursor() as cur:
+		cur.execute("select data_version from mustard.users where twitchid=%s", (twitchid,))
+		row = cur.fetchone()
+		# No user yet means no data, but not for long; and when provisioned,
+		# they'll start at 0, so that mustn't be what describes having nothing.
+		if not row: return -1
+		# Store it before committing: a write that lands meanwhile is then sure
+		# to discard it afterwards, rather than us caching a stale version.
+		version = row[0]
+		data_versions[twitchid] = version, time.monotonic() + DATA_VERSION_TTL
+	return version
+
+def _bump_version(cur, twitchid):
+	cur.execute("update mustard.users set data_version = data_version + 1 where twitchid=%s", (twitchid,))
+
+@contextlib.contextmanager
+def _changing(twitchid, cursor_factory=None):
+	"""Open a transaction that changes a user's data, bumping their data version"""
+	with postgres, postgres.cursor(cursor_factory=cursor_factory) as cur:
+		yield cur
+		_bump_version(cur, twitchid)
+	data_versions.pop(int(twitchid), None)
+	pin("user", twitchid)
 
 def create_setup(twitchid, *, category, title, tags="", tweet="", **extra):
 	"""Create a new 'setup' - a loadable stream config
 
 	Returns the full record just created, including its ID.
 	"""
-	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+	with _changing(twitchid, psycopg2.extras.RealDictCursor) as cur:
 		cur.execute("insert into mustard.setups (twitchid, category, title, tags, tweet) values (%s, %s, %s, %s, %s) returning *",
 			(twitchid, category, title, tags, tweet))
 		ret = cur.fetchone()
 	return ret
 
-def list_setups(twitchid):
-	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-		cur.execute("select * from mustard.setups where twitchid=%s order by id", (twitchid,))
+@reads("user")
+def list_setups(db, twitchid):
+	with db, db.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+		execute_prepared(cur, "list_setups", (twitchid,))
 		ret = cur.fetchall()
 	return ret
 
+def get_setup(twitchid, setupid):
+	"""Fetch one saved setup, or None if it isn't one of this user's"""
+	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+		cur.execute("select * from mustard.setups where twitchid=%s and id=%s", (twitchid, setupid))
+		return cur.fetchone()
+
 def delete_setup(twitchid, setupid):
 	"""Attempt to delete a saved setup
 
 	If the setupid is bad, or if it doesn't belong to the given twitchid,
 	returns 0. There is no permissions-error response - just a 404ish.
 	"""
-	with postgres, postgres.cursor() as cur:
+	with _changing(twitchid) as cur:
 		cur.execute("delete from mustard.setups where twitchid=%s and id=%s", (twitchid, setupid))
 		return cur.rowcount
 
-def get_schedule(twitchid):
+@reads("user")
+def get_schedule(db, twitchid):
 	"""Return the user's timezone and schedule
 
 	Schedule is split into seven (Sun through Sat) space-delimited strings.
 	"""
-	with postgres, postgres.cursor() as cur:
-		cur.execute("select sched_timezone, schedule, sched_tweet from mustard.users where twitchid=%s", (twitchid,))
+	with db, db.cursor() as cur:
+		execute_prepared(cur, "get_schedule", (twitchid,))
 		tz, sched, tweet = cur.fetchone()
 		sched = sched.split(",") + [""] * 7
 		return tz, sched[:7], int(tweet)
 
 def set_schedule(twitchid, tz, schedule):
-	with postgres, postgres.cursor() as cur:
+	with _changing(twitchid) as cur:
 		cur.execute("update mustard.users set sched_timezone=%s, schedule=%s where twitchid=%s",
 			(tz, ",".join(schedule), twitchid))
 
 def update_twitter_config(twitchid, schedule):
-	with postgres, postgres.cursor() as cur:
+	with _changing(twitchid) as cur:
 		cur.execute("update mustard.users set sched_tweet=%s where twitchid=%s",
 			(schedule, twitchid))
 
-def get_checklist(twitchid):
+@reads("user")
+def get_checklist(db, twitchid):
 	"""Return the user's checklist
 
 	Items are separated by \n in a single string.
 	Empty string means no checklist.
 	"""
-	with postgres, postgres.cursor() as cur:
-		cur.execute("select checklist from mustard.users where twitchid=%s", (twitchid,))
+	with db, db.cursor() as cur:
+		execute_prepared(cur, "get_checklist", (twitchid,))
 		return cur.fetchone()[0]
 
 def set_checklist(twitchid, checklist):
 	"""Update the checklist, which must be formatted as lines already"""
-	with postgres, postgres.cursor() as cur:
+	with _changing(twitchid) as cur:
 		cur.execute("update mustard.users set checklist=%s where twitchid=%s", (checklist, twitchid,))
 
-def list_timers(twitchid, *, full=False):
+@reads("user")
+def list_timers(db, twitchid, *, full=False):
 	"""List the user's timers
 
 	Returns their unique IDs, which are URL-safe strings, and titles, which
 	usually aren't. If full is True, also returns additional fields.
 	"""
-	with postgres, postgres.cursor() as cur:
-		morefields = ", delta, maxtime, styling" if full else ""
-		cur.execute("select id, title" + morefields + " from mustard.timers where twitchid=%s order by id", (twitchid,))
+	with db, db.cursor() as cur:
+		execute_prepared(cur, "list_timers_full" if full else "list_timers", (twitchid,))
 		return cur.fetchall()
 
 def get_timer_details(id):
@@ -227,25 +518,38 @@ def find_next_event(tz, sched, delta=0):
 	# is an empty schedule, so return failure.
 	return 0
 
-def get_public_timer_details(id):
+class PublicTimer:
+	"""What anyone may know about a timer; usable as a mapping, eg for **info"""
+	__slots__ = ("title", "delta", "maxtime", "styling", "next_event")
+	def __init__(self, title, delta, maxtime, styling, next_event):
+		self.title, self.delta, self.maxtime, self.styling, self.next_event = title, delta, maxtime, styling, next_event
+
+	def keys(self): return self.__slots__
+	def __getitem__(self, key): return getattr(self, key)
+
+@reads("timer")
+def get_public_timer_details(db, id):
 	"""Get public details for a specific timer
 
 	Requires no Twitch ID, but is guaranteed to return ONLY public info.
 	In addition to the raw info, this also gives the UTC time of the next
-	scheduled event.
+	scheduled event. A schedule change is written against the user, not the
+	timer, so an overlay may take up to PIN_WINDOW to see it with a replica.
 	"""
-	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-		cur.execute("select twitchid, title, delta, maxtime, styling from mustard.timers where id=%s", (id,))
-		info = cur.fetchone()
-		if not info: return None
-		# Survive psycopg2 2.8.0 bug by turning the RealDict into a real dict
-		# Otherwise, mutating the dictionary causes future iteration to crash.
-		info = {**info}
-		twitchid = info.pop("twitchid")
-		cur.execute("select sched_timezone, schedule from mustard.users where twitchid=%s", (twitchid,))
-		sched = cur.fetchone()
-		info["next_event"] = find_next_event(sched["sched_timezone"], sched["schedule"], info["delta"])
-		return info
+	with db, db.cursor() as cur:
+		execute_prepared(cur, "public_timer", (id,))
+		row = cur.fetchone()
+	if not row: return None
+	title, delta, maxtime, styling, tz, sched = row
+	return PublicTimer(title, delta, maxtime, styling, find_next_event(tz, sched, delta))
+
+@reads("timer")
+def get_timer_channel(db, id):
+	"""Get the Twitch ID that owns a timer, or None if there's no such timer"""
+	with db, db.cursor() as cur:
+		execute_prepared(cur, "timer_channel", (id,))
+		row = cur.fetchone()
+	return row and row[0]
 
 def get_next_event(twitchid, delta=0):
 	"""Get the next event from this user's schedule
@@ -272,30 +576,88 @@ def generate_timer_id():
 def create_timer(twitchid):
 	"""Create a new timer and return its unique ID"""
 	# TODO: If we happen to collide, rerandomize instead of failing
-	with postgres, postgres.cursor() as cur:
+	with _changing(twitchid) as cur:
 		id = generate_timer_id()
 		cur.execute("insert into mustard.timers (id, twitchid) values (%s, %s)", (id, twitchid))
-		return id
+	pin("timer", id)
+	return id
 
 def update_timer_details(twitchid, id, *, title, delta, maxtime, styling):
 	"""Update a timer, but only if it's owned by that twitchid
 
 	Raises ValueError if it found nothing to update
 	"""
-	with postgres, postgres.cursor() as cur:
+	with _changing(twitchid) as cur:
 		cur.execute("update mustard.timers set title=%s, delta=%s, maxtime=%s, styling=%s where id=%s and twitchid=%s",
 			(title, delta, maxtime, styling, id, twitchid))
 		if not cur.rowcount: raise ValueError("Timer not found, or not owned by that user")
+	pin("timer", id)
 
 def delete_timer(twitchid, id):
 	"""Delete a timer, but only if it's owned by that twitchid
 
 	Raises ValueError if it found nothing to delete
 	"""
-	with postgres, postgres.cursor() as cur:
+	with _changing(twitchid) as cur:
 		cur.execute("delete from mustard.timers where id=%s and twitchid=%s",
 			(id, twitchid))
 		if not cur.rowcount: raise ValueError("Timer not found, or not owned by that user")
+	pin("timer", id)
+
+@contextlib.contextmanager
+def snapshot():
+	"""Open a read-only cursor onto a single consistent view of the database
+
+	Uses a connection of its own in repeatable-read mode, so the caller may
+	yield control between queries (eg while streaming a response) without
+	other requests' writes - or their commits on the shared connection -
+	tearing the data. The connections come from a small pool of their own,
+	as a slow download holds one throughout; beyond that, callers wait.
+	"""
+	with snapshots.connection() as conn:
+		conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+		with conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+			yield cur
+
+def existing_users(twitchids):
+	"""Filter Twitch IDs down to those that have been set up here (as strings, in order)"""
+	ids = [int(id) for id in twitchids if str(id).isdigit()]
+	with postgres, postgres.cursor() as cur:
+		cur.execute("select twitchid from mustard.users where twitchid = any(%s)", (ids,))
+		found = {str(row[0]) for row in cur}
+	return [str(id) for id in twitchids if str(id) in found]
+
+def backup_sections(cur, twitchid):
+	"""Yield (section, items) for everything that goes into a user's backup
+
+	cur should come from snapshot(). Each section is read only when the
+	previous one has been consumed, so nothing is held beyond one section.
+	The user must exist (see existing_users); check before starting a response.
+	"""
+	cur.execute("select category, title, tags, tweet from mustard.setups where twitchid=%s order by id", (twitchid,))
+	yield "setups", [dict(row) for row in cur]
+	cur.execute("select sched_timezone, schedule, sched_tweet, checklist from mustard.users where twitchid=%s", (twitchid,))
+	user = cur.fetchone()
+	sched = user["schedule"].split(",") + [""] * 7
+	yield "schedule", sched[:7] + [user["sched_timezone"], int(user["sched_tweet"])]
+	yield "checklist", user["checklist"].strip().split("\n")
+	cur.execute("select id, title, delta, maxtime, styling from mustard.timers where twitchid=%s order by id", (twitchid,))
+	yield "timers", [dict(row) for row in cur]
+
+def generate_backup(cur, twitchid):
+	"""Generate the text of a backup file, one section at a time"""
+	yield "{\n"
+	for section, items in backup_sections(cur, twitchid):
+		if section == "schedule": *items, last = items # Timezone and tweet time, no shim
+		else: last = "" # Empty string as shim. Ignored on import.
+		yield '\t"%s": [\n' % section
+		yield "".join("\t\t" + json.dumps(item) + ",\n" for item in items)
+		yield "\t\t%s\n\t],\n" % json.dumps(last)
+	# Footer (marker to show that the file was correctly downloaded)
+	# This must NOT include any sort of timestamp, as the backup file
+	# must be completely stable (taking two backups without changing
+	# anything should result in bit-for-bit identical files).
+	yield '\t"": "Mustard-Mine Backup"\n}\n'
 
 class ValidationError(Exception): pass
 class Restorer(contextlib.ExitStack):
@@ -309,18 +671,22 @@ class Restorer(contextlib.ExitStack):
 		super().__enter__()
 		self.enter_context(postgres)
 		self.cur = self.enter_context(postgres.cursor())
+		_bump_version(self.cur, self.twitchid) # Rolled back along with everything else on failure
 		# List all pre-existing timers so untouched ones can get wiped
 		self.cur.execute("select id from mustard.timers where twitchid=%s", (self.twitchid,))
 		self.timers = {tm[0] for tm in self.cur}
+		self.original_timers = set(self.timers)
 		return self
 
 	def __exit__(self, t, v, tb):
 		super().__exit__(t, v, tb)
-		print("__exit__: t is", t)
+		data_versions.pop(int(self.twitchid), None)
+		pin("user", self.twitchid)
+		for id in self.original_timers: pin("timer", id)
 		if t is not None:
 			self.failed = True
 			if t is ValidationError:
-				print("Returning true")
+				log.debug("Restore for %s rejected: %s", self.twitchid, v.args[0])
 				self.summary += "--> " + v.args[0] + "\n"
 				return True
 			self.summary = "" # TODO: Summarize the failure?
@@ -338,11 +704,18 @@ class Restorer(contextlib.ExitStack):
 	def wipe_setups(self):
 		self.cur.execute("delete from mustard.setups where twitchid = %s", (self.twitchid,))
 
-	def restore_setup(self, *, category=None, title=None, tags="", tweet=""):
-		if not category or not title: raise ValidationError("Setups: Category and title are required")
-		self.cur.execute("insert into mustard.setups (twitchid, category, title, tags, tweet) values (%s, %s, %s, %s, %s) returning id",
-			(self.twitchid, category, title, tags, tweet))
-		self.summary += "Restored %r setup\n" % category
+	def restore_setups(self, setups):
+		"""Restore a batch of setups (dicts, already checked) in one statement"""
+		rows = []
+		for setup in setups:
+			category, title = setup.get("category"), setup.get("title")
+			if not category or not title: raise ValidationError("Setups: Category and title are required")
+			if set(setup) - {"category", "title", "tags", "tweet"}: raise ValidationError("Setups: Unknown field")
+			if not all(isinstance(v, str) for v in setup.values()): raise ValidationError("Setups: Fields must be text")
+			rows.append((self.twitchid, category, title, setup.get("tags", ""), setup.get("tweet", "")))
+			self.summary += "Restored %r setup\n" % category
+		psycopg2.extras.execute_values(self.cur,
+			"insert into mustard.setups (twitchid, category, title, tags, tweet) values %s", rows)
 
 	def restore_schedule(self, tz, schedule, tweet):
 		self.cur.execute("update mustard.users set sched_timezone=%s, schedule=%s, sched_tweet=%s where twitchid=%s",
@@ -381,73 +754,190 @@ class Restorer(contextlib.ExitStack):
 			self.summary += "Deleted timer %s\n" % id
 
 def restore_from_json(twitchid, data):
+	return restore_from_sections(twitchid, data.items())
+
+RESTORE_BATCH = 100 # Setups inserted per statement
+RESTORE_SECTIONS = ("setups", "timers") # May be given as iterators, eg from utils.iter_json_object
+
+def restore_from_sections(twitchid, sections):
+	"""Restore a backup given as (section, value) pairs, in file order
+
+	The setups and timers may be iterators, consumed as they're restored,
+	so a backup can be streamed in without ever being held in memory whole.
+	Fails (rolling everything back) unless the signature footer turns up.
+	"""
 	# Open a single database transaction and do all the work.
 	with Restorer(twitchid) as r:
-		if "setups" in data:
-			r.wipe_setups()
-			for setup in data["setups"]:
-				if setup == "": continue # The shim at the end
-				if "communities" in setup:
+		signed = False
+		for section, value in sections:
+			if section == "setups":
+				r.wipe_setups()
+				batch = []
+				for setup in value:
+					if setup == "": continue # The shim at the end
+					r.check_dict(setup)
 					# Previously, Twitch had "communities", which no longer do anything.
 					# Silently remove them from the data.
-					del setup["communities"]
-				r.check_dict(setup)
-				r.restore_setup(**setup)
-		if "schedule" in data:
-			sched = data["schedule"]
-			if not isinstance(sched, list): r.fail()
-			elif len(sched) == 8: r.restore_schedule(sched[-1], sched[:-1], 0) # Old format backups
-			elif len(sched) == 9: r.restore_schedule(sched[-2], sched[:-2], int(sched[-1])) # New backups
-			else: r.fail()
-		if "checklist" in data:
-			checklist = data["checklist"]
-			if isinstance(checklist, list): checklist = "\n".join(checklist).strip()
-			if not isinstance(checklist, str): r.fail()
-			r.restore_checklist(checklist)
-		if "timers" in data:
-			# This one is problematic. We can't simply wipe and recreate because IDs
-			# are significant (they're the external references, so people's OBS configs
-			# will have those same IDs in them).
-			for timer in data["timers"]:
-				if timer == "": continue # The shim
-				r.check_dict(timer)
-				r.restore_timer(**timer)
-			r.wipe_untouched_timers()
+					setup.pop("communities", None)
+					batch.append(setup)
+					if len(batch) >= RESTORE_BATCH:
+						r.restore_setups(batch)
+						batch = []
+				if batch: r.restore_setups(batch)
+			elif section == "schedule":
+				sched = value
+				if not isinstance(sched, list): r.fail()
+				elif len(sched) == 8: r.restore_schedule(sched[-1], sched[:-1], 0) # Old format backups
+				elif len(sched) == 9: r.restore_schedule(sched[-2], sched[:-2], int(sched[-1])) # New backups
+				else: r.fail()
+			elif section == "checklist":
+				checklist = value
+				if isinstance(checklist, list): checklist = "\n".join(checklist).strip()
+				if not isinstance(checklist, str): r.fail()
+				r.restore_checklist(checklist)
+			elif section == "timers":
+				# This one is problematic. We can't simply wipe and recreate because IDs
+				# are significant (they're the external references, so people's OBS configs
+				# will have those same IDs in them).
+				for timer in value:
+					if timer == "": continue # The shim
+					r.check_dict(timer)
+					try: r.restore_timer(**timer)
+					except TypeError: r.fail("Timers: Unknown or missing field")
+				r.wipe_untouched_timers()
+			elif section == "":
+				signed = value == "Mustard-Mine Backup"
+		if not signed: r.fail("Backup file corrupt - signature missing.")
 	return r
 
-def tags_need_updating():
+def generate_session_id():
+	"""Generate an unguessable session ID, safe to use as a cookie value"""
+	return base64.urlsafe_b64encode(os.urandom(30)).decode("ascii")
+
+def load_session(id):
+	"""Return (data, expires) for a stored session, or None if not found"""
+	with postgres, postgres.cursor() as cur:
+		cur.execute("select data, expires from mustard.sessions where id=%s", (id,))
+		return cur.fetchone()
+
+def save_session(id, data, expires):
+	with postgres, postgres.cursor() as cur:
+		cur.execute("""insert into mustard.sessions (id, data, expires) values (%s, %s, %s)
+			on conflict (id) do update set data=excluded.data, expires=excluded.expires""",
+			(id, data, expires))
+
+def delete_session(id):
+	with postgres, postgres.cursor() as cur:
+		cur.execute("delete from mustard.sessions where id=%s", (id,))
+
+def purge_sessions():
+	"""Discard all expired sessions"""
+	with postgres, postgres.cursor() as cur:
+		cur.execute("delete from mustard.sessions where expires < extract(epoch from now())")
+
+def tags_need_updating(db=None):
 	"""Check if the tags cache needs to be updated.
 
 	Updates will happen no more frequently than daily, unless the table is
 	empty.
 	"""
-	with postgres, postgres.cursor() as cur:
+	db = db or postgres
+	with db, db.cursor() as cur:
 		# Yeah, I'm doing all the logic in PostgreSQL. Because why not.
 		cur.execute("""select now() - tags_updated > '1 day'
 			or (select count(*) from mustard.tags) < 1 from mustard.status""")
 		return cur.fetchone()[0]
 
-def replace_all_tags(tags):
+def replace_all_tags(tags, db=None):
 	"""Replace all tags in the cache with the given collection.
 
 	tags should be a collection of (id, name, desc) tuples.
 	"""
-	with postgres, postgres.cursor() as cur:
+	db = db or postgres
+	with db, db.cursor() as cur:
 		cur.execute("truncate mustard.tags");
 		psycopg2.extras.execute_values(cur,
 			"insert into mustard.tags (id, english_name, english_desc) values %s",
 			tags)
 		cur.execute("update mustard.status set tags_updated = now()")
 
-def get_tag_ids(tag_names):
+TAGS_LOCK = 0x4d4d7467 # Advisory lock key held by whichever process is refreshing the tags
+
+def refresh_tags(fetch, force=False):
+	"""Replace the tags cache with fetch()'s tags, unless another process is already on it
+
+	The crawl holds a Postgres advisory lock on a connection of its own, so
+	across every worker and dyno, exactly one process does it at a time, and
+	anyone who wanted the lock and didn't get it finds the tags fresh the next
+	time they look. Returns False if it didn't refresh (someone else is, or
+	the tags turned out not to need it), True if it did. The outcome goes in
+	mustard.status either way; a failed fetch is recorded, then re-raised.
+	"""
+	conn = psycopg2.connect(config.DATABASE_URI, connection_factory=TimedConnection)
+	try:
+		with conn, conn.cursor() as cur:
+			cur.execute("select pg_try_advisory_lock(%s)", (TAGS_LOCK,))
+			if not cur.fetchone()[0]: return False
+		# Anyone who had the lock before us has finished, so check again
+		if not force and not tags_need_updating(conn): return False
+		start = time.time()
+		status = "interrupted"
+		try:
+			tags = fetch()
+			replace_all_tags(tags, conn)
+			status = "ok (%d tags)" % len(tags)
+			return True
+		except Exception as e:
+			status = "failed: %s" % e
+			raise
+		finally:
+			with conn, conn.cursor() as cur:
+				cur.execute("update mustard.status set tags_refresh_status = %s, tags_refresh_seconds = %s",
+					(status[:1000], time.time() - start))
+	finally:
+		conn.close() # Also releases the lock
+
+def get_tags_status():
+	"""Report on the tags cache and its refreshing, for monitoring"""
+	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+		cur.execute("""select extract(epoch from tags_updated)::bigint as version,
+				extract(epoch from now() - tags_updated) as age_seconds,
+				tags_refresh_status as last_status, tags_refresh_seconds as last_seconds,
+				exists(select 1 from pg_locks where locktype = 'advisory'
+					and classid = 0 and objid = %s and objsubid = 1) as refreshing
+			from mustard.status""", (TAGS_LOCK,))
+		return cur.fetchone()
+
+@reads()
+def list_schedules(db):
+	"""List (twitchid, timezone, schedule) for every user who has a schedule"""
+	with db, db.cursor() as cur:
+		cur.execute("""select twitchid, sched_timezone, schedule from mustard.users
+			where trim(both ',' from schedule) != ''""")
+		return cur.fetchall()
+
+@reads()
+def get_tag_ids(db, tag_names):
 	"""Convert tag names into IDs"""
-	tag_names = tuple(tag_names)
-	with postgres, postgres.cursor() as cur:
-		cur.execute("select id from mustard.tags where english_name in %s", (tag_names,))
+	with db, db.cursor() as cur:
+		execute_prepared(cur, "tag_ids", (list(tag_names),))
 		return [row[0] for row in cur]
 
-def find_tags_by_prefix(prefix):
+def get_tags_version():
+	"""Get the tag cache's version, which changes whenever the tags are replaced"""
+	with postgres, postgres.cursor() as cur:
+		cur.execute("select extract(epoch from tags_updated)::bigint from mustard.status")
+		return cur.fetchone()[0]
+
+def list_tags():
+	"""List all tags as (id, name, desc) tuples, ordered by name"""
+	with postgres, postgres.cursor() as cur:
+		cur.execute("select id, english_name, english_desc from mustard.tags order by english_name")
+		return cur.fetchall()
+
+@reads()
+def find_tags_by_prefix(db, prefix):
 	"""Get a list of all tags that start with some string"""
-	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-		cur.execute("select * from mustard.tags where english_name ilike %s order by english_name", (prefix + "%",))
+	with db, db.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+		execute_prepared(cur, "tags_by_prefix", (prefix + "%",))
 		return cur.fetchall()
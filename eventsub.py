@@ -0,0 +1,47 @@
+"""Receiving Twitch EventSub notifications by webhook
+
+Twitch signs every message with an HMAC-SHA256, keyed by the secret we gave
+when subscribing, over the message ID, timestamp and body. Anything badly
+signed or too old is rejected; Twitch retries deliveries, so a message ID
+that has already been seen is acknowledged but otherwise ignored.
+"""
+import collections
+import datetime
+import hashlib
+import hmac
+import time
+
+MAX_AGE = 600 # Seconds; older messages might be replays
+SEEN_LIMIT = 1000 # Recent message IDs remembered for deduplication
+
+def signature(secret, msgid, timestamp, body):
+	mac = hmac.new(secret.encode("utf-8"), msgid.encode("utf-8") + timestamp.encode("utf-8") + body, hashlib.sha256)
+	return "sha256=" + mac.hexdigest()
+
+def parse_timestamp(ts):
+	"""Parse Twitch's RFC 3339 timestamps (which may have nanoseconds) to Unix time"""
+	dt = datetime.datetime.strptime(ts[:19], "%Y-%m-%dT%H:%M:%S")
+	return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+class Receiver:
+	def __init__(self, secret):
+		self.secret = secret
+		self.seen = collections.OrderedDict()
+
+	def check(self, headers, body):
+		"""Verify a delivery; True if it's new, False if a redelivery
+
+		Raises ValueError if it can't be trusted.
+		"""
+		msgid = headers.get("Twitch-Eventsub-Message-Id", "")
+		timestamp = headers.get("Twitch-Eventsub-Message-Timestamp", "")
+		sig = headers.get("Twitch-Eventsub-Message-Signature", "")
+		if not msgid or not hmac.compare_digest(signature(self.secret, msgid, timestamp, body), sig):
+			raise ValueError("Bad signature")
+		try: age = time.time() - parse_timestamp(timestamp)
+		except ValueError: raise ValueError("Bad timestamp")
+		if abs(age) > MAX_AGE: raise ValueError("Stale message")
+		if msgid in self.seen: return False
+		self.seen[msgid] = True
+		while len(self.seen) > SEEN_LIMIT: self.seen.popitem(last=False)
+		return True
@@ -0,0 +1,66 @@
+# Find how many countdown overlays one server process can hold, and what
+# holding them does to ordinary request latency.
+#
+# Opens overlay connections in steps; after each step, times a burst of
+# countdown page loads (an ordinary database-backed request). Stops when too
+# many connections fail or the page's p99 exceeds --slo. Run it against each
+# way of serving, with the same database, and compare the tables:
+#   gunicorn (Procfile):     python3 loadtest/capacity.py --timer ID --transport sse
+#   asyncio (python3 asgi.py): the same command
+# The client needs a file descriptor per connection; this raises its own soft
+# limit as far as the hard limit allows, but the server's may need raising too.
+import argparse
+import concurrent.futures
+import os
+import resource
+import sys
+import time
+import requests
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from conn_memory import open_stream
+from loadgen import Results, open_overlay
+
+def probe(base, timerid, count):
+	"""Time count page loads, a few at a time; returns sorted latencies in seconds (None if failed)"""
+	def one(i):
+		start = time.perf_counter()
+		try: requests.get(base + "/countdown/" + timerid, timeout=30).raise_for_status()
+		except requests.RequestException: return None
+		return time.perf_counter() - start
+	with concurrent.futures.ThreadPoolExecutor(10) as pool:
+		times = list(pool.map(one, range(count)))
+	return sorted(t for t in times if t is not None), times.count(None)
+
+def main():
+	parser = argparse.ArgumentParser(description="Overlay capacity of one Mustard Mine process")
+	parser.add_argument("--base", default="http://localhost:5000")
+	parser.add_argument("--transport", choices=["ws", "sse"], default="sse")
+	parser.add_argument("--timer", required=True, help="ID of an existing countdown timer")
+	parser.add_argument("--step", type=int, default=500, help="Connections added per step")
+	parser.add_argument("--max", type=int, default=20000)
+	parser.add_argument("--probes", type=int, default=50, help="Page loads timed per step")
+	parser.add_argument("--slo", type=float, default=500, help="Page p99 (ms) beyond which to stop")
+	args = parser.parse_args()
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+	opener = open_overlay if args.transport == "ws" else open_stream
+	results = Results()
+	conns = []
+	print("%8s %8s %10s %10s %8s" % ("held", "failed", "p50 ms", "p99 ms", "errors"))
+	try:
+		while len(conns) < args.max:
+			with concurrent.futures.ThreadPoolExecutor(50) as pool:
+				opened = list(pool.map(lambda i: opener(args.base, args.timer, results), range(args.step)))
+			conns.extend(c for c in opened if c)
+			failed = opened.count(None)
+			times, errors = probe(args.base, args.timer, args.probes)
+			p50 = times[len(times) // 2] * 1000 if times else float("inf")
+			p99 = times[min(len(times) - 1, int(len(times) * 0.99))] * 1000 if times else float("inf")
+			print("%8d %8d %10.1f %10.1f %8d" % (len(conns), failed, p50, p99, errors))
+			if failed > args.step // 100 or errors or p99 > args.slo: break
+	finally:
+		for conn in conns: conn.close()
+	print("Capacity (%s): about %d overlays" % (args.transport, len(conns)))
+
+if __name__ == "__main__":
+	main()
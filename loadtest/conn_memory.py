@@ -0,0 +1,77 @@
+# Measure the server memory cost of each held-open countdown overlay connection.
+#
+# Opens N overlay connections of one transport, holds them, and compares the
+# server's /debug/memory readings before and after. Peak RSS never goes back
+# down, so use a freshly-started server for each transport, and set
+# MEMORY_PROFILING for the (more precise) traced-allocation figure:
+#   MEMORY_PROFILING=1 gunicorn ... &  python3 loadtest/conn_memory.py --transport ws --count 1000 --timer ID
+#   (restart)                          python3 loadtest/conn_memory.py --transport sse --count 1000 --timer ID
+# The server's /debug pages need DEBUG_TOKEN set; give this the same value in
+# its own environment.
+import argparse
+import concurrent.futures
+import os
+import socket
+import ssl
+import sys
+import time
+from urllib.parse import urlsplit
+import requests
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loadgen import Results, open_overlay
+
+def open_stream(base, timerid, results):
+	"""Open /countdown/ID/events and read up to the first ("inited") event"""
+	url = urlsplit(base)
+	start = time.perf_counter()
+	try:
+		sock = socket.create_connection((url.hostname, url.port or (443 if url.scheme == "https" else 80)), timeout=30)
+		if url.scheme == "https": sock = ssl.create_default_context().wrap_socket(sock, server_hostname=url.hostname)
+		sock.sendall(("GET /countdown/%s/events HTTP/1.1\r\nHost: %s\r\nAccept: text/event-stream\r\n\r\n"
+			% (timerid, url.netloc)).encode("ascii"))
+		buf = b""
+		while b'"inited"' not in buf:
+			data = sock.recv(4096)
+			if not data: raise ConnectionError("Stream closed")
+			buf += data
+	except (OSError, ConnectionError):
+		results.record("stream_init", time.perf_counter() - start, False)
+		return None
+	results.record("stream_init", time.perf_counter() - start)
+	return sock
+
+def snapshot(base):
+	headers = {"Authorization": "Bearer " + os.environ["DEBUG_TOKEN"]} if os.environ.get("DEBUG_TOKEN") else {}
+	r = requests.get(base + "/debug/memory", params={"limit": 0}, headers=headers, timeout=60)
+	r.raise_for_status()
+	return r.json()
+
+def main():
+	parser = argparse.ArgumentParser(description="Per-connection memory of countdown overlay transports")
+	parser.add_argument("--base", default="http://localhost:5000")
+	parser.add_argument("--transport", choices=["ws", "sse"], required=True)
+	parser.add_argument("--count", type=int, default=500)
+	parser.add_argument("--timer", required=True, help="ID of an existing countdown timer")
+	parser.add_argument("--settle", type=float, default=5, help="Seconds to wait before measuring")
+	args = parser.parse_args()
+	results = Results()
+	opener = open_overlay if args.transport == "ws" else open_stream
+	before = snapshot(args.base)
+	start = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(50) as pool:
+		conns = [c for c in pool.map(lambda i: opener(args.base, args.timer, results), range(args.count)) if c]
+	elapsed = time.perf_counter() - start
+	time.sleep(args.settle)
+	after = snapshot(args.base)
+	for conn in conns: conn.close()
+	results.report(elapsed)
+	if not conns: sys.exit("No connections opened")
+	print("Held %d/%d %s connections" % (len(conns), args.count, args.transport))
+	print("Peak RSS:  %+8d KB total, %7.2f KB per connection" % (after["max_rss_kb"] - before["max_rss_kb"],
+		(after["max_rss_kb"] - before["max_rss_kb"]) / len(conns)))
+	if "traced_kb" in after:
+		print("Traced:    %+8d KB total, %7.2f KB per connection" % (after["traced_kb"] - before["traced_kb"],
+			(after["traced_kb"] - before["traced_kb"]) / len(conns)))
+
+if __name__ == "__main__":
+	main()
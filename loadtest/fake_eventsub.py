@@ -0,0 +1,86 @@
+# Send Twitch-style EventSub webhook deliveries to a running Mustard Mine.
+#
+# The app must have EVENTSUB_SECRET and EVENTSUB_CALLBACK set; pass the same
+# secret here. Without a subcommand, sends one channel.update notification:
+#   python3 loadtest/fake_eventsub.py --secret s3cret --channel 1000 --title "New title"
+# Other message types, and some deliberately bad deliveries:
+#   ... verify       Callback verification challenge (should be echoed back)
+#   ... revoke       Subscription revocation
+#   ... replay       The same notification twice (second should be ignored)
+#   ... badsig       Wrongly-signed notification (should get 403)
+#   ... stale        Notification timestamped an hour ago (should get 403)
+import argparse
+import datetime
+import json
+import os
+import sys
+import uuid
+import requests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from eventsub import signature
+
+def timestamp(offset=0):
+	now = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=offset)
+	return now.strftime("%Y-%m-%dT%H:%M:%S.%f") + "123Z" # Twitch sends nanoseconds
+
+def deliver(args, msgtype, payload, *, msgid=None, ts=None, secret=None):
+	body = json.dumps(payload).encode("utf-8")
+	msgid = msgid or str(uuid.uuid4())
+	ts = ts or timestamp()
+	r = requests.post(args.target, data=body, timeout=10, headers={
+		"Content-Type": "application/json",
+		"Twitch-Eventsub-Message-Id": msgid,
+		"Twitch-Eventsub-Message-Retry": "0",
+		"Twitch-Eventsub-Message-Type": msgtype,
+		"Twitch-Eventsub-Message-Timestamp": ts,
+		"Twitch-Eventsub-Message-Signature": signature(secret or args.secret, msgid, ts, body),
+		"Twitch-Eventsub-Subscription-Type": "channel.update",
+		"Twitch-Eventsub-Subscription-Version": "1",
+	})
+	print(msgtype, "->", r.status_code, r.text[:200])
+	return r
+
+def subscription(args, status="enabled"):
+	return {"id": "sub-" + args.channel, "status": status, "type": "channel.update", "version": "1",
+		"condition": {"broadcaster_user_id": args.channel}, "cost": 0,
+		"transport": {"method": "webhook", "callback": args.target},
+		"created_at": timestamp()}
+
+def notification(args):
+	return {"subscription": subscription(args), "event": {
+		"broadcaster_user_id": args.channel, "broadcaster_user_login": "user" + args.channel,
+		"broadcaster_user_name": "User" + args.channel, "title": args.title, "language": "en",
+		"category_id": args.category_id, "category_name": args.category_name, "is_mature": False,
+	}}
+
+def main():
+	parser = argparse.ArgumentParser(description="Fake EventSub sender for Mustard Mine")
+	parser.add_argument("action", nargs="?", default="update", choices=["update", "verify", "revoke", "replay", "badsig", "stale"])
+	parser.add_argument("--target", default="http://localhost:5000/eventsub")
+	parser.add_argument("--secret", required=True)
+	parser.add_argument("--channel", default="1000")
+	parser.add_argument("--title", default="Title set via EventSub")
+	parser.add_argument("--category-id", default="509670")
+	parser.add_argument("--category-name", default="Science & Technology")
+	args = parser.parse_args()
+	if args.action == "verify":
+		r = deliver(args, "webhook_callback_verification", {"subscription": subscription(args, "webhook_callback_verification_pending"),
+			"challenge": "pogchamp-kappa-360noscope-vohiyo"})
+		ok = r.status_code == 200 and r.text == "pogchamp-kappa-360noscope-vohiyo"
+	elif args.action == "revoke":
+		ok = deliver(args, "revocation", {"subscription": subscription(args, "authorization_revoked")}).ok
+	elif args.action == "replay":
+		msgid, ts = str(uuid.uuid4()), timestamp()
+		ok = deliver(args, "notification", notification(args), msgid=msgid, ts=ts).ok
+		ok = deliver(args, "notification", notification(args), msgid=msgid, ts=ts).ok and ok
+	elif args.action == "badsig":
+		ok = deliver(args, "notification", notification(args), secret=args.secret + "-wrong").status_code == 403
+	elif args.action == "stale":
+		ok = deliver(args, "notification", notification(args), ts=timestamp(-3600)).status_code == 403
+	else:
+		ok = deliver(args, "notification", notification(args)).ok
+	print("OK" if ok else "FAILED")
+	sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+	main()
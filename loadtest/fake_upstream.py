@@ -0,0 +1,227 @@
+# Stand-in for the Twitch (Helix, Kraken, OAuth) and Twitter endpoints that
+# Mustard Mine uses, for load testing without hammering the real thing.
+#
+# Start this, then start the app with all three base URLs pointing here:
+#   python3 loadtest/fake_upstream.py --port 8001 --latency 50 --error-rate 0.01
+#   TWITCH_API_BASE=http://localhost:8001/ TWITCH_ID_BASE=http://localhost:8001/ \
+#     TWITTER_API_BASE=http://localhost:8001/ python3 mustard.py
+#
+# Latency and error injection can be changed while running by POSTing JSON
+# to /_fake/config, eg {"latency": 200, "error_rate": 0.1}. Counts of calls
+# per endpoint are available from GET /_fake/stats.
+import argparse
+import collections
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+settings = {
+	"latency": 0, # Milliseconds, mean
+	"jitter": 0, # Milliseconds, +/- uniformly distributed
+	"error_rate": 0.0, # Fraction of calls that get a 503
+	"stall_rate": 0.0, # Fraction of calls that hang for stall_time seconds
+	"stall_time": 30,
+}
+stats = collections.Counter()
+stats_lock = threading.Lock()
+ids = itertools.count(1000)
+
+def load_tags():
+	"""Build a tag catalogue that includes every tag the new-user template uses"""
+	names = set()
+	try:
+		with open(os.path.join(os.path.dirname(__file__), "..", "template.json")) as f:
+			for setup in json.load(f)["setups"]:
+				if setup: names.update(t.strip() for t in setup["tags"].split(","))
+	except OSError: pass
+	names.update("Synthetic Tag %d" % i for i in range(500))
+	return [{
+		"tag_id": "fake-%04d" % i, "is_auto": i % 10 == 9,
+		"localization_names": {"en-us": name},
+		"localization_descriptions": {"en-us": "Description of " + name},
+	} for i, name in enumerate(sorted(names))]
+TAGS = load_tags()
+GAMES = ["Science & Technology", "Games + Demos", "Art", "Just Chatting", "Alice: Madness Returns",
+	"American McGee's Alice"] + ["Synthetic Game %d" % i for i in range(200)]
+channels = {} # Channel state, so that PATCH followed by GET is consistent
+
+def channel(id):
+	if id not in channels:
+		channels[id] = {"broadcaster_id": id, "broadcaster_login": "user" + id, "broadcaster_name": "User" + id,
+			"broadcaster_language": "en", "game_id": "1", "game_name": GAMES[0], "title": "Fake stream", "tags": TAGS[:3]}
+	return channels[id]
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	def log_message(self, *args): pass # Way too noisy under load
+
+	def send(self, status, body=None, headers=()):
+		if isinstance(body, (dict, list)):
+			body = json.dumps(body).encode("utf-8")
+			headers = [("Content-Type", "application/json"), *headers]
+		elif isinstance(body, str):
+			body = body.encode("utf-8")
+			headers = [("Content-Type", "application/x-www-form-urlencoded"), *headers]
+		self.send_response(status)
+		for hdr in headers: self.send_header(*hdr)
+		self.send_header("Content-Length", str(len(body or b"")))
+		self.end_headers()
+		if body: self.wfile.write(body)
+
+	def form(self, multi=()):
+		"""Parse the request body; keys listed in multi keep all their values"""
+		length = int(self.headers.get("Content-Length") or 0)
+		body = self.rfile.read(length).decode("utf-8") if length else ""
+		if self.headers.get("Content-Type", "").startswith("application/json"): return json.loads(body or "{}")
+		return {k: v if k in multi else v[-1] for k, v in parse_qs(body).items()}
+
+	def handle_any(self, method):
+		url = urlsplit(self.path)
+		path = url.path.strip("/")
+		args = {k: v[-1] for k, v in parse_qs(url.query).items()}
+		if path.startswith("_fake/"): return self.control(method, path)
+		key = method + " " + "/".join(p for p in path.split("/") if not p.isdigit())
+		with stats_lock: stats[key] += 1
+		delay = settings["latency"] + random.uniform(-settings["jitter"], settings["jitter"])
+		if delay > 0: time.sleep(delay / 1000)
+		if random.random() < settings["stall_rate"]: time.sleep(settings["stall_time"])
+		if random.random() < settings["error_rate"]:
+			return self.send(503, {"error": "Service Unavailable", "status": 503, "message": "Injected failure"})
+		handler = getattr(self, "api_" + path.replace("/", "_").replace(".", "_"), None)
+		if handler is None and path.startswith("kraken/channels/"): handler = self.api_kraken_channel
+		if handler is None: return self.send(404, {"error": "Not Found", "status": 404, "message": "No fake for " + path})
+		handler(method, args)
+
+	def do_GET(self): self.handle_any("GET")
+	def do_POST(self): self.handle_any("POST")
+	def do_PUT(self): self.handle_any("PUT")
+	def do_PATCH(self): self.handle_any("PATCH")
+	def do_DELETE(self): self.handle_any("DELETE")
+
+	def control(self, method, path):
+		if path == "_fake/config" and method == "POST":
+			settings.update(self.form())
+		elif path == "_fake/stats":
+			with stats_lock: return self.send(200, dict(stats))
+		self.send(200, settings)
+
+	def token_user(self):
+		auth = self.headers.get("Authorization") or ""
+		return auth.split("-")[-1] if "-" in auth else "1000"
+
+	# ---- Twitch OAuth ----
+	def api_oauth2_authorize(self, method, args):
+		# Skip the consent screen and go straight back to the app
+		code = "code-%d" % next(ids)
+		self.send(302, None, [("Location", args["redirect_uri"] + "?" + urlencode({
+			"code": code, "state": args.get("state", ""), "scope": args.get("scope", "")}))])
+
+	def api_oauth2_token(self, method, args):
+		form = self.form()
+		if form.get("grant_type") == "authorization_code": user = form.get("code", "code-1000").split("-")[-1]
+		elif form.get("grant_type") == "refresh_token": user = form.get("refresh_token", "refresh-1000").split("-")[-1]
+		else: user = "app"
+		self.send(200, {"access_token": "token-" + user, "refresh_token": "refresh-" + user, "expires_in": 3600,
+			"token_type": "bearer", "scope": "channel_editor user:edit:broadcast user_read".split()})
+
+	# ---- Helix ----
+	def api_helix_users(self, method, args):
+		login = args.get("login")
+		if login: id = login.replace("user", "") if login.startswith("user") else str(abs(hash(login)) % 100000)
+		else: id = self.token_user()
+		self.send(200, {"data": [{"id": id, "login": "user" + id, "display_name": "User" + id, "type": "",
+			"broadcaster_type": "", "description": "", "profile_image_url": "", "offline_image_url": "", "view_count": 0}]})
+
+	def api_helix_channels(self, method, args):
+		chan = channel(args["broadcaster_id"])
+		if method == "PATCH":
+			form = self.form()
+			if form.get("title"): chan["title"] = form["title"]
+			if form.get("game_id"):
+				chan["game_id"] = form["game_id"]
+				chan["game_name"] = GAMES[int(form["game_id"]) % len(GAMES)]
+			return self.send(204)
+		self.send(200, {"data": [{k: v for k, v in chan.items() if k != "tags"}]})
+
+	def api_helix_streams_tags(self, method, args):
+		chan = channel(args["broadcaster_id"])
+		if method == "PUT":
+			want = set(self.form(multi=("tag_ids",)).get("tag_ids") or ())
+			chan["tags"] = [t for t in TAGS if t["tag_id"] in want]
+			return self.send(204)
+		self.send(200, {"data": chan["tags"]})
+
+	def api_helix_tags_streams(self, method, args):
+		start = int(args.get("after") or 0)
+		count = int(args.get("first") or 20)
+		page = TAGS[start:start + count]
+		cursor = {"cursor": str(start + count)} if start + count < len(TAGS) else {}
+		self.send(200, {"data": page, "pagination": cursor})
+
+	def api_helix_games(self, method, args):
+		name = args.get("name", "")
+		if name not in GAMES: return self.send(200, {"data": []})
+		self.send(200, {"data": [{"id": str(GAMES.index(name)), "name": name, "box_art_url": ""}]})
+
+	def api_helix_search_categories(self, method, args):
+		q = args.get("query", "").lower()
+		hits = [g for g in GAMES if q in g.lower()][:int(args.get("first") or 20)]
+		self.send(200, {"data": [{"id": str(GAMES.index(g)), "name": g, "box_art_url": ""} for g in hits]})
+
+	def api_helix_eventsub_subscriptions(self, method, args):
+		# Accept the subscription, but don't send anything; see fake_eventsub.py
+		sub = self.form() if method == "POST" else {}
+		self.send(202, {"data": [{"id": "sub-%d" % next(ids), "status": "webhook_callback_verification_pending",
+			"type": sub.get("type"), "version": sub.get("version"), "condition": sub.get("condition"),
+			"created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "cost": 1}]})
+
+	# ---- Kraken ----
+	def api_kraken_channel(self, method, args):
+		chan = channel(self.path.split("?")[0].rstrip("/").split("/")[-1])
+		if method == "PUT": self.form()
+		self.send(200, {"_id": chan["broadcaster_id"], "game": chan["game_name"], "status": chan["title"]})
+
+	# ---- Twitter ----
+	def api_oauth_request_token(self, method, args):
+		self.send(200, "oauth_token=req-%d&oauth_token_secret=reqsecret&oauth_callback_confirmed=true" % next(ids))
+
+	def api_oauth_authenticate(self, method, args):
+		# There's no callback URL given here (it was in the request token step),
+		# so the load generator follows up by hitting /authorized-twitter itself.
+		self.send(200, "oauth_token=%s&oauth_verifier=verifier" % args.get("oauth_token", ""))
+
+	def api_oauth_access_token(self, method, args):
+		self.form()
+		n = next(ids)
+		self.send(200, "oauth_token=acc-%d&oauth_token_secret=accsecret&user_id=%d&screen_name=loadtest%d" % (n, n, n))
+
+	def api_1_1_statuses_update_json(self, method, args):
+		form = self.form()
+		if len(form.get("status", "")) > 280:
+			return self.send(403, {"errors": [{"code": 186, "message": "Tweet needs to be a bit shorter."}]})
+		n = next(ids)
+		self.send(200, {"id": n, "id_str": str(n), "text": form.get("status", ""), "user": {"screen_name": "loadtest"}})
+
+def main():
+	parser = argparse.ArgumentParser(description="Fake Twitch/Twitter upstream for load testing")
+	parser.add_argument("--port", type=int, default=8001)
+	parser.add_argument("--latency", type=float, default=0, help="Mean added latency, ms")
+	parser.add_argument("--jitter", type=float, default=0, help="Latency jitter, +/- ms")
+	parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls to fail with 503")
+	parser.add_argument("--stall-rate", type=float, default=0.0, help="Fraction of calls to hang")
+	parser.add_argument("--stall-time", type=float, default=30, help="How long a hang lasts, seconds")
+	args = parser.parse_args()
+	settings.update(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+		stall_rate=args.stall_rate, stall_time=args.stall_time)
+	server = ThreadingHTTPServer(("", args.port), Handler)
+	server.daemon_threads = True
+	print("Fake upstream listening on port", args.port)
+	server.serve_forever()
+
+if __name__ == "__main__":
+	main()
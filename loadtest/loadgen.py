@@ -0,0 +1,201 @@
+# Drive a running Mustard Mine at a target request rate and report latencies.
+#
+# The app should be pointed at loadtest/fake_upstream.py (see there), so that
+# logging in works without real Twitch accounts: each virtual user goes through
+# the normal /login flow, which the fake short-circuits.
+#
+#   python3 loadtest/loadgen.py --base http://localhost:5000 --rate 50 --duration 60 \
+#     --users 20 --sockets 200 --mix mainpage=1,update=2,search_game=5,search_tag=5,countdown=5
+#
+# Requests are issued open-loop (on a fixed schedule, regardless of how quickly
+# earlier ones complete), so a slow server shows up as latency rather than as a
+# quietly reduced request rate. Countdown sockets are opened at the start and
+# held for the whole run; their connect-to-inited time is reported separately.
+import argparse
+import base64
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import re
+import socket
+import ssl
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+
+class WebSocket:
+	"""Just enough of RFC 6455 to talk to /countdown_ctrl (text frames only)"""
+	def __init__(self, url, timeout=30):
+		url = urlsplit(url)
+		port = url.port or (443 if url.scheme == "wss" else 80)
+		self.sock = socket.create_connection((url.hostname, port), timeout=timeout)
+		if url.scheme == "wss": self.sock = ssl.create_default_context().wrap_socket(self.sock, server_hostname=url.hostname)
+		key = base64.b64encode(os.urandom(16)).decode("ascii")
+		self.sock.sendall(("GET %s HTTP/1.1\r\nHost: %s\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+			"Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n" % (url.path or "/", url.netloc, key)).encode("ascii"))
+		self.buf = b""
+		while b"\r\n\r\n" not in self.buf:
+			data = self.sock.recv(4096)
+			if not data: raise ConnectionError("Socket closed during handshake")
+			self.buf += data
+		head, self.buf = self.buf.split(b"\r\n\r\n", 1)
+		if b" 101 " not in head.split(b"\r\n")[0]: raise ConnectionError("Handshake refused: %r" % head[:100])
+
+	def send(self, text):
+		data = text.encode("utf-8")
+		mask = os.urandom(4)
+		if len(data) < 126: hdr = struct.pack("!BB", 0x81, 0x80 | len(data))
+		elif len(data) < 65536: hdr = struct.pack("!BBH", 0x81, 0x80 | 126, len(data))
+		else: hdr = struct.pack("!BBQ", 0x81, 0x80 | 127, len(data))
+		self.sock.sendall(hdr + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(data)))
+
+	def _read(self, n):
+		while len(self.buf) < n:
+			data = self.sock.recv(4096)
+			if not data: raise ConnectionError("Socket closed")
+			self.buf += data
+		ret, self.buf = self.buf[:n], self.buf[n:]
+		return ret
+
+	def receive(self):
+		while True:
+			op, length = self._read(2)
+			length &= 0x7F
+			if length == 126: length, = struct.unpack("!H", self._read(2))
+			elif length == 127: length, = struct.unpack("!Q", self._read(8))
+			data = self._read(length)
+			if op & 0x0F == 1: return data.decode("utf-8")
+			if op & 0x0F == 8: raise ConnectionError("Socket closed by server")
+
+	def close(self):
+		try: self.sock.close()
+		except OSError: pass
+
+class Results:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.latencies = collections.defaultdict(list)
+		self.errors = collections.Counter()
+
+	def record(self, op, duration, ok=True):
+		with self.lock:
+			self.latencies[op].append(duration)
+			if not ok: self.errors[op] += 1
+
+	def report(self, elapsed):
+		print("%-14s %8s %8s %9s %9s %9s %7s" % ("operation", "count", "req/s", "p50 ms", "p99 ms", "max ms", "errors"))
+		for op, lat in sorted(self.latencies.items()):
+			lat = sorted(lat)
+			pct = lambda p: lat[min(len(lat) - 1, int(len(lat) * p))] * 1000
+			print("%-14s %8d %8.1f %9.1f %9.1f %9.1f %7d" % (op, len(lat), len(lat) / elapsed,
+				pct(0.50), pct(0.99), lat[-1] * 1000, self.errors[op]))
+
+class VirtualUser:
+	def __init__(self, base):
+		self.base = base
+		self.http = requests.Session()
+		# Logging in redirects via the fake upstream and back to the main page
+		r = self.http.get(base + "/login", timeout=60)
+		r.raise_for_status()
+		self.timers = re.findall(r'href="/countdown/([A-Za-z0-9]+)"', r.text)
+		self.channelid = re.search(r'name=channelid value=(\d+)', r.text).group(1)
+		self.setups = json.loads(re.search(r"let setups = (.*);", r.text).group(1))
+
+	def mainpage(self):
+		return self.http.get(self.base + "/", timeout=60)
+
+	def update(self):
+		setup = random.choice(self.setups)
+		return self.http.post(self.base + "/api/update?channelid=" + self.channelid, timeout=60,
+			json={"category": setup["category"], "title": setup["title"], "tags": setup["tags"]})
+
+	def search_game(self):
+		return self.http.get(self.base + "/search/game", params={"q": random.choice("ASGJ")}, timeout=60)
+
+	def search_tag(self):
+		return self.http.get(self.base + "/search/tag", params={"q": random.choice("ABCDMST")}, timeout=60)
+
+	def countdown(self):
+		# Overlays don't log in, so use a fresh connection for realism
+		return requests.get(self.base + "/countdown/" + random.choice(self.timers), timeout=60)
+
+def open_overlay(base, timerid, results):
+	url = base.replace("http", "ws", 1) + "/countdown_ctrl"
+	start = time.perf_counter()
+	try:
+		ws = WebSocket(url)
+		ws.send(json.dumps({"type": "init", "id": timerid}))
+		while json.loads(ws.receive()).get("type") != "inited": pass
+	except (OSError, ConnectionError, ValueError):
+		results.record("socket_init", time.perf_counter() - start, False)
+		return None
+	results.record("socket_init", time.perf_counter() - start)
+	return ws
+
+def main():
+	parser = argparse.ArgumentParser(description="Load generator for Mustard Mine")
+	parser.add_argument("--base", default="http://localhost:5000")
+	parser.add_argument("--rate", type=float, default=20, help="Requests per second, across all operations")
+	parser.add_argument("--duration", type=float, default=30, help="Seconds")
+	parser.add_argument("--users", type=int, default=10, help="Virtual users (logged-in sessions)")
+	parser.add_argument("--sockets", type=int, default=0, help="Countdown sockets to hold open")
+	parser.add_argument("--concurrency", type=int, default=200, help="Max requests in flight")
+	parser.add_argument("--mix", default="mainpage=1,update=1,search_game=4,search_tag=4,countdown=4",
+		help="Relative weights of each operation")
+	args = parser.parse_args()
+	mix = [(op, float(w)) for op, w in (part.split("=") for part in args.mix.split(","))]
+	ops, weights = zip(*mix)
+	results = Results()
+
+	print("Logging in %d virtual users..." % args.users)
+	users = [VirtualUser(args.base) for _ in range(args.users)]
+	timers = [t for u in users for t in u.timers]
+	sockets = []
+	if args.sockets:
+		print("Opening %d countdown sockets..." % args.sockets)
+		with concurrent.futures.ThreadPoolExecutor(50) as pool:
+			sockets = [ws for ws in pool.map(lambda i: open_overlay(args.base, random.choice(timers), results),
+				range(args.sockets)) if ws]
+
+	def run(op):
+		user = random.choice(users)
+		start = time.perf_counter()
+		try:
+			r = getattr(user, op)()
+			ok = r.status_code < 400 and not (op == "update" and not r.json().get("ok"))
+		except (requests.RequestException, ValueError):
+			ok = False
+		results.record(op, time.perf_counter() - start, ok)
+
+	print("Running at %.1f req/s for %d seconds..." % (args.rate, args.duration))
+	with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+		start = time.perf_counter()
+		sent = 0
+		while True:
+			now = time.perf_counter() - start
+			if now >= args.duration: break
+			due = int(now * args.rate) + 1
+			while sent < due:
+				pool.submit(run, random.choices(ops, weights)[0])
+				sent += 1
+			time.sleep(max(0, (sent / args.rate) - (time.perf_counter() - start)))
+	elapsed = time.perf_counter() - start
+	alive = 0
+	for ws in sockets:
+		# The server should still be holding every socket open
+		try:
+			ws.sock.setblocking(False)
+			try: alive += ws.sock.recv(1, socket.MSG_PEEK) != b""
+			except BlockingIOError: alive += 1
+		except OSError: pass
+		ws.close()
+	print()
+	results.report(elapsed)
+	if sockets: print("Sockets still open at end: %d/%d" % (alive, len(sockets)))
+
+if __name__ == "__main__":
+	main()
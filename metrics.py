@@ -0,0 +1,199 @@
+"""Per-request instrumentation, exposed in Prometheus text format
+
+Each request gets a tally of database statements and upstream (Twitch,
+Twitter) calls, which gets folded into histograms when the request ends.
+Anything that happens outside of a request (scheduled tweets, the tag
+crawl) still counts towards the per-service upstream totals.
+"""
+import bisect
+import collections
+import contextlib
+import logging
+import re
+import threading
+import time
+
+# Seconds, for anything timed. Counts get their own buckets.
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+def _labels(names, values):
+	if not names: return ""
+	esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+	return "{" + ",".join('%s="%s"' % (n, esc(v)) for n, v in zip(names, values)) + "}"
+
+class Histogram:
+	def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+		self.name, self.help, self.labels, self.buckets = name, help, tuple(labels), buckets
+		self.series = {} # Map label values to [bucket counts..., sum, count]
+		self.lock = threading.Lock()
+		registry.append(self)
+
+	def observe(self, value, *labels):
+		with self.lock:
+			series = self.series.get(labels)
+			if series is None: series = self.series[labels] = [0] * (len(self.buckets) + 2)
+			# Buckets are stored non-cumulative and summed on rendering
+			series[bisect.bisect_left(self.buckets, value)] += 1
+			series[-2] += value
+			series[-1] += 1
+
+	def render(self):
+		yield "# HELP %s %s" % (self.name, self.help)
+		yield "# TYPE %s histogram" % self.name
+		with self.lock: series = {k: list(v) for k, v in self.series.items()}
+		for labels, counts in sorted(series.items()):
+			total = 0
+			for le, n in zip(self.buckets + ("+Inf",), counts):
+				total += n
+				yield "%s_bucket%s %d" % (self.name, _labels(self.labels + ("le",), labels + (le,)), total)
+			yield "%s_sum%s %s" % (self.name, _labels(self.labels, labels), counts[-2])
+			yield "%s_count%s %d" % (self.name, _labels(self.labels, labels), counts[-1])
+
+class Counter:
+	def __init__(self, name, help, labels=()):
+		self.name, self.help, self.labels = name, help, tuple(labels)
+		self.series = collections.Counter() # Map label values to count
+		self.lock = threading.Lock()
+		registry.append(self)
+
+	def inc(self, *labels):
+		with self.lock: self.series[labels] += 1
+
+	def render(self):
+		yield "# HELP %s %s" % (self.name, self.help)
+		yield "# TYPE %s counter" % self.name
+		with self.lock: series = dict(self.series)
+		for labels, n in sorted(series.items()):
+			yield "%s%s %d" % (self.name, _labels(self.labels, labels), n)
+
+class Gauge:
+	"""A value sampled at scrape time
+
+	func returns either a number, or a dict mapping label-value tuples to numbers.
+	"""
+	def __init__(self, name, help, func, labels=()):
+		self.name, self.help, self.func, self.labels = name, help, func, tuple(labels)
+		registry.append(self)
+
+	def render(self):
+		yield "# HELP %s %s" % (self.name, self.help)
+		yield "# TYPE %s gauge" % self.name
+		value = self.func()
+		if not isinstance(value, dict): value = {(): value}
+		for labels, v in sorted(value.items()):
+			yield "%s%s %s" % (self.name, _labels(self.labels, labels), v)
+
+log = logging.getLogger("mustard.metrics")
+registry = []
+request_seconds = Histogram("mustard_request_seconds", "Wall time per request", ["route"])
+request_db_queries = Histogram("mustard_request_db_queries", "Database statements per request", ["route"], COUNT_BUCKETS)
+request_db_seconds = Histogram("mustard_request_db_seconds", "Total database time per request", ["route"])
+request_upstream_calls = Histogram("mustard_request_upstream_calls", "Upstream API calls per request", ["route", "service"], COUNT_BUCKETS)
+request_upstream_seconds = Histogram("mustard_request_upstream_seconds", "Total upstream API time per request", ["route", "service"])
+upstream_seconds = Histogram("mustard_upstream_seconds", "Time per upstream API call, in or out of requests", ["service"])
+
+# Under gevent, this is greenlet-local, which is exactly one request; under
+# asgi.py, each request runs start to finish on one pool thread.
+current = threading.local()
+SERVICES = ("twitch", "twitter")
+
+def start_request():
+	current.db = [0, 0.0]
+	current.upstream = {svc: [0, 0.0] for svc in SERVICES}
+	if profiler.enabled: current.statements = []
+
+def finish_request(route, duration):
+	db = getattr(current, "db", None)
+	if db is None: return # Request started before instrumentation was hooked in
+	if profiler.enabled: profiler.finish_request(route, current.__dict__.pop("statements", ()))
+	request_seconds.observe(duration, route)
+	request_db_queries.observe(db[0], route)
+	request_db_seconds.observe(db[1], route)
+	for svc, (count, tm) in current.upstream.items():
+		request_upstream_calls.observe(count, route, svc)
+		if count: request_upstream_seconds.observe(tm, route, svc)
+	del current.db, current.upstream
+
+def record_query(sql, args, duration, rowcount):
+	"""Database hook - see database.query_hooks"""
+	db = getattr(current, "db", None)
+	if db is None: return
+	db[0] += 1
+	db[1] += duration
+
+@contextlib.contextmanager
+def upstream(service):
+	"""Time a call to an upstream API (one of SERVICES)"""
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		duration = time.perf_counter() - start
+		upstream_seconds.observe(duration, service)
+		tally = getattr(current, "upstream", None)
+		if tally is not None:
+			tally[service][0] += 1
+			tally[service][1] += duration
+
+def fingerprint(sql):
+	"""Reduce a statement to its shape, so that repeats can be spotted
+
+	Placeholders are already anonymous, but execute_values and friends inline
+	their values, so literals and lists of tuples get collapsed too.
+	"""
+	sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+	sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+	sql = sql.replace("%s", "?")
+	sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*", "(...)", sql)
+	return " ".join(sql.split())
+
+class QueryProfile:
+	"""Opt-in statement profiler - set QUERY_PROFILING in the environment
+
+	Keeps running totals per statement fingerprint, and flags any request that
+	ran the same shape of statement at least N_PLUS_ONE times (the classic
+	"one query per row" pattern).
+	"""
+	N_PLUS_ONE = 5
+	def __init__(self):
+		self.enabled = False
+		self.lock = threading.Lock()
+		self.totals = {} # Map fingerprint to [count, total time, max time, rows, params]
+		self.flagged = collections.deque(maxlen=50)
+
+	def record_query(self, sql, args, duration, rowcount):
+		"""Database hook - see database.query_hooks"""
+		if isinstance(sql, bytes): sql = sql.decode("utf-8", "replace")
+		fp = fingerprint(sql)
+		nparams = len(args) if isinstance(args, (list, tuple, dict)) else 0
+		with self.lock:
+			tot = self.totals.get(fp)
+			if tot is None: tot = self.totals[fp] = [0, 0.0, 0.0, 0, nparams]
+			tot[0] += 1; tot[1] += duration; tot[2] = max(tot[2], duration)
+			tot[3] += max(rowcount, 0)
+		statements = getattr(current, "statements", None)
+		if statements is not None: statements.append((fp, nparams, rowcount, duration))
+
+	def finish_request(self, route, statements):
+		repeats = collections.Counter(fp for fp, *_ in statements)
+		for fp, count in repeats.items():
+			if count < self.N_PLUS_ONE: continue
+			tm = sum(st[3] for st in statements if st[0] == fp)
+			self.flagged.append({"route": route, "fingerprint": fp, "count": count,
+				"seconds": tm, "statements": len(statements), "at": int(time.time())})
+			log.warning("Repeated statement: %s ran %r %d times", route, fp, count)
+
+	def report(self, limit=20):
+		with self.lock: totals = list(self.totals.items())
+		totals.sort(key=lambda t: -t[1][1])
+		return {
+			"slowest": [{"fingerprint": fp, "count": count, "total_seconds": total,
+				"max_seconds": worst, "mean_seconds": total / count, "rows": rows, "params": params}
+				for fp, (count, total, worst, rows, params) in totals[:limit]],
+			"repeated": list(self.flagged),
+		}
+profiler = QueryProfile()
+
+def render():
+	return "".join(line + "\n" for metric in registry for line in metric.render())
@@ -1,23 +1,36 @@
 import base64
 import collections
+import concurrent.futures
+import contextlib
 import datetime
 import functools
+import gzip
+import hmac
 import json
+import logging
 import os
+import queue
+import random
+import resource
 import sys
 import threading
 import time
+import tracemalloc
+import zipfile
 import pytz
-from pprint import pprint
-# Hack: Get gevent to do its monkeypatching as early as possible.
-# I have no idea what this is actually doing, but if you let the
-# patching happen automatically, it happens too late, and we get
-# RecursionErrors and such. There's a helpful warning on startup.
-from gevent import monkey; monkey.patch_all(subprocess=True)
-from flask import Flask, request, redirect, session, url_for, g, render_template, jsonify, Response, Markup
-from flask_sockets import Sockets
+# Served on asyncio by asgi.py (which sets this) rather than by gevent?
+ASYNC_MODE = bool(os.environ.get("MUSTARD_ASYNC"))
+if not ASYNC_MODE:
+	# Hack: Get gevent to do its monkeypatching as early as possible.
+	# I have no idea what this is actually doing, but if you let the
+	# patching happen automatically, it happens too late, and we get
+	# RecursionErrors and such. There's a helpful warning on startup.
+	from gevent import monkey; monkey.patch_all(subprocess=True)
+	from flask_sockets import Sockets
+from flask import Flask, request, redirect, session, url_for, g, render_template, jsonify, Response, Markup, has_request_context
 from authlib.integrations.requests_client import OAuth1Session, OAuth2Session
 import requests
+from werkzeug.exceptions import RequestEntityTooLarge
 
 try:
 	import config
@@ -36,12 +49,187 @@ except ImportError:
 		sys.exit(1)
 	sys.modules["config"] = config # Make the config vars available elsewhere
 
+import assets
 import database
+import eventsub
+import metrics
+import session_store
+import tags
+import twitter_client
 import utils
+log_handler = utils.setup_logging(os.environ.get("LOG_LEVEL", "INFO"))
+log = logging.getLogger("mustard")
 app = Flask(__name__)
 app.secret_key = config.SESSION_SECRET or base64.b64encode(os.urandom(12))
-scheduler = utils.Scheduler()
-sockets = Sockets(app)
+app.session_interface = session_store.PostgresSessionInterface()
+scheduler = utils.Scheduler(limit=10000)
+sockets = None if ASYNC_MODE else Sockets(app)
+database.query_hooks.append(metrics.record_query)
+if os.environ.get("QUERY_PROFILING"):
+	metrics.profiler.enabled = True
+	database.query_hooks.append(metrics.profiler.record_query)
+
+@app.before_request
+def start_timing():
+	g.request_start = time.perf_counter()
+	metrics.start_request()
+
+@app.teardown_request
+def finish_timing(exc):
+	if "request_start" not in g: return
+	route = request.url_rule.rule if request.url_rule else "<unmatched>"
+	metrics.finish_request(route, time.perf_counter() - g.request_start)
+
+GZIP_MIN_SIZE = 1024 # Smaller bodies aren't worth compressing
+
+def json_response(produce, etag=None):
+	"""Respond with the JSON of produce(), gzipped if big enough and acceptable
+
+	Given an etag, which must change whenever the data would, a client whose
+	copy is current gets a 304 without produce() being called at all.
+	"""
+	headers = {"Vary": "Accept-Encoding"}
+	if etag:
+		headers["Cache-Control"] = "private, no-cache" # Always revalidate, but it's cheap to
+		for encoding in ("identity", "gzip"):
+			tag = "%s-%s" % (etag, encoding)
+			if request.if_none_match.contains(tag):
+				return Response(status=304, headers=dict(headers, ETag='"%s"' % tag))
+	body = json.dumps(produce(), separators=(",", ":")).encode("utf-8")
+	bodies = {"identity": body}
+	if len(body) >= GZIP_MIN_SIZE: bodies["gzip"] = gzip.compress(body, 6)
+	encoding, body = assets.negotiate(bodies, request.headers.get("Accept-Encoding", ""))
+	if encoding != "identity": headers["Content-Encoding"] = encoding
+	if etag: headers["ETag"] = '"%s-%s"' % (etag, encoding)
+	return Response(body, mimetype="application/json", headers=headers)
+
+@app.route("/metrics")
+def show_metrics():
+	return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Per-process caches, with the most entries each may keep. Expired entries are
+# dropped periodically, and then the soonest-to-expire, if still too many.
+CACHE_LIMITS = {"channel_editor_cache": 10000, "channel_state": 5000, "eventsub_subscribed": 5000, "game_ids": 10000, "golive_until": 10000, "timer_history": 10000, "timer_channels": 10000}
+HOUSEKEEPING_INTERVAL = 300
+
+def housekeeping():
+	while True:
+		time.sleep(HOUSEKEEPING_INTERVAL)
+		try: housekeeping_pass()
+		except Exception:
+			log.exception("Housekeeping failed")
+
+def housekeeping_pass():
+	utils.prune(channel_editor_cache, lambda expiry: expiry, CACHE_LIMITS["channel_editor_cache"])
+	utils.prune(channel_state, lambda entry: entry[1], CACHE_LIMITS["channel_state"])
+	utils.prune(game_ids, lambda entry: entry[1], CACHE_LIMITS["game_ids"])
+	utils.prune(golive_until, lambda end: end, CACHE_LIMITS["golive_until"])
+	for channelid in utils.prune(eventsub_subscribed, lambda used: used + EVENTSUB_IDLE, CACHE_LIMITS["eventsub_subscribed"]):
+		channel_state.pop(channelid, None) # Nothing will be keeping it current now
+		unsubscribe_channel(channelid)
+	# Overlay registrations and histories are only needed for overlays that
+	# are, or might soon be, listening (and a listening stream's sequence
+	# numbers must not start over)
+	now = time.time()
+	for id in list(timer_sockets) + list(timer_streams):
+		if id in timer_history: timer_history[id][2] = now
+		if id in timer_channels: timer_channels[id][1] = now
+	utils.prune(timer_history, lambda hist: hist[2] + HOUSEKEEPING_INTERVAL, CACHE_LIMITS["timer_history"])
+	utils.prune(timer_channels, lambda entry: entry[1] + HOUSEKEEPING_INTERVAL, CACHE_LIMITS["timer_channels"])
+	index = collections.defaultdict(set)
+	for id, (channelid, seen) in list(timer_channels.items()): index[channelid].add(id)
+	channel_overlays.clear(); channel_overlays.update(index)
+	database.purge_sessions()
+
+def memory_sizes():
+	"""Count the entries in everything per-process that could grow"""
+	return {
+		"channel_editor_cache": len(channel_editor_cache),
+		"channel_state": len(channel_state),
+		"game_ids": len(game_ids),
+		"golive_until": len(golive_until),
+		"prewarm_queued": len(prewarm_queued),
+		"prewarm_schedule": len(prewarm_schedule.queue.queue),
+		"eventsub_schedule": len(eventsub_schedule.queue.queue),
+		"eventsub_subscribed": len(eventsub_subscribed),
+		"eventsub_seen": len(eventsub_receiver.seen) if eventsub_receiver else 0,
+		"timer_sockets": len(timer_sockets),
+		"timer_streams": len(timer_streams),
+		"timer_history": len(timer_history),
+		"timer_channels": len(timer_channels),
+		"scheduler_queue": len(scheduler.queue.queue),
+		"scheduler_deleted": len(scheduler.deleted),
+		"known_users": len(database.known_users),
+		"session_cache": len(app.session_interface.cache),
+		"twitter_sessions": len(tweeter.sessions),
+		"tag_catalogue": len(tags._catalogue.ids) if tags._catalogue else 0,
+	}
+
+memory_baseline = None
+
+# The /debug pages expose other people's channel IDs and the app's internals,
+# so are only for these Twitch user IDs (comma-separated), or anyone sending
+# "Authorization: Bearer <DEBUG_TOKEN>" (eg scripts in loadtest/).
+DEBUG_ADMINS = set(filter(None, os.environ.get("DEBUG_ADMINS", "").split(",")))
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN")
+
+def debug_only(f):
+	"""Wrap a routed function so only admins (see DEBUG_ADMINS) may use it"""
+	@functools.wraps(f)
+	def handler(*a, **kw):
+		auth = request.headers.get("Authorization", "")
+		if DEBUG_TOKEN and hmac.compare_digest(auth.encode("utf-8"), ("Bearer " + DEBUG_TOKEN).encode("utf-8")):
+			return f(*a, **kw)
+		if session.get("twitch_user", {}).get("_id") in DEBUG_ADMINS: return f(*a, **kw)
+		return "Not permitted (see DEBUG_ADMINS and DEBUG_TOKEN)", 403
+	return handler
+
+def limit_arg(default=20):
+	"""The ?limit= for a debug listing; raises ValueError if it isn't a count"""
+	limit = request.args.get("limit", str(default))
+	if not limit.isdigit(): raise ValueError("limit must be a non-negative integer")
+	return int(limit)
+
+@app.route("/debug/memory")
+@debug_only
+def show_memory():
+	"""Sizes of the per-process structures, and (if tracing) the top allocators
+
+	Pass baseline=1 to keep this snapshot; later calls then also report the
+	growth since, by allocation site.
+	"""
+	global memory_baseline
+	try: limit = limit_arg()
+	except ValueError as e: return str(e), 400
+	ret = {"sizes": memory_sizes(), "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+	if not tracemalloc.is_tracing():
+		ret["tracemalloc"] = "Not tracing (set MEMORY_PROFILING)"
+		return jsonify(ret)
+	snap = tracemalloc.take_snapshot().filter_traces([
+		tracemalloc.Filter(False, tracemalloc.__file__),
+		tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+	])
+	ret["traced_kb"] = tracemalloc.get_traced_memory()[0] // 1024
+	ret["top"] = [{"where": str(stat.traceback), "size_kb": stat.size // 1024, "count": stat.count}
+		for stat in snap.statistics("lineno")[:limit]]
+	if memory_baseline:
+		ret["growth"] = [{"where": str(stat.traceback), "size_diff_kb": stat.size_diff // 1024, "count_diff": stat.count_diff}
+			for stat in snap.compare_to(memory_baseline, "lineno")[:limit]]
+	if request.args.get("baseline"): memory_baseline = snap
+	return jsonify(ret)
+
+@app.route("/debug/tags")
+@debug_only
+def show_tags_status():
+	return jsonify(database.get_tags_status())
+
+@app.route("/debug/queries")
+@debug_only
+def show_query_profile():
+	if not metrics.profiler.enabled: return "Query profiling not enabled (set QUERY_PROFILING)", 404
+	try: limit = limit_arg()
+	except ValueError as e: return str(e), 400
+	return jsonify(metrics.profiler.report(limit))
 
 # Override Flask's forcing of Location headers to be absolute, since it
 # gets stuff flat-out wrong. Also, the spec now says that relative
@@ -60,33 +248,123 @@ if os.environ.get("OVERRIDE_REDIRECT_HTTPS"):
 
 REQUIRED_SCOPES = "channel_editor user:edit:broadcast user_read" # Ensure that these are sorted
 
+# Upstream API locations. Override these (eg to point at loadtest/fake_upstream.py)
+# via the environment; each must end with a slash.
+TWITCH_API = os.environ.get("TWITCH_API_BASE", "https://api.twitch.tv/")
+TWITCH_ID = os.environ.get("TWITCH_ID_BASE", "https://id.twitch.tv/")
+TWITTER_API = os.environ.get("TWITTER_API_BASE", "https://api.twitter.com/")
+
+# Per-endpoint (connect, read) timeouts for Twitch calls, in seconds. The
+# longest matching prefix wins. Without these, a hung Twitch would hang us too.
+TWITCH_TIMEOUTS = {
+	"": (3.05, 10),
+	"helix/search/": (3.05, 4), # Interactive, once per keystroke
+	"helix/tags/streams": (3.05, 30), # Background crawl, big pages
+}
+TWITTER_TIMEOUT = (3.05, 15)
+# Connection trouble, timeouts and 5xx responses count as failures; a 4xx
+# means the service is up and just doesn't like us.
+twitch_breaker = utils.CircuitBreaker("Twitch", failures=(requests.RequestException,))
+twitter_breaker = utils.CircuitBreaker("Twitter", failures=(requests.RequestException,))
+tweeter = twitter_client.Client(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET,
+	TWITTER_API, TWITTER_TIMEOUT, twitter_breaker)
+THREAD_RESUMES = 3 # Times to come back to a partly-posted thread
+THREAD_RESUME_DELAY = 60
+
+# Requests that need Twitch may occupy at most this many of the worker's
+# connections at once, so that a Twitch outage can't tie up all of them; the
+# rest stay available to routes that don't need Twitch (eg countdowns). Under
+# asgi.py, requests get only ASYNC_THREADS threads, so Twitch may have at most
+# all but one of them (by default, half).
+ASYNC_THREADS = int(os.environ.get("ASYNC_THREADS", "32"))
+TWITCH_CONCURRENCY = int(os.environ.get("TWITCH_CONCURRENCY", ASYNC_THREADS // 2 if ASYNC_MODE else 50))
+if ASYNC_MODE: TWITCH_CONCURRENCY = max(1, min(TWITCH_CONCURRENCY, ASYNC_THREADS - 1))
+twitch_admission = threading.BoundedSemaphore(TWITCH_CONCURRENCY)
+twitch_inflight = 0
+
+class TwitchBusy(Exception): pass
+
+@contextlib.contextmanager
+def twitch_slot():
+	"""Occupy one of the TWITCH_CONCURRENCY slots, raising TwitchBusy if none free up
+
+	A request holds at most one, so nesting is free. Outside a request (eg
+	threads working for one that already holds its slot), this does nothing.
+	"""
+	global twitch_inflight
+	if not has_request_context() or request.environ.get("mustard.twitch_slot"):
+		yield
+		return
+	if not twitch_admission.acquire(timeout=2): raise TwitchBusy
+	twitch_inflight += 1
+	request.environ["mustard.twitch_slot"] = True
+	try:
+		yield
+	finally:
+		request.environ["mustard.twitch_slot"] = False
+		twitch_inflight -= 1
+		twitch_admission.release()
+
+def needs_twitch(f):
+	"""Wrap a routed function that talks to Twitch, to limit how many can run at once"""
+	@functools.wraps(f)
+	def handler(*a, **kw):
+		with twitch_slot():
+			return f(*a, **kw)
+	return handler
+
+@app.errorhandler(TwitchBusy)
+def twitch_busy(e):
+	msg = "Server busy - please try again shortly"
+	if request.path.startswith("/api/"): return jsonify({"ok": False, "error": msg}), 503, {"Retry-After": "5"}
+	return msg, 503, {"Retry-After": "5"}
+
+@app.errorhandler(utils.CircuitOpen)
+@app.errorhandler(requests.Timeout)
+@app.errorhandler(requests.ConnectionError)
+@app.errorhandler(requests.HTTPError) # 5xx from twitch_request or the Twitter client, or an unexpected 4xx
+def upstream_unavailable(e):
+	status = 503
+	if isinstance(e, utils.CircuitOpen): msg, retry = str(e), int(e.retry_after) + 1
+	elif isinstance(e, requests.HTTPError):
+		if e.response is not None and e.response.status_code >= 500: msg, retry = "Twitch or Twitter is having trouble", 30
+		else: # Not an outage, and not something we handle; worth a look
+			log.exception("Unexpected response from upstream")
+			msg, retry, status = "Unexpected response from Twitch or Twitter", 30, 502
+	else: msg, retry = "Timed out talking to Twitch or Twitter", 30
+	msg += " - please try again shortly"
+	if request.path.startswith("/api/"): return jsonify({"ok": False, "error": msg}), status, {"Retry-After": str(retry)}
+	return msg, status, {"Retry-After": str(retry)}
+
+def twitch_request(method, base, path, **kw):
+	"""Make one call to Twitch, with a timeout, through the circuit breaker"""
+	timeout = TWITCH_TIMEOUTS[max((p for p in TWITCH_TIMEOUTS if path.startswith(p)), key=len)]
+	with twitch_breaker, metrics.upstream("twitch"):
+		r = requests.request(method, base + path, timeout=timeout, **kw)
+		if r.status_code >= 500: r.raise_for_status()
+	return r
+
 class TwitchDataError(Exception):
 	def __init__(self, error):
 		self.__dict__.update(error)
 		super().__init__(error["message"])
 
-def query(endpoint, *, token, method="GET", params=None, data=None, auto_refresh=True):
+def query(endpoint, *, token, method="GET", params=None, data=None, body=None, auto_refresh=True, user_token=None):
 	# If this is called outside of a Flask request context, be sure to provide
-	# the auth token, and set auto_refresh to False.
+	# the auth token: either token="app", or the user's own as user_token (with
+	# token="oauth" or "bearer" saying how to send it; it won't be refreshed,
+	# as there's no session to save a new one in). Pass body= to send JSON.
 	# TODO: Tidy up all this mess of auth patterns. It'll probably be easiest
 	# to migrate everything to Helix first, and then probably everything will
 	# use Bearer or App authentication.
 	if token is None:
 		auth = None
 	elif token == "oauth":
-		auth = "OAuth " + session["twitch_token"]
+		auth = "OAuth " + (user_token or session["twitch_token"])
 	elif token == "bearer":
-		auth = "Bearer " + session["twitch_token"]
+		auth = "Bearer " + (user_token or session["twitch_token"])
 	elif token == "app":
-		r = requests.post("https://id.twitch.tv/oauth2/token", data={
-			"grant_type": "client_credentials",
-			"client_id": config.CLIENT_ID, "client_secret": config.CLIENT_SECRET,
-		})
-		r.raise_for_status()
-		data = r.json()
-		auth = "Bearer " + data["access_token"]
-		# TODO: Save the token so long as it's valid
-		# expires = int(time.time()) + data["expires_in"] - 120
+		auth = "Bearer " + get_app_token()
 	else:
 		auth = "OAuth " + token # Not currently used anywhere
 
@@ -98,14 +376,17 @@ def query(endpoint, *, token, method="GET", params=None, data=None, auto_refresh
 	# soon be fixed and then we can finally go Helix-exclusive!
 	if not endpoint.startswith(("kraken/", "helix/")): raise ValueError("Need explicit selection of API (helix or kraken)")
 	# if not endpoint.startswith(("kraken/", "helix/")): endpoint = "helix/" + endpoint
-	r = requests.request(method, "https://api.twitch.tv/" + endpoint,
-		params=params, data=data, headers={
+	r = twitch_request(method, TWITCH_API, endpoint,
+		params=params, data=data, json=body, headers={
 		"Accept": "application/vnd.twitchtv.v5+json", # for Kraken only
 		"Client-ID": config.CLIENT_ID,
 		"Authorization": auth,
 	})
-	if auto_refresh and r.status_code == 401 and r.json()["message"].lower() == "invalid oauth token":
-		r = requests.post("https://id.twitch.tv/oauth2/token", data={
+	if token == "app" and auto_refresh and r.status_code == 401:
+		app_token[1] = 0 # Revoked, or expired early. Get a new one and try again (once).
+		return query(endpoint, token="app", method=method, params=params, data=data, body=body, auto_refresh=False)
+	if auto_refresh and not user_token and r.status_code == 401 and r.json()["message"].lower() == "invalid oauth token":
+		r = twitch_request("POST", TWITCH_ID, "oauth2/token", data={
 			"grant_type": "refresh_token",
 			"refresh_token": session["twitch_refresh_token"],
 			"client_id": config.CLIENT_ID, "client_secret": config.CLIENT_SECRET,
@@ -119,16 +400,39 @@ def query(endpoint, *, token, method="GET", params=None, data=None, auto_refresh
 		# prevent infinite loops by disabling auto-refresh. Otherwise, pass-through.
 		# (But DO pass the token-passing mode.)
 		return query(endpoint, token="bearer" if token == "bearer" else "oauth",
-			method=method, params=params, data=data, auto_refresh=False)
+			method=method, params=params, data=data, body=body, auto_refresh=False)
 	if r.status_code == 403:
-		# TODO: What if it *isn't* of this form??
-		raise TwitchDataError(json.loads(r.json()["message"]))
+		# Kraken puts a JSON object inside the message; Helix's is plain text
+		try: error = json.loads(r.json()["message"])
+		except (ValueError, KeyError, TypeError): error = None
+		if not isinstance(error, dict) or "message" not in error: error = {"message": r.text or "Forbidden"}
+		raise TwitchDataError(error)
 	r.raise_for_status()
 	if r.status_code == 204: return {}
 	return r.json()
 
+app_token = ["", 0] # Twitch app access token, and when to stop using it
+app_token_lock = threading.Lock()
+
+def get_app_token():
+	"""Get an app access token, reusing one until shortly before it expires"""
+	with app_token_lock: # Only one fetch at a time; everyone else waits for it
+		if app_token[1] > time.time():
+			cache_lookup("app_token", True)
+			return app_token[0]
+		cache_lookup("app_token", False)
+		r = twitch_request("POST", TWITCH_ID, "oauth2/token", data={
+			"grant_type": "client_credentials",
+			"client_id": config.CLIENT_ID, "client_secret": config.CLIENT_SECRET,
+		})
+		r.raise_for_status()
+		data = r.json()
+		app_token[:] = data["access_token"], time.time() + data.get("expires_in", 3600) - 120
+		return app_token[0]
+
 def get_all_tags():
-	print("Fetching tags into cache...")
+	"""Crawl Twitch's full list of (non-automatic) stream tags"""
+	log.info("Fetching tags into cache...")
 	t = time.time()
 	cursor = ""
 	all_tags = []
@@ -142,9 +446,29 @@ def get_all_tags():
 		)
 		seen += len(data["data"])
 		cursor = data["pagination"].get("cursor")
-		print("Fetching more... %d/%d" % (len(all_tags), seen))
-	database.replace_all_tags(all_tags)
-	print(len(all_tags), "tags fetched. Time taken:", time.time() - t)
+		log.info("Fetching more... %d/%d", len(all_tags), seen)
+	log.info("%d tags fetched. Time taken: %.1fs", len(all_tags), time.time() - t)
+	return all_tags
+
+TAGS_CHECK_INTERVAL = 3600 # Seconds between checks of whether the tags are due a refresh
+tags_status = {} # As of the last check; see database.get_tags_status
+
+def tag_refresher():
+	"""Keep the tags cache fresh, for as long as the process runs
+
+	Every process does this, but database.refresh_tags lets only one crawl at
+	a time; the rest see the new version through tags.current().
+	"""
+	global tags_status
+	while True:
+		try:
+			if database.tags_need_updating() and database.refresh_tags(get_all_tags):
+				tags.invalidate()
+			tags_status = database.get_tags_status()
+		except Exception:
+			log.exception("Tag refresh failed")
+		# Jittered, so that processes started together don't check together
+		time.sleep(TAGS_CHECK_INTERVAL * random.uniform(0.9, 1.1))
 
 def format_time(tm, tz):
 	"""Format a time_t in a human-readable way, based on the timezone"""
@@ -157,7 +481,7 @@ def format_time(tm, tz):
 	return tm.strftime("at %H:%M")
 
 channel_editor_cache = {}
-def may_edit_channel(userid, channelid):
+def may_edit_channel(userid, channelid, user_token=None):
 	# Twitch will ensure that we have legit powers before making any actual
 	# channel changes, but we need to guard the Mustard Mine setups themselves.
 	# Unfortunately, we can't easily ask Twitch whether or not we have editor
@@ -171,10 +495,15 @@ def may_edit_channel(userid, channelid):
 	if userid == channelid: return True # Trivially true
 	if channel_editor_cache.get((userid, channelid), 0) > time.time():
 		# The user was an editor when last seen, recently
+		cache_lookup("permissions", True, channelid)
 		return True
+	cache_lookup("permissions", False, channelid)
+	# Many routes only reach Twitch here, on a cache miss, so this is where
+	# they take their slot (a no-op for those already under needs_twitch).
 	try:
-		data = query("kraken/channels/%s" % channelid, method="GET", token=None)
-		resp = query("kraken/channels/%s" % channelid, method="PUT", token="oauth", data={"channel[game]": data["game"]})
+		with twitch_slot():
+			data = query("kraken/channels/%s" % channelid, method="GET", token=None)
+			resp = query("kraken/channels/%s" % channelid, method="PUT", token="oauth", user_token=user_token, data={"channel[game]": data["game"]})
 		channel_editor_cache[(userid, channelid)] = time.time() + 900
 		return True
 	except TwitchDataError as e:
@@ -190,6 +519,7 @@ def wants_channelid(f):
 	def handler(*a, **kw):
 		userid = session["twitch_user"]["_id"]
 		channelid = request.form.get("channelid") or request.args.get("channelid") or userid
+		g.channelid = channelid # For cache_lookup
 		if not may_edit_channel(userid, channelid): return redirect(url_for("mainpage"))
 		resp = f(*a, **kw, channelid=channelid)
 		if (channelid != userid and
@@ -204,18 +534,105 @@ def list_scheduled_tweets(token, secret, sched_tz):
 	cred = (token, secret)
 	return [(format_time(tm, sched_tz), id, args[1]) for tm, id, args in scheduler.search(send_tweet) if args[0] == cred]
 
-def get_channel_setup(channelid):
-	channel = query("helix/channels?broadcaster_id=" + channelid, token="bearer")["data"][0]
+# Channel info as last seen, kept current by EventSub notifications. Only used
+# if EventSub is configured, since otherwise nothing would tell us about changes
+# made elsewhere (eg on Twitch's dashboard). Tags aren't in the notifications,
+# so tag changes made elsewhere can take up to CHANNEL_STATE_TTL to show up.
+channel_state = {} # channelid: (channel, expiry)
+CHANNEL_STATE_TTL = 900
+EVENTSUB_SECRET = os.environ.get("EVENTSUB_SECRET")
+EVENTSUB_CALLBACK = os.environ.get("EVENTSUB_CALLBACK") # eg https://mustardmine.herokuapp.com/eventsub
+eventsub_receiver = EVENTSUB_SECRET and EVENTSUB_CALLBACK and eventsub.Receiver(EVENTSUB_SECRET)
+eventsub_subscribed = {} # channelid: when its channel info was last wanted
+EVENTSUB_IDLE = 6 * 3600 # Unsubscribe from channels not looked at for this long
+# Subscribing gets a schedule of its own, to stay out of the way of tweets
+eventsub_schedule = utils.Scheduler(limit=1000)
+
+def subscribe_channel(channelid):
+	"""Ask Twitch to tell us about changes to a channel (runs in eventsub_schedule's thread)"""
+	try:
+		query("helix/eventsub/subscriptions", method="POST", token="app", body={
+			"type": "channel.update", "version": "1",
+			"condition": {"broadcaster_user_id": channelid},
+			"transport": {"method": "webhook", "callback": EVENTSUB_CALLBACK, "secret": EVENTSUB_SECRET},
+		})
+	except requests.HTTPError as e:
+		# 409 Conflict means we're already subscribed, probably from before a restart
+		if e.response.status_code != 409:
+			log.warning("Unable to subscribe to channel %s: %s", channelid, e)
+			eventsub_subscribed.pop(channelid, None) # Try again next time it's fetched
+	except (requests.RequestException, utils.CircuitOpen, TwitchDataError) as e:
+		log.warning("Unable to subscribe to channel %s: %s", channelid, e)
+		eventsub_subscribed.pop(channelid, None)
+	except Exception:
+		log.exception("Unable to subscribe to channel %s", channelid)
+		eventsub_subscribed.pop(channelid, None)
+
+def unsubscribe_channel(channelid):
+	"""Stop Twitch telling us about a channel (runs in the housekeeping thread)
+
+	Looked up rather than remembered, so as to also find subscriptions made
+	before a restart.
+	"""
+	try:
+		subs = query("helix/eventsub/subscriptions", params={"user_id": channelid}, token="app")["data"]
+		for sub in subs:
+			if sub["type"] == "channel.update" and sub["transport"].get("callback") == EVENTSUB_CALLBACK:
+				query("helix/eventsub/subscriptions", method="DELETE", params={"id": sub["id"]}, token="app")
+	except (requests.RequestException, utils.CircuitOpen, TwitchDataError) as e:
+		log.warning("Unable to unsubscribe from channel %s: %s", channelid, e)
+	except Exception:
+		log.exception("Unable to unsubscribe from channel %s", channelid)
+
+def get_channel_setup(channelid, token="bearer"):
+	cached = channel_state.get(channelid)
+	if channelid in eventsub_subscribed: eventsub_subscribed[channelid] = time.time()
+	if cached and cached[1] > time.time():
+		cache_lookup("channel_state", True, channelid)
+		return dict(cached[0])
+	if eventsub_receiver: cache_lookup("channel_state", False, channelid)
+	channel = query("helix/channels?broadcaster_id=" + channelid, token=token)["data"][0]
 	# For compatibility and convenience, provide _id as an alias for broadcaster_id.
 	channel["_id"] = channel["broadcaster_id"]
-	# 20200619: Temporary compatibility in case people have cached versions of the JS
-	channel["game"] = channel["game_name"]; channel["status"] = channel["title"]
-	tags = query("helix/streams/tags", params={"broadcaster_id": channelid}, token="app")
-	channel["tags"] = ", ".join(sorted(t["localization_names"]["en-us"] for t in tags["data"] if not t["is_auto"]))
+	current = query("helix/streams/tags", params={"broadcaster_id": channelid}, token="app")
+	channel["tags"] = ", ".join(sorted(t["localization_names"]["en-us"] for t in current["data"] if not t["is_auto"]))
+	if eventsub_receiver:
+		channel_state[channelid] = dict(channel), time.time() + CHANNEL_STATE_TTL
+		if channelid not in eventsub_subscribed:
+			eventsub_subscribed[channelid] = time.time() # Don't queue it twice; removed again on failure
+			try: eventsub_schedule.put(time.time(), subscribe_channel, channelid)
+			except queue.Full: eventsub_subscribed.pop(channelid, None) # Next time, then
 	return channel
 
+@app.route("/eventsub", methods=["POST"])
+def eventsub_callback():
+	if not eventsub_receiver: return "EventSub not configured", 404
+	body = request.get_data()
+	try:
+		if not eventsub_receiver.check(request.headers, body): return "", 204 # Seen it already
+	except ValueError as e:
+		return str(e), 403
+	msg = json.loads(body)
+	msgtype = request.headers.get("Twitch-Eventsub-Message-Type")
+	if msgtype == "webhook_callback_verification":
+		return msg["challenge"], 200, {"Content-Type": "text/plain"}
+	channelid = msg["subscription"]["condition"].get("broadcaster_user_id")
+	if msgtype == "revocation":
+		eventsub_subscribed.pop(channelid, None)
+		channel_state.pop(channelid, None)
+	elif msgtype == "notification" and msg["subscription"]["type"] == "channel.update":
+		event = msg["event"]
+		cached = channel_state.get(channelid)
+		if cached:
+			channel = cached[0]
+			channel.update(title=event["title"], game_id=event["category_id"], game_name=event["category_name"],
+				broadcaster_language=event["language"])
+			channel_state[channelid] = channel, time.time() + CHANNEL_STATE_TTL
+	return "", 204
+
 @app.route("/")
 @app.route("/editor/<channelid>")
+@needs_twitch
 def mainpage(channelid=None):
 	# NOTE: If we've *reduced* the required scopes, this will still force a re-login.
 	# However, it'll be an easy login, as Twitch will recognize the existing auth.
@@ -232,6 +649,7 @@ def mainpage(channelid=None):
 		# users is either an empty list (bad login) or a list of one.
 		if not users: return redirect("/")
 		return redirect("/editor/" + users[0]["id"])
+	g.channelid = channelid # For cache_lookup
 	if not may_edit_channel(user["_id"], channelid): return redirect(url_for("mainpage"))
 	database.create_user(channelid) # Just in case, make sure the database has the basic structure
 	channel = get_channel_setup(channelid)
@@ -242,49 +660,150 @@ def mainpage(channelid=None):
 		twitter = "Twitter connected: " + username
 		tweets = list_scheduled_tweets(auth["oauth_token"], auth["oauth_token_secret"], sched_tz)
 	else:
-		twitter = Markup("""<div id="login-twitter"><a href="/login-twitter"><img src="/static/Twitter_Social_Icon_Square_Color.svg" alt="Twitter logo"><div>Connect with Twitter</div></a></div>""")
+		twitter = Markup("""<div id="login-twitter"><a href="/login-twitter"><img src="%s" alt="Twitter logo"><div>Connect with Twitter</div></a></div>""" % assets.url("Twitter_Social_Icon_Square_Color.svg"))
 		tweets = []
-	error = session.get("last_error_message", "")
-	session["last_error_message"] = ""
+	# Check before popping, so an unchanged session doesn't need saving
+	error = session.pop("last_error_message") if "last_error_message" in session else ""
+	# Flag any saved setups whose tags wouldn't apply cleanly
+	setups = database.list_setups(channelid)
+	resolved = tags.resolve(tags.split(s["tags"]) for s in setups)
+	setups = [{**s, "unknown_tags": [name for name, sugg in unknown]} for s, (ids, unknown) in zip(setups, resolved)]
 	return render_template("index.html",
 		twitter=twitter, username=user["display_name"],
 		channel=channel, channelid=channelid, error=error,
-		setups=database.list_setups(channelid),
+		setups=setups,
 		sched_tz=sched_tz, schedule=schedule, sched_tweet=sched_tweet,
 		checklist=database.get_checklist(channelid),
-		timers=database.list_timers(channelid),
+		timers=database.list_timers(channelid), overlays=live_overlays(channelid),
 		tweets=tweets,
+		tags_url=url_for("tag_dictionary", version=tags.current().version),
 	)
 
-def find_game_id(game_name, token="bearer"): # pass token="app" if no login - slower b/c we don't cache app tokens (yet)
-	resp = query("helix/games", token=token, params={"name": game_name})["data"]
-	print(resp)
+GAME_ID_TTL = 86400
+game_ids = {} # Casefolded game name: (id, expiry)
+
+def find_game_id(game_name, token="bearer", user_token=None): # pass token="app" if no login
+	key = game_name.casefold()
+	cached = game_ids.get(key)
+	if cached and cached[1] > time.time():
+		cache_lookup("game_id", True)
+		return cached[0]
+	cache_lookup("game_id", False)
+	resp = query("helix/games", token=token, user_token=user_token, params={"name": game_name})["data"]
+	log.debug("Games named %r: %r", game_name, resp)
 	if not resp: return None
+	game_ids[key] = resp[0]["id"], time.time() + GAME_ID_TTL
 	return resp[0]["id"]
 
-def do_update(channelid, info):
+# ---- Go-live pre-warming ----
+
+# Just before a scheduled stream, the streamer loads the main page, applies a
+# setup, maybe tweets - and whatever's cold costs them Twitch round trips at
+# exactly the wrong moment. So get things ready ahead of each scheduled event.
+PREWARM_AHEAD = 600 # Seconds before a scheduled event to warm up
+PREWARM_WINDOW = 1800 # Seconds after the event during which lookups count as go-live ones
+PREWARM_SCAN = 900 # Seconds between scans of everyone's schedules
+PREWARM_LIMIT = 2000 # Channels queued for warming at once
+# Warm-ups get a schedule of their own, so however many there are, they can
+# neither delay tweets and the like on the main scheduler nor fill it up.
+prewarm_schedule = utils.Scheduler(limit=PREWARM_LIMIT)
+prewarm_queued = {} # channelid: the event time it's queued for
+golive_until = {} # channelid: end of its current go-live window
+cache_lookups = metrics.Counter("mustard_cache_lookups_total", "Lookups in per-process caches, by outcome, and by "
+	"whether the channel concerned was in its go-live window", ["cache", "result", "window"])
+
+def cache_lookup(cache, hit, channelid=None):
+	"""Count a cache hit or miss; the channel defaults to the request's, if any"""
+	if channelid is None and has_request_context(): channelid = g.get("channelid")
+	golive = channelid is not None and golive_until.get(channelid, 0) > time.time()
+	cache_lookups.inc(cache, "hit" if hit else "miss", "golive" if golive else "other")
+
+def prewarm_scan():
+	"""Queue pre-warming for every channel whose next event is before the next scan"""
+	now = time.time()
+	for n, (twitchid, tz, sched) in enumerate(database.list_schedules()):
+		if not n % 1000: time.sleep(0) # Let others have a turn (we're cooperative under gevent)
+		try: event = database.find_next_event(tz, sched)
+		except (ValueError, KeyError, pytz.UnknownTimeZoneError): continue # Broken schedule; nothing to warm
+		channelid = str(twitchid)
+		if not event or event - PREWARM_AHEAD > now + PREWARM_SCAN or prewarm_queued.get(channelid) == event: continue
+		try: prewarm_schedule.put(max(now, event - PREWARM_AHEAD), prewarm_channel, channelid, event)
+		except queue.Full:
+			log.warning("Pre-warm schedule full; not pre-warming further channels")
+			break
+		prewarm_queued[channelid] = event
+
+def prewarm_channel(channelid, event):
+	"""Get everything ready for a channel about to go live (runs in prewarm_schedule's thread)
+
+	Permissions can't be checked in advance (that needs the editor's own
+	login), but the rest needs only the app token.
+	"""
+	prewarm_queued.pop(channelid, None)
+	start = time.time()
+	try:
+		get_app_token()
+		if eventsub_receiver: get_channel_setup(channelid, token="app")
+		setups = database.list_setups(channelid)
+		tags.resolve(tags.split(s["tags"]) for s in setups) # Loads the catalogue if stale
+		for category in {s["category"] for s in setups if s["category"]}:
+			find_game_id(category, token="app")
+	except (requests.RequestException, utils.CircuitOpen, TwitchDataError) as e:
+		log.warning("Unable to pre-warm channel %s: %s", channelid, e)
+	except Exception:
+		log.exception("Unable to pre-warm channel %s", channelid)
+	# Set afterwards, so that our own lookups don't count
+	golive_until[channelid] = event + PREWARM_WINDOW
+	log.debug("Pre-warmed channel %s in %.2fs", channelid, time.time() - start)
+
+def prewarmer():
+	while True:
+		try: prewarm_scan()
+		except Exception:
+			log.exception("Pre-warm scan failed")
+		time.sleep(PREWARM_SCAN)
+
+@app.route("/debug/prewarm")
+@debug_only
+def show_prewarm():
+	"""Cache hit rates in go-live windows, and otherwise"""
+	now = time.time()
+	with cache_lookups.lock: series = dict(cache_lookups.series)
+	rates = {}
+	for (cache, result, window), n in series.items():
+		rates.setdefault(window, {}).setdefault(cache, {"hit": 0, "miss": 0})[result] += n
+	for caches in rates.values():
+		for counts in caches.values(): counts["hit_rate"] = counts["hit"] / ((counts["hit"] + counts["miss"]) or 1)
+	return jsonify({"golive_channels": sorted(ch for ch, end in golive_until.items() if end > now),
+		"queued": len(prewarm_queued), "hit_rates": rates})
+
+def do_update(channelid, info, userid=None, user_token=None):
 	"""Update channel status (category, title, etc)
 
-	Returns None if successful, else a string of error/warning text.
+	Returns None if successful, else a string of error/warning text. Acts
+	for the logged-in user, unless given another's ID and token (which
+	it must be, outside of a request).
 	"""
+	if userid is None: userid = session["twitch_user"]["_id"]
+	channel_state.pop(channelid, None) # Next fetch will see what we've done
 	try:
 		# TODO: There may be a 'description' field, not sure. Should we use it?
-		gameid = info.get("game_id") or find_game_id(info["category"])
+		gameid = info.get("game_id") or find_game_id(info["category"], user_token=user_token)
 		resp = query("helix/channels?broadcaster_id=" + channelid, method="PATCH", data={
 			"game_id": gameid,
 			"title": info["title"],
-		}, token="bearer")
+		}, token="bearer", user_token=user_token)
 	except requests.exceptions.HTTPError as e:
 		# TODO: Things seem to be broken when channelid != logged in user. Is
 		# the Twitch end broken or do I need to do something different for a
 		# channel editor? For now, just guess that it might be an issue, and
 		# redo the request using the older API.
-		if channelid != session["twitch_user"]["_id"]:
+		if channelid != userid:
 			try:
 				resp = query("kraken/channels/" + channelid, method="PUT", data={
 					"channel[game]": info["category"],
 					"channel[status]": info["title"],
-				}, token="oauth")
+				}, token="oauth", user_token=user_token)
 			except TwitchDataError as e:
 				return "Stream status update not accepted: " + e.message
 	except TwitchDataError as e:
@@ -293,28 +812,29 @@ def do_update(channelid, info):
 	ret = None
 	if "tags" in info:
 		# Convert tag names into IDs
-		tags = tuple(t.strip() for t in info["tags"].split(","))
-		if len(tags) > 5: # (magic number 5 is the Twitch limit)
+		names = tags.split(info["tags"])
+		if len(names) > 5: # (magic number 5 is the Twitch limit)
 			# Note that the saved setup will include all of them.
 			# Maybe some day I'll have a UI for prioritizing tags, and
 			# then have an easy way to turn one off (eg "Warming Up")
 			# such that the next one along appears.
-			ret = "%d tags used, first five kept" % len(tags) # Warning, not error
-			tags = tags[:5]
-		tag_ids = database.get_tag_ids(tags)
-		if len(tag_ids) != len(tags):
-			return "Tag names not all found in Twitch" # TODO: Make this error friendlier
+			ret = "%d tags used, first five kept" % len(names) # Warning, not error
+			names = names[:5]
+		[(tag_ids, unknown)] = tags.resolve([names], suggest=True)
+		if unknown: return tags.describe_unknown(unknown)
 		try:
-			resp = query("helix/streams/tags", method="PUT", token="bearer",
+			resp = query("helix/streams/tags", method="PUT", token="bearer", user_token=user_token,
 				params={"broadcaster_id": channelid},
 				data={"tag_ids": tag_ids},
 			)
 		except TwitchDataError as e:
 			return "Stream tags update not accepted: " + e.message
 
+	channel_state.pop(channelid, None) # In case it got fetched while we were busy
 	return ret
 
 @app.route("/update", methods=["POST"])
+@needs_twitch
 @wants_channelid
 def update(channelid):
 	if "twitch_user" not in session:
@@ -324,6 +844,7 @@ def update(channelid):
 	return redirect(url_for("mainpage"))
 
 @app.route("/api/update", methods=["POST"])
+@needs_twitch
 @wants_channelid
 def api_update(channelid):
 	setup = get_channel_setup(channelid)
@@ -332,6 +853,79 @@ def api_update(channelid):
 	if err: return jsonify({"ok": False, "error": err})
 	return jsonify({"ok": True, "success": "Stream status updated.", "previous": previous})
 
+BULK_MAX_CHANNELS = 50
+BULK_PARALLEL = 5 # Channels being checked/updated at once, per request
+
+def is_channel_id(value):
+	# JSON true is an int to Python, but never a channel
+	return isinstance(value, (str, int)) and not isinstance(value, bool) and str(value).isdigit()
+
+def bulk_request_error(req):
+	"""Check the shape of a bulk update request; returns an error message, or None if it's usable"""
+	if not isinstance(req, dict): return "Expected a JSON object"
+	channels = req.get("channels")
+	if not isinstance(channels, list) or not all(is_channel_id(c) for c in channels):
+		return "channels must be a list of channel IDs"
+	if "setupid" in req:
+		if not isinstance(req["setupid"], int) or isinstance(req["setupid"], bool): return "setupid must be an integer"
+		if req.get("setup_channel") is not None and not is_channel_id(req["setup_channel"]):
+			return "setup_channel must be a channel ID"
+	else:
+		for key in ("category", "title", "tags"):
+			if key in req and not isinstance(req[key], str): return "%s must be a string" % key
+	return None
+
+@app.route("/api/update/bulk", methods=["POST"])
+@needs_twitch
+def api_bulk_update():
+	"""Apply one setup to many channels at once
+
+	Post {"channels": [id, ...]} and either "setupid" (one of your own saved
+	setups, or of "setup_channel" if you edit that channel) or an ad-hoc
+	"category", "title" and optionally "tags". Every channel gets the usual
+	permission check. The response lists, per channel, whether it worked and
+	how long it took.
+	"""
+	if "twitch_user" not in session: return jsonify({"ok": False, "error": "Not logged in"}), 401
+	userid = session["twitch_user"]["_id"]
+	req = request.get_json(silent=True)
+	err = bulk_request_error(req)
+	if err: return jsonify({"ok": False, "error": err}), 400
+	channels = list(dict.fromkeys(str(c) for c in req["channels"]))
+	if not channels: return jsonify({"ok": False, "error": "No channels given"})
+	if len(channels) > BULK_MAX_CHANNELS:
+		return jsonify({"ok": False, "error": "At most %d channels at once" % BULK_MAX_CHANNELS})
+	if "setupid" in req:
+		owner = str(req.get("setup_channel") or userid)
+		if not may_edit_channel(userid, owner): return jsonify({"ok": False, "error": "Setup not found"})
+		info = database.get_setup(owner, req["setupid"])
+		if not info: return jsonify({"ok": False, "error": "Setup not found"})
+	else:
+		if not req.get("category") or not req.get("title"):
+			return jsonify({"ok": False, "error": "Need a setupid, or a category and title"})
+		info = req
+	info = {k: info[k] for k in ("category", "title", "tags") if k in info}
+
+	# The workers get no request context (one can't be shared between threads),
+	# so everything they need from the session is read out here.
+	token = session["twitch_token"]
+	def apply(channelid):
+		start = time.monotonic()
+		try:
+			if not may_edit_channel(userid, channelid, user_token=token): ret = {"ok": False, "error": "Not an editor for this channel"}
+			else:
+				err = do_update(channelid, info, userid=userid, user_token=token)
+				ret = {"ok": False, "error": err} if err else {"ok": True}
+		except (requests.RequestException, utils.CircuitOpen) as e:
+			ret = {"ok": False, "error": "Unable to reach Twitch: %s" % e}
+		ret["channelid"] = channelid
+		ret["seconds"] = round(time.monotonic() - start, 3)
+		return ret
+
+	with concurrent.futures.ThreadPoolExecutor(min(BULK_PARALLEL, len(channels))) as pool:
+		results = list(pool.map(apply, channels))
+	return jsonify({"ok": all(r["ok"] for r in results), "results": results})
+
 @app.route("/schedule", methods=["POST"])
 @wants_channelid
 def update_schedule(channelid):
@@ -416,37 +1010,24 @@ def do_tweet(channelid, tweet, schedule, auth):
 	# if tweeting fails, check to see if it was "duplicate status", and if so,
 	# remove the tweet from the database. (Otherwise, error means "try again",
 	# unless we just want to schedule tweets as fire-and-forget.)
-	scheduler.put(target, send_tweet, (auth["oauth_token"], auth["oauth_token_secret"]), tweet)
+	try: scheduler.put(target, send_tweet, (auth["oauth_token"], auth["oauth_token_secret"]), tweet)
+	except queue.Full: return "Too many tweets scheduled right now - try again later"
 	return None
 
-def send_tweet(auth, tweet, in_reply_to=None):
-	"""Actually send a tweet"""
-	if isinstance(tweet, list):
-		# It's a thread of tweets
-		prev = ret = None
-		for part in tweet:
-			if not part: continue
-			info = send_tweet(auth, part, in_reply_to=prev)
-			if "error" in info: return info
-			if not ret: ret = info # Return the info for the *first* tweet sent
-			prev = info["tweet_id"]
-		return ret or {"error": "Can't send a thread of nothing but empty tweets"}
-	twitter = OAuth1Session(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET, auth[0], auth[1])
-	resp = twitter.post("https://api.twitter.com/1.1/statuses/update.json",
-		data={"status": tweet, "in_reply_to_status_id": in_reply_to})
-	if resp.status_code != 200:
-		print("Unknown response from Twitter")
-		print(resp.status_code)
-		print("---")
-		print(resp.json())
-		print("---")
+def send_tweet(auth, tweet, in_reply_to=None, resumes=0):
+	"""Actually send a tweet, or a thread of them"""
+	if not isinstance(tweet, list): return tweeter.post(auth, tweet, in_reply_to)
+	parts = [p for p in tweet if p]
+	info = tweeter.post_thread(auth, parts, in_reply_to)
+	log.info("Thread of %d: %s", len(parts), ", ".join("%.2fs/%d" % (p["seconds"], p["attempts"]) for p in info["parts"]))
+	if info.get("retryable") and info["last_id"] and resumes < THREAD_RESUMES:
+		# Partway through a thread. Rather than leave it hanging, try the rest
+		# again later, continuing on from the last part that got posted.
 		try:
-			return {"error": "Unable to send tweet: " + resp.json()["errors"][0]["message"]}
-		except LookupError:
-			return {"error": "Unknown error response from Twitter (see server console)"}
-	r = resp.json()
-	url = "https://twitter.com/%s/status/%s" % (r["user"]["screen_name"], r["id_str"])
-	return {"screen_name": r["user"]["screen_name"], "tweet_id": r["id"], "url": url}
+			scheduler.put(time.time() + THREAD_RESUME_DELAY, send_tweet, auth, parts[info["posted"]:], info["last_id"], resumes + 1)
+			info["error"] += " (the rest of the thread will be retried shortly)"
+		except queue.Full: pass
+	return info
 
 @app.route("/tweet", methods=["POST"])
 @wants_channelid
@@ -468,7 +1049,7 @@ def api_tweet(channelid):
 	err = do_tweet(channelid, request.json.get("tweet"),
 		when, session.get("twitter_oauth"))
 	if err: return jsonify({"ok": False, "error": err})
-	return jsonify({"ok": True, "success": "Tweet sent." if when == "now" else "Tweet scheduled.",
+	return json_response(lambda: {"ok": True, "success": "Tweet sent." if when == "now" else "Tweet scheduled.",
 		"new_tweets": get_user_tweets()})
 
 @app.route("/deltweet/<int:id>") # Deprecated
@@ -492,18 +1073,19 @@ def api_cancel_tweet(id):
 			ret = {"ok": True, "success": "Tweet cancelled"}
 			break
 	ret["new_tweets"] = get_user_tweets()
-	return jsonify(ret)
+	return json_response(lambda: ret)
 
 @app.route("/login")
 def login():
 	twitch = OAuth2Session(config.CLIENT_ID, config.CLIENT_SECRET,
 		scope=REQUIRED_SCOPES)
-	uri, state = twitch.create_authorization_url("https://id.twitch.tv/oauth2/authorize",
+	uri, state = twitch.create_authorization_url(TWITCH_ID + "oauth2/authorize",
 		redirect_uri=os.environ.get("OVERRIDE_REDIRECT_URI") or url_for("authorized", _external=True))
 	session["login_state"] = state
 	return redirect(uri)
 
 @app.route("/login/authorized")
+@needs_twitch
 def authorized():
 	if "error" in request.args:
 		# User cancelled the auth flow - discard auth (most likely there won't be any)
@@ -511,33 +1093,35 @@ def authorized():
 		return redirect(url_for("mainpage"))
 	twitch = OAuth2Session(config.CLIENT_ID, config.CLIENT_SECRET,
 		state=session["login_state"])
-	resp = twitch.fetch_access_token("https://id.twitch.tv/oauth2/token",
-		code=request.args["code"],
-		# For some bizarre reason, we need to pass this information along.
-		client_id=config.CLIENT_ID, client_secret=config.CLIENT_SECRET,
-		redirect_uri=url_for("authorized", _external=True))
+	with twitch_breaker:
+		resp = twitch.fetch_access_token(TWITCH_ID + "oauth2/token",
+			code=request.args["code"], timeout=TWITCH_TIMEOUTS[""],
+			# For some bizarre reason, we need to pass this information along.
+			client_id=config.CLIENT_ID, client_secret=config.CLIENT_SECRET,
+			redirect_uri=url_for("authorized", _external=True))
 	if "access_token" not in resp:
 		# Something went wrong with the retrieval. No idea what or why,
 		# so I'm doing a cop-out and just dumping to console.
-		print("Unable to log in")
-		pprint(resp)
-		print("Returning generic failure.")
+		log.warning("Unable to log in: %r", resp)
 		raise Exception
+	# A new ID for the logged-in session, so that one planted before login is useless
+	session.regenerate()
 	session["twitch_token"] = resp["access_token"]
 	session["twitch_refresh_token"] = resp["refresh_token"]
 	session["twitch_auth_scopes"] = " ".join(sorted(resp["scope"]))
 	user = query("helix/users", token="bearer")["data"][0]
-	user["_id"] = user["id"] # For now, everything looks for _id. Existing logins don't have user["id"].
-	database.create_user(user["_id"])
-	session["twitch_user"] = user
+	database.create_user(user["id"])
+	# Keep only what we use. For now, everything looks for _id rather than id.
+	session["twitch_user"] = {"_id": user["id"], "login": user["login"], "display_name": user["display_name"]}
 	return redirect(url_for("mainpage"))
 
 @app.route("/login-twitter")
 def login_twitter():
 	twitter = OAuth1Session(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET,
 		redirect_uri=url_for("authorized_twitter", _external=True))
-	session["twitter_state"] = twitter.fetch_request_token("https://api.twitter.com/oauth/request_token")
-	return redirect(twitter.create_authorization_url("https://api.twitter.com/oauth/authenticate"))
+	with twitter_breaker: token = twitter.fetch_request_token(TWITTER_API + "oauth/request_token", timeout=TWITTER_TIMEOUT)
+	session["twitter_state"] = {"oauth_token": token["oauth_token"], "oauth_token_secret": token["oauth_token_secret"]}
+	return redirect(twitter.create_authorization_url(TWITTER_API + "oauth/authenticate"))
 
 @app.route("/authorized-twitter")
 def authorized_twitter():
@@ -548,8 +1132,10 @@ def authorized_twitter():
 	req_token = session["twitter_state"]
 	twitter = OAuth1Session(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET,
 		req_token["oauth_token"], req_token["oauth_token_secret"])
-	resp = twitter.fetch_access_token("https://api.twitter.com/oauth/access_token", request.args["oauth_verifier"])
-	session["twitter_oauth"] = resp
+	with twitter_breaker:
+		resp = twitter.fetch_access_token(TWITTER_API + "oauth/access_token", request.args["oauth_verifier"], timeout=TWITTER_TIMEOUT)
+	session.pop("twitter_state", None)
+	session["twitter_oauth"] = {k: resp[k] for k in ("oauth_token", "oauth_token_secret", "screen_name")}
 	return redirect(url_for("mainpage"))
 
 @app.route("/logout")
@@ -588,7 +1174,9 @@ def parse_time(timestr):
 @app.route("/timer/<id>", methods=["POST"])
 @wants_channelid
 def save_timer(id, channelid):
-	if "delete" in request.form: database.delete_timer(channelid, id)
+	if "delete" in request.form:
+		database.delete_timer(channelid, id)
+		forget_overlay(id)
 	else: database.update_timer_details(channelid, id,
 		title=request.form["title"],
 		delta=parse_time(request.form["delta"]),
@@ -601,23 +1189,127 @@ def save_timer(id, channelid):
 def countdown(id):
 	info = database.get_public_timer_details(id)
 	if not info: return "Timer not found", 404
-	return render_template("countdown.html", id=id, **info)
+	# Server-sent events unless asked for the older socket transport (?transport=ws)
+	transport = "ws" if request.args.get("transport") == "ws" else "sse"
+	return render_template("countdown.html", id=id, transport=transport, **info)
+
+SSE_KEEPALIVE = 25 # Seconds; comfortably inside typical proxy idle timeouts
+SSE_BACKLOG = 64 # Undelivered messages before a stream is dropped (it'll reconnect and catch up)
+
+@app.route("/countdown/<id>/events")
+def countdown_events(id):
+	"""Server-sent events carrying a timer's control messages
+
+	Each message's ID is "EPOCH-SEQ". A browser that reconnects sends back
+	the last one it saw, and gets whatever it missed replayed from the timer's
+	recent history, provided the server hasn't restarted (changing EPOCH)
+	and it hasn't fallen out of the history.
+	"""
+	last = request.headers.get("Last-Event-ID", "")
+	register_overlay(id)
+	stream = queue.Queue(SSE_BACKLOG)
+	def generate():
+		timer_streams[id].append(stream)
+		try:
+			preamble, sent = stream_preamble(id, last)
+			yield preamble
+			while True:
+				try: n, data = stream.get(timeout=SSE_KEEPALIVE)
+				except queue.Empty:
+					yield ": keepalive\n\n"
+					continue
+				if n is None: break # Too far behind; let it reconnect
+				if n <= sent: continue # Already replayed
+				yield sse_event(n, data)
+		finally:
+			stream_closed(id, stream)
+	return Response(generate(), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(n, data):
+	return "id: %s-%d\ndata: %s\n\n" % (EVENT_EPOCH, n, data)
+
+def stream_preamble(id, last):
+	"""Start an event stream that's already registered in timer_streams
+
+	Returns the text to send first (anything missed since the Last-Event-ID
+	given, then "inited"), and the sequence number that brings it up to.
+	"""
+	ret = ["retry: 1000\n\n"]
+	epoch, _, seq = last.partition("-")
+	hist = timer_history.get(id)
+	sent = hist[0] if hist else 0
+	if epoch == EVENT_EPOCH and seq.isdigit() and hist:
+		# A number we haven't reached means the history was pruned and started
+		# over while this overlay was away; all of it is news.
+		seq = int(seq) if int(seq) <= hist[0] else 0
+		for n, message, at in list(hist[1]):
+			if n <= seq: continue
+			if message["type"] == "force":
+				# Forced times count from when they were sent, not from now
+				message = dict(message, time=message["time"] - (time.time() - at))
+			ret.append(sse_event(n, json.dumps(message)))
+	ret.append(sse_event(sent, json.dumps({"type": "inited"})))
+	return "".join(ret), sent
+
+def stream_closed(id, stream):
+	timer_streams[id].remove(stream)
+	if not timer_streams[id]: del timer_streams[id]
 
 # ---- Live search API ----
 
 @app.route("/search/game")
+@needs_twitch
 def findgame():
 	if request.args["q"] == "": return jsonify([]) # Prevent failure in Twitch API call
 	cats = query("helix/search/categories", params={"query": request.args["q"], "first": "50"}, token="bearer")
 	return jsonify([{
 		"name": cat["name"], "boxart": cat["box_art_url"], "id": cat["id"],
-		# Compatibility shims for cached clients (20200619)
-		"localized_name": cat["name"], "box": {"small": cat["box_art_url"]},
 	} for cat in cats["data"] or ()])
 
 @app.route("/search/tag")
 def findtag():
-	return jsonify(database.find_tags_by_prefix(request.args["q"]))
+	q = request.args["q"]
+	return json_response(lambda: database.find_tags_by_prefix(q), etag="tagsearch-" + tags.current().version)
+
+app.add_template_global(assets.url, "asset_url")
+
+@app.route("/assets/<name>")
+def static_asset(name):
+	"""A file from static/, by its fingerprinted name (see assets.py)"""
+	asset = assets.by_hashed_name.get(name)
+	if not asset:
+		# Probably a page from before a deploy. Send it to the current version.
+		parts = name.split(".")
+		original = ".".join(parts[:-2] + parts[-1:]) if len(parts) > 2 else name
+		if original in assets.manifest: return redirect(assets.url(original))
+		return "Not found", 404
+	encoding, body = asset.negotiate(request.headers.get("Accept-Encoding", ""))
+	etag = asset.etag(encoding)
+	headers = {"ETag": '"%s"' % etag, "Vary": "Accept-Encoding",
+		"Cache-Control": "public, max-age=31536000, immutable"}
+	if request.if_none_match.contains(etag): return Response(status=304, headers=headers)
+	if encoding != "identity": headers["Content-Encoding"] = encoding
+	return Response(body, mimetype=asset.mimetype, headers=headers)
+
+@app.route("/tags/<version>.json")
+def tag_dictionary(version):
+	"""The entire tag catalogue, for filtering client-side
+
+	The URL carries the version, so a given URL's content never changes and
+	can be cached forever; the main page always links to the current one.
+	Asking for an old version gets you redirected to the new.
+	"""
+	cat = tags.current()
+	if version != cat.version: return redirect(url_for("tag_dictionary", version=cat.version))
+	encoding, body = cat.negotiate(request.headers.get("Accept-Encoding", ""))
+	etag = cat.etag(encoding)
+	headers = {"ETag": '"%s"' % etag, "Vary": "Accept-Encoding",
+		"Cache-Control": "public, max-age=31536000, immutable"}
+	if request.if_none_match.contains(etag): return Response(status=304, headers=headers)
+	if encoding != "identity": headers["Content-Encoding"] = encoding
+	return Response(body, mimetype="application/json", headers=headers)
 
 # ---- Config management API ----
 
@@ -630,7 +1322,8 @@ def helloworld():
 @app.route("/api/setups")
 @wants_channelid
 def list_setups(channelid):
-	return jsonify(database.list_setups(channelid))
+	return json_response(lambda: database.list_setups(channelid),
+		etag="setups-%s-%d" % (channelid, database.get_data_version(channelid)))
 
 @app.route("/api/setups", methods=["POST"])
 @wants_channelid
@@ -649,60 +1342,93 @@ def delete_setup(channelid, setupid):
 	if deleted: return "", 204
 	return "", 404
 
+def generate_backup_snapshot(twitchid):
+	with database.snapshot() as cur:
+		yield from database.generate_backup(cur, twitchid)
+
 @app.route("/mustard-backup.json")
 @wants_channelid
 def make_backup(channelid):
-	twitchid = channelid
-	response = "{\n"
-	# Setups
-	setups = database.list_setups(twitchid)
-	response += '\t"setups": [\n'
-	fields = "category", "title", "tags", "tweet"
-	for setup in setups:
-		setup = {field: setup[field] for field in fields}
-		response += "\t\t" + json.dumps(setup) + ",\n"
-	response += '\t\t""\n\t],\n'
-	# Schedule
-	tz, sched, sched_tweet = database.get_schedule(twitchid)
-	response += '\t"schedule": [\n'
-	for day in sched:
-		response += "\t\t" + json.dumps(day) + ",\n"
-	response += "\t\t%s,\n\t\t%d\n\t],\n" % (json.dumps(tz), sched_tweet)
-	# Checklist
-	checklist = database.get_checklist(twitchid).strip().split("\n")
-	response += '\t"checklist": [\n'
-	for item in checklist:
-		response += "\t\t" + json.dumps(item) + ",\n"
-	response += '\t\t""\n\t],\n' # Empty string as shim. Ignored on import.
-	# Timers
-	timers = database.list_timers(twitchid, full=True)
-	response += '\t"timers": [\n'
-	for timer in timers:
-		item = dict(zip("id title delta maxtime styling".split(), timer))
-		response += "\t\t" + json.dumps(item) + ",\n"
-	response += '\t\t""\n\t],\n'
-	# Footer (marker to show that the file was correctly downloaded)
-	# This must NOT include any sort of timestamp, as the backup file
-	# must be completely stable (taking two backups without changing
-	# anything should result in bit-for-bit identical files).
-	response += '\t"": "Mustard-Mine Backup"\n}\n'
-	return Response(response, mimetype="application/json",
+	if not database.existing_users([channelid]): return "Nothing to back up - that channel hasn't been set up here.", 404
+	return Response(generate_backup_snapshot(channelid), mimetype="application/json",
 		headers={"Content-disposition": "attachment"})
 
+def editable_channels(userid):
+	"""List the channels this user is known to be able to edit, own first"""
+	now = time.time()
+	return [userid] + sorted(chan for (user, chan), expiry in channel_editor_cache.items()
+		if user == userid and chan != userid and expiry > now)
+
+@app.route("/mustard-archive")
+def make_archive():
+	"""Back up every channel you can edit, as a zip of backup files or as NDJSON
+
+	Channels come from your own, any that you've recently edited, and any
+	extra channelid=... args (which get the usual permission check). Ones
+	never set up here are skipped; this has to be known before the response
+	starts, since it can't report an error once it's streaming.
+	"""
+	if "twitch_user" not in session: return redirect(url_for("mainpage"))
+	userid = session["twitch_user"]["_id"]
+	channels = editable_channels(userid)
+	for channelid in request.args.getlist("channelid"):
+		if channelid not in channels and may_edit_channel(userid, channelid):
+			channels.append(channelid)
+	channels = database.existing_users(channels)
+	if request.args.get("format") == "ndjson":
+		def generate():
+			# One line per channel; each "backup" is exactly what the .json file would parse to.
+			with database.snapshot() as cur:
+				for channelid in channels:
+					backup = {}
+					for section, items in database.backup_sections(cur, channelid):
+						backup[section] = items if section == "schedule" else items + [""]
+					backup[""] = "Mustard-Mine Backup"
+					yield json.dumps({"channelid": channelid, "backup": backup}) + "\n"
+		return Response(generate(), mimetype="application/x-ndjson",
+			headers={"Content-disposition": "attachment; filename=mustard-archive.ndjson"})
+	def generate():
+		buf = utils.ChunkBuffer()
+		with database.snapshot() as cur, zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+			for channelid in channels:
+				with zf.open("mustard-backup-%s.json" % channelid, "w") as f:
+					for chunk in database.generate_backup(cur, channelid):
+						f.write(chunk.encode("utf-8"))
+						yield buf.drain()
+		yield buf.drain() # Central directory, written on close
+	return Response(generate(), mimetype="application/zip",
+		headers={"Content-disposition": "attachment; filename=mustard-archive.zip"})
+
+RESTORE_MAX_BYTES = 1024 * 1024 # Real backups are a few KB
+# No request needs more than a backup upload (plus its form's overhead). This
+# is enforced by werkzeug as it reads the body, so it holds for chunked uploads
+# too, which have no Content-Length to check up front.
+app.config["MAX_CONTENT_LENGTH"] = RESTORE_MAX_BYTES + 65536
+
+@app.errorhandler(RequestEntityTooLarge)
+def too_large(e):
+	# Usually raised while wants_channelid looks in the form, before the route runs
+	if request.path == "/restore-backup": return "Backup file too large.", 413
+	return "Request too large.", 413
+
 @app.route("/restore-backup", methods=["POST"])
 @wants_channelid
 def restore_backup(channelid):
 	twitchid = channelid
 	if not twitchid:
 		return redirect(url_for("mainpage"))
+	if "backup" not in request.files:
+		return "Backup file unreadable - must be a JSON file saved from Mustard Mine.", 400
+	# Parse and restore as it's read, one setup or timer at a time, so that
+	# memory use doesn't depend on the size of the file.
+	sections = utils.iter_json_object(request.files["backup"].stream,
+		streamed=database.RESTORE_SECTIONS, limit=RESTORE_MAX_BYTES)
 	try:
-		data = json.loads(request.files["backup"].read().decode("utf-8"))
-	except (KeyError, UnicodeDecodeError, json.JSONDecodeError):
+		r = database.restore_from_sections(twitchid, sections)
+	except utils.JSONTooLarge:
+		return "Backup file too large.", 413
+	except ValueError: # Includes bad JSON and bad UTF-8
 		return "Backup file unreadable - must be a JSON file saved from Mustard Mine.", 400
-	# Signature (from footer)
-	if data[""] != "Mustard-Mine Backup":
-		return "Backup file corrupt - signature missing.", 400
-	r = database.restore_from_json(twitchid, data)
 	return '<ul><li>%s</li></ul><a href="/">Back</a>' % r.summary.strip().replace("\n", "</li><li>"), 400 if r.failed else 200
 
 @app.route("/tz")
@@ -715,33 +1441,117 @@ document.getElementById("tz").innerHTML = "Your timezone appears to be: " + tz;
 </script>
 """
 
-# Map timer IDs to lists of sockets
+# Map timer IDs to lists of sockets, and to lists of event-stream queues
 timer_sockets = collections.defaultdict(list)
-@sockets.route("/countdown_ctrl")
+timer_streams = collections.defaultdict(list)
+# Recent control messages per timer, so that an overlay that reconnects can
+# catch up on what it missed: timerid: [last seq, deque of (seq, message, time), last used]
+TIMER_HISTORY = 32
+timer_history = {}
+EVENT_EPOCH = "%x" % int(time.time()) # Sequence numbers don't survive a restart
+
+# Which channel owns each timer that overlays have recently connected to, so a
+# broadcast to a channel's timers needn't ask the database which they are.
+# timerid: [channelid, last seen]; channel_overlays indexes it by channel.
+# Channel IDs are kept as strings, as they arrive in requests.
+timer_channels = {}
+channel_overlays = collections.defaultdict(set)
+
+def register_overlay(timerid):
+	"""Note that an overlay has connected to a timer, looking up its owner if need be"""
+	entry = timer_channels.get(timerid)
+	if entry is None:
+		channelid = database.get_timer_channel(timerid)
+		if channelid is None: return # No such timer; nothing will ever be sent to it
+		channelid = str(channelid)
+		entry = timer_channels[timerid] = [channelid, 0]
+		channel_overlays[channelid].add(timerid)
+	entry[1] = time.time()
+
+def forget_overlay(timerid):
+	entry = timer_channels.pop(timerid, None)
+	if entry: channel_overlays.get(entry[0], set()).discard(timerid)
+
+def live_overlays(channelid):
+	"""Count the overlays currently connected to each of a channel's timers"""
+	return {id: len(timer_sockets.get(id, ())) + len(timer_streams.get(id, ()))
+		for id in channel_overlays.get(str(channelid), ())}
+
+def send_to_channel(channelid, message):
+	"""Send a control message to every overlay showing any of a channel's timers"""
+	for id in list(channel_overlays.get(str(channelid), ())): send_to_timer(id, message)
+
+def send_to_timer(timerid, message):
+	"""Send a control message to every overlay showing a timer"""
+	hist = timer_history.get(timerid)
+	if hist is None: hist = timer_history[timerid] = [0, collections.deque(maxlen=TIMER_HISTORY), 0]
+	hist[0] += 1
+	hist[2] = time.time()
+	hist[1].append((hist[0], message, hist[2]))
+	data = json.dumps(message)
+	for ws in timer_sockets.get(timerid, ()): ws.send(data)
+	for stream in timer_streams.get(timerid, ()):
+		try: stream.put_nowait((hist[0], data))
+		except queue.Full:
+			# Make room to tell it to go away. It'll reconnect and replay.
+			try: stream.get_nowait()
+			except queue.Empty: pass
+			stream.put_nowait((None, None))
+
+metrics.Gauge("mustard_scheduler_queue_depth", "Scheduled events not yet fired", scheduler.depth)
+metrics.Gauge("mustard_scheduler_lag_seconds", "How late the most recent scheduled event fired", lambda: scheduler.lag)
+metrics.Gauge("mustard_twitch_requests_inflight", "Requests currently holding a Twitch admission slot", lambda: twitch_inflight)
+metrics.Gauge("mustard_circuit_open", "Whether calls to each upstream are being refused",
+	lambda: {(b.name,): int(b.open) for b in (twitch_breaker, twitter_breaker)}, ["service"])
+metrics.Gauge("mustard_tags_age_seconds", "Age of the tags cache, as of the last check",
+	lambda: tags_status.get("age_seconds", 0))
+metrics.Gauge("mustard_tags_refresh_seconds", "How long the last tags refresh (by any process) took",
+	lambda: tags_status.get("last_seconds", 0))
+metrics.Gauge("mustard_log_dropped", "Log messages lost to a full log queue", lambda: log_handler.dropped)
+metrics.Gauge("mustard_cache_entries", "Entries in per-process caches and queues",
+	lambda: {(name,): size for name, size in memory_sizes().items()}, ["cache"])
+metrics.Gauge("mustard_websockets_open", "Countdown control sockets currently open",
+	lambda: sum(len(socks) for socks in timer_sockets.values()))
+metrics.Gauge("mustard_event_streams_open", "Countdown event streams currently open",
+	lambda: sum(len(streams) for streams in timer_streams.values()))
 def control_socket(ws):
 	timerid = None
 	while not ws.closed:
-		message = ws.receive()
-		if type(message) is not str: continue # Be VERY strict here, for safety
-		try: message = json.loads(message)
-		except JSON.JSONDecodeError: continue
-		if type(message) is not dict: continue # Again, very strict
-		if "type" not in message: continue
-		# Okay, we have a properly-formed message.
-		if message["type"] == "init":
-			if timerid: continue # Don't initialize twice
-			if "id" not in message or not message["id"]: continue
-			timerid = message["id"]
-			timer_sockets[timerid].append(ws)
-			ws.send(json.dumps({"type": "inited"}))
-		if message["type"] == "logme":
-			# Sometimes we're working in a context that has no logging
-			# facilities available. Provide some very basic logging via
-			# the server's console. Strictly strings only, and shortish.
-			msg = message.get("msg")
-			if type(msg) is str and len(msg) < 1000:
-				print("Log message from socket: %r" % msg)
-	if timerid: timer_sockets[timerid].remove(ws)
+		timerid = control_message(ws, timerid, ws.receive())
+	socket_closed(ws, timerid)
+if sockets: sockets.route("/countdown_ctrl")(control_socket) # See asgi.py for the other way
+
+def control_message(ws, timerid, message):
+	"""Handle one message from a countdown control socket
+
+	Returns the timer ID the socket is showing (None until it's initialized).
+	"""
+	if type(message) is not str: return timerid # Be VERY strict here, for safety
+	try: message = json.loads(message)
+	except json.JSONDecodeError: return timerid
+	if type(message) is not dict: return timerid # Again, very strict
+	if "type" not in message: return timerid
+	# Okay, we have a properly-formed message.
+	if message["type"] == "init":
+		if timerid: return timerid # Don't initialize twice
+		if "id" not in message or not message["id"]: return timerid
+		timerid = message["id"]
+		timer_sockets[timerid].append(ws)
+		register_overlay(timerid)
+		ws.send(json.dumps({"type": "inited"}))
+	if message["type"] == "logme":
+		# Sometimes we're working in a context that has no logging
+		# facilities available. Provide some very basic logging via
+		# the server's console. Strictly strings only, and shortish.
+		msg = message.get("msg")
+		if type(msg) is str and len(msg) < 1000:
+			log.info("Log message from socket: %r", msg, extra={"source": "socket:%s" % (timerid or id(ws))})
+	return timerid
+
+def socket_closed(ws, timerid):
+	if timerid:
+		timer_sockets[timerid].remove(ws)
+		if not timer_sockets[timerid]: del timer_sockets[timerid] # Don't keep every timer ever seen
 
 '''
 # For testing, update a single timer
@@ -768,20 +1578,14 @@ def force_timer(id):
 def adjust_all_timers(channelid, delta, negative=False):
 	if negative: delta = -delta # Since the int converter can't handle negatives, we do them manually.
 	if not channelid: return redirect(url_for("mainpage"))
-	for id, timer in database.list_timers(channelid):
-		if id in timer_sockets:
-			for ws in timer_sockets[id]:
-				ws.send(json.dumps({"type": "adjust", "delta": delta}))
+	send_to_channel(channelid, {"type": "adjust", "delta": delta})
 	return "", 204
 
 @app.route("/timer-force-all/<int:tm>")
 @wants_channelid
 def force_all_timers(channelid, tm):
 	if not channelid: return redirect(url_for("mainpage"))
-	for id, timer in database.list_timers(channelid):
-		if id in timer_sockets:
-			for ws in timer_sockets[id]:
-				ws.send(json.dumps({"type": "force", "time": tm}))
+	send_to_channel(channelid, {"type": "force", "time": tm})
 	return "", 204
 
 if __name__ == "__main__":
@@ -795,5 +1599,8 @@ if __name__ == "__main__":
 else:
 	# Worker startup. This is the place to put any actual initialization work
 	# as it won't be done on master startup.
-	if database.tags_need_updating():
-		threading.Thread(target=get_all_tags).start()
+	database.purge_sessions()
+	if os.environ.get("MEMORY_PROFILING"): tracemalloc.start()
+	threading.Thread(target=housekeeping, daemon=True).start()
+	threading.Thread(target=prewarmer, daemon=True).start()
+	threading.Thread(target=tag_refresher, daemon=True).start()
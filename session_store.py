@@ -0,0 +1,92 @@
+"""Server-side sessions: the cookie carries only an opaque ID
+
+Session data lives in Postgres (mustard.sessions), with a small in-process
+LRU in front so that most requests never touch the database to find out who
+you are. Writes go through to the database, and only happen when the session
+has actually changed (or is getting close to expiry).
+
+NOTE: The LRU is per process. With several workers, a change made through
+one worker will not be seen by another until its cached copy ages out.
+"""
+import collections
+import json
+import threading
+import time
+from flask.sessions import SessionInterface, SecureCookieSession
+import database
+
+LIFETIME = 30 * 86400 # Seconds; sessions idle longer than this are forgotten
+CACHE_SIZE = 1000
+CACHE_TTL = 60 # Seconds before a cached session is re-read from the database
+
+class ServerSession(SecureCookieSession):
+	def __init__(self, initial=None, sid=None, expires=0):
+		super().__init__(initial)
+		self.sid = sid
+		self.expires = expires
+		self.old_sid = None
+
+	def regenerate(self):
+		"""Move to a new ID when saved, discarding the old one (do this on logging in)"""
+		if self.sid: self.old_sid, self.sid = self.sid, None
+		self.modified = True
+
+class PostgresSessionInterface(SessionInterface):
+	def __init__(self):
+		self.cache = collections.OrderedDict() # sid: (data, expires, cached_at)
+		self.lock = threading.Lock()
+
+	def _cache(self, sid, data, expires):
+		with self.lock:
+			self.cache[sid] = data, expires, time.time()
+			self.cache.move_to_end(sid)
+			while len(self.cache) > CACHE_SIZE: self.cache.popitem(last=False)
+
+	def _forget(self, sid):
+		with self.lock: self.cache.pop(sid, None)
+
+	def load(self, sid):
+		with self.lock:
+			hit = self.cache.get(sid)
+			if hit: self.cache.move_to_end(sid)
+		now = time.time()
+		if hit and hit[2] > now - CACHE_TTL:
+			data, expires, _ = hit
+		else:
+			found = database.load_session(sid)
+			if not found: return None, 0
+			data, expires = json.loads(found[0]), found[1]
+			self._cache(sid, data, expires)
+		if expires < now: return None, 0
+		return data, expires
+
+	def open_session(self, app, request):
+		sid = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+		if not sid: return ServerSession()
+		data, expires = self.load(sid)
+		if data is None: return ServerSession()
+		# Copy, so that changes don't leak into the cache unless saved
+		return ServerSession(json.loads(json.dumps(data)), sid=sid, expires=expires)
+
+	def save_session(self, app, session, response):
+		name = app.config["SESSION_COOKIE_NAME"]
+		domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+		if session.old_sid:
+			database.delete_session(session.old_sid)
+			self._forget(session.old_sid)
+		if not session:
+			if session.sid:
+				database.delete_session(session.sid)
+				self._forget(session.sid)
+				response.delete_cookie(name, domain=domain, path=path)
+			return
+		# Sliding expiry, but only bother writing if a good chunk has elapsed
+		if not session.modified and session.expires > time.time() + LIFETIME / 2: return
+		if not session.sid: session.sid = database.generate_session_id()
+		expires = int(time.time()) + LIFETIME
+		data = dict(session)
+		database.save_session(session.sid, json.dumps(data), expires)
+		self._cache(session.sid, data, expires)
+		response.set_cookie(name, session.sid, expires=expires, domain=domain, path=path,
+			httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+			samesite=self.get_cookie_samesite(app))
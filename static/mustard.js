@@ -7,13 +7,15 @@ const schedform = document.forms.schedule.elements;
 //Map category names to their game IDs. If the to-be-saved category is in this
 //mapping, we can send the ID to the server (as well as the category name) to
 //save one API call.
-const gameids = {[channel.game]: channel.game_id};
+const gameids = {[channel.game_name]: channel.game_id};
 
 function render_setups() {
 	const rows = setups.map((s, i) => TR({onclick: () => pick_setup(i)}, [
 		TD(s.category),
 		TD(s.title),
-		TD(s.tags),
+		s.unknown_tags && s.unknown_tags.length
+			? TD({className: "badtags", title: "Not known to Twitch: " + s.unknown_tags.join(", ")}, s.tags)
+			: TD(s.tags),
 		TD(s.tweet),
 		TD(BUTTON({className: "deleting", id: "del"+i}, "X")),
 	]));
@@ -387,9 +389,23 @@ function open_picker(now_picking, heading) {
 document.getElementById("pick_cat").onclick = function(ev) {open_picker("game", "Pick a category:"); ev.preventDefault();}
 document.getElementById("pick_tag").onclick = function(ev) {open_picker("tag", "Select tags:"); ev.preventDefault();}
 
+//The full tag list is fetched once (and cached by the browser until it changes)
+//and searched locally, rather than asking the server on every keystroke.
+let all_tags = null;
+async function search_tags(prefix) {
+	if (!all_tags) all_tags = (await (await fetch(tags_url)).json())
+		.map(([english_name, english_desc]) => ({english_name, english_desc, folded: english_name.toLowerCase()}));
+	prefix = prefix.toLowerCase();
+	return all_tags.filter(tag => tag.folded.startsWith(prefix));
+}
+
 let searching = false;
 document.getElementById("picker_search").oninput = async function() {
 	let val = this.value;
+	if (picking === "tag") {
+		set_content("#picker_results", (await search_tags(val)).map(pickmapper.tag));
+		return;
+	}
 	if (searching) return;
 	while (true)
 	{
@@ -0,0 +1,93 @@
+"""In-process copy of the tag catalogue
+
+The catalogue changes at most daily (see database.tags_need_updating), so
+rather than searching it on every keystroke, clients download all of it once
+per version and filter locally. The serialized and compressed forms are built
+once per version and kept here, along with a name->ID map so that resolving
+tag names needs no database queries either.
+"""
+import difflib
+import gzip
+import json
+import threading
+import time
+import assets
+import database
+try:
+	import brotli
+except ImportError:
+	brotli = None # Optional; gzip alone is fine
+
+CHECK_INTERVAL = 300 # Seconds between checks of the database's tag version
+
+class Catalogue:
+	def __init__(self, version, tags):
+		self.version = str(version)
+		# Casefolded name to (id, canonical name)
+		self.ids = {name.casefold(): (id, name) for id, name, desc in tags}
+		# Compact form: [[name, description], ...] sorted by name
+		body = json.dumps([[name, desc] for id, name, desc in tags], separators=(",", ":")).encode("utf-8")
+		self.bodies = {"identity": body, "gzip": gzip.compress(body, 9)}
+		if brotli: self.bodies["br"] = brotli.compress(body, quality=11)
+
+	def etag(self, encoding):
+		# Strong ETags must differ between encodings of the same resource
+		return "tags-%s-%s" % (self.version, encoding)
+
+	def negotiate(self, accept_encoding):
+		return assets.negotiate(self.bodies, accept_encoding)
+
+	def suggest(self, name):
+		"""Find the most likely intended tag for a name that isn't one"""
+		match = difflib.get_close_matches(name.casefold(), self.ids, n=1, cutoff=0.75)
+		return self.ids[match[0]][1] if match else None
+
+def split(tags):
+	"""Split a comma-separated tag string into names"""
+	return [t.strip() for t in tags.split(",") if t.strip()]
+
+def resolve(tag_lists, suggest=False):
+	"""Convert many lists of tag names into IDs in one go
+
+	Matching ignores case. Returns one (ids, unknown) pair per list, where
+	unknown lists (name, suggestion) for each name not found; suggestion is
+	the closest real tag name, or None. Finding suggestions means a fuzzy
+	search of the whole catalogue per unknown name, so it is only done if
+	asked for, ie when the result is going into an error message.
+	"""
+	cat = current()
+	ret = []
+	for names in tag_lists:
+		ids, unknown = [], []
+		for name in names:
+			found = cat.ids.get(name.casefold())
+			if found: ids.append(found[0])
+			else: unknown.append((name, cat.suggest(name) if suggest else None))
+		ret.append((ids, unknown))
+	return ret
+
+def describe_unknown(unknown):
+	"""Make an error message out of the unknowns from resolve()"""
+	return "Tag names not found in Twitch: " + ", ".join(
+		"%r (did you mean %r?)" % (name, sugg) if sugg else repr(name)
+		for name, sugg in unknown)
+
+_catalogue = None
+_checked = 0
+_lock = threading.Lock()
+
+def current():
+	"""Get the current catalogue, reloading it if the database has a newer one"""
+	global _catalogue, _checked
+	with _lock:
+		if _catalogue and time.time() < _checked + CHECK_INTERVAL: return _catalogue
+		_checked = time.time()
+		version = database.get_tags_version()
+		if not _catalogue or _catalogue.version != str(version):
+			_catalogue = Catalogue(version, database.list_tags())
+		return _catalogue
+
+def invalidate():
+	"""Force a version check on next use (eg after refreshing the tags ourselves)"""
+	global _checked
+	_checked = 0
@@ -0,0 +1,59 @@
+import datetime
+import os
+import sys
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import eventsub
+
+SECRET = "s3cret-for-tests"
+
+def headers(body, msgid="msg-1", age=0, secret=SECRET):
+	when = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=age)
+	timestamp = when.strftime("%Y-%m-%dT%H:%M:%S.123456789Z") # Twitch sends nanoseconds
+	return {
+		"Twitch-Eventsub-Message-Id": msgid,
+		"Twitch-Eventsub-Message-Timestamp": timestamp,
+		"Twitch-Eventsub-Message-Signature": eventsub.signature(secret, msgid, timestamp, body),
+	}
+
+def test_good_message_then_redelivery():
+	recv = eventsub.Receiver(SECRET)
+	body = b'{"event": {}}'
+	hdr = headers(body)
+	assert recv.check(hdr, body) is True
+	assert recv.check(hdr, body) is False # Same message ID again
+
+@pytest.mark.parametrize("tamper", [
+	lambda hdr, body: (hdr, body + b" "), # Body changed
+	lambda hdr, body: ({**hdr, "Twitch-Eventsub-Message-Id": "msg-2"}, body),
+	lambda hdr, body: ({**hdr, "Twitch-Eventsub-Message-Signature": "sha256=" + "0" * 64}, body),
+	lambda hdr, body: ({k: v for k, v in hdr.items() if k != "Twitch-Eventsub-Message-Signature"}, body),
+	lambda hdr, body: ({k: v for k, v in hdr.items() if k != "Twitch-Eventsub-Message-Id"}, body),
+])
+def test_bad_signature(tamper):
+	body = b'{"event": {}}'
+	hdr, body = tamper(headers(body), body)
+	with pytest.raises(ValueError): eventsub.Receiver(SECRET).check(hdr, body)
+
+def test_wrong_secret():
+	body = b"{}"
+	with pytest.raises(ValueError): eventsub.Receiver(SECRET).check(headers(body, secret="other"), body)
+
+def test_stale_message():
+	body = b"{}"
+	with pytest.raises(ValueError): eventsub.Receiver(SECRET).check(headers(body, age=eventsub.MAX_AGE + 60), body)
+
+def test_bad_timestamp():
+	body = b"{}"
+	msgid, timestamp = "msg-1", "yesterday"
+	hdr = {"Twitch-Eventsub-Message-Id": msgid, "Twitch-Eventsub-Message-Timestamp": timestamp,
+		"Twitch-Eventsub-Message-Signature": eventsub.signature(SECRET, msgid, timestamp, body)}
+	with pytest.raises(ValueError): eventsub.Receiver(SECRET).check(hdr, body)
+
+def test_seen_ids_are_bounded():
+	recv = eventsub.Receiver(SECRET)
+	for i in range(eventsub.SEEN_LIMIT + 10):
+		body = b"{}"
+		assert recv.check(headers(body, msgid="msg-%d" % i), body)
+	assert len(recv.seen) == eventsub.SEEN_LIMIT
+	assert "msg-0" not in recv.seen and "msg-%d" % (eventsub.SEEN_LIMIT + 9) in recv.seen
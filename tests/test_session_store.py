@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import types
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+flask = pytest.importorskip("flask")
+
+class FakeDatabase(types.ModuleType):
+	"""Stands in for database.py's session functions, counting the loads"""
+	def __init__(self):
+		super().__init__("database")
+		self.sessions, self.loads, self.next_id = {}, 0, 0
+	def load_session(self, sid):
+		self.loads += 1
+		return self.sessions.get(sid)
+	def save_session(self, sid, data, expires): self.sessions[sid] = data, expires
+	def delete_session(self, sid): self.sessions.pop(sid, None)
+	def generate_session_id(self):
+		self.next_id += 1
+		return "sid-%d" % self.next_id
+
+@pytest.fixture
+def store(monkeypatch):
+	db = FakeDatabase()
+	monkeypatch.setitem(sys.modules, "database", db)
+	monkeypatch.delitem(sys.modules, "session_store", raising=False)
+	import session_store
+	monkeypatch.setattr(session_store, "CACHE_SIZE", 3)
+	app = flask.Flask(__name__)
+	app.secret_key = "test"
+	app.session_interface = session_store.PostgresSessionInterface()
+	@app.route("/set/<value>")
+	def set_value(value):
+		flask.session["value"] = value
+		return ""
+	@app.route("/get")
+	def get_value(): return flask.session.get("value", "")
+	@app.route("/login")
+	def login():
+		flask.session.regenerate()
+		flask.session["user"] = "me"
+		return ""
+	@app.route("/logout")
+	def logout():
+		flask.session.clear()
+		return ""
+	return app, db, session_store
+
+def test_cache_serves_repeat_loads(store):
+	app, db, session_store = store
+	client = app.test_client()
+	client.get("/set/hello")
+	loads = db.loads
+	for _ in range(5): assert client.get("/get").data == b"hello"
+	assert db.loads == loads # All from the in-process cache
+
+def test_cache_is_bounded_lru(store):
+	app, db, session_store = store
+	iface = app.session_interface
+	for i in range(5): iface._cache("s%d" % i, {"n": i}, time.time() + 100)
+	assert list(iface.cache) == ["s2", "s3", "s4"]
+	iface.load("s2") # Touching one makes it the most recent
+	iface._cache("s5", {}, time.time() + 100)
+	assert list(iface.cache) == ["s4", "s2", "s5"]
+
+def test_stale_cache_entry_is_reread(store, monkeypatch):
+	app, db, session_store = store
+	iface = app.session_interface
+	db.sessions["abc"] = '{"value": "new"}', time.time() + 100
+	iface._cache("abc", {"value": "old"}, time.time() + 100)
+	assert iface.load("abc")[0] == {"value": "old"}
+	monkeypatch.setattr(session_store, "CACHE_TTL", -1)
+	assert iface.load("abc")[0] == {"value": "new"}
+
+def test_expired_session_is_not_used(store):
+	app, db, session_store = store
+	db.sessions["abc"] = '{"value": "x"}', time.time() - 1
+	assert app.session_interface.load("abc") == (None, 0)
+
+def test_login_issues_new_session_id(store):
+	app, db, session_store = store
+	client = app.test_client()
+	client.get("/set/before")
+	assert set(db.sessions) == {"sid-1"}
+	client.get("/login")
+	assert set(db.sessions) == {"sid-2"} # The pre-login ID is gone for good
+	assert "sid-1" not in app.session_interface.cache
+	assert client.get("/get").data == b"before" # Same data, new ID
+
+def test_emptied_session_is_deleted(store):
+	app, db, session_store = store
+	client = app.test_client()
+	client.get("/set/x")
+	client.get("/logout")
+	assert db.sessions == {}
@@ -0,0 +1,65 @@
+import gzip
+import json
+import os
+import sys
+import types
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TAGS = [
+	("id-en", "English", "Speaks English"),
+	("id-speedrun", "Speedrun", "Going fast"),
+	("id-casual", "Casual Playthrough", "Taking it easy"),
+]
+
+@pytest.fixture
+def tags(monkeypatch):
+	db = types.ModuleType("database")
+	db.version, db.tags, db.loads = 1, list(TAGS), 0
+	def list_tags():
+		db.loads += 1
+		return db.tags
+	db.get_tags_version = lambda: db.version
+	db.list_tags = list_tags
+	monkeypatch.setitem(sys.modules, "database", db)
+	monkeypatch.delitem(sys.modules, "tags", raising=False)
+	import tags
+	tags.db = db # For the tests' convenience
+	return tags
+
+def test_resolve_ignores_case(tags):
+	[(ids, unknown)] = tags.resolve([["english", "SPEEDRUN"]])
+	assert ids == ["id-en", "id-speedrun"] and unknown == []
+
+def test_resolve_batches(tags):
+	result = tags.resolve(tags.split(s) for s in ["English, Speedrun", "", "Casual Playthrough"])
+	assert result == [(["id-en", "id-speedrun"], []), ([], []), (["id-casual"], [])]
+	assert tags.db.loads == 1 # One catalogue load for the lot
+
+def test_unknown_without_suggestions(tags):
+	[(ids, unknown)] = tags.resolve([["Englsh", "Nonsense"]])
+	assert ids == [] and unknown == [("Englsh", None), ("Nonsense", None)]
+
+def test_unknown_with_suggestions(tags):
+	[(ids, unknown)] = tags.resolve([["Englsh", "Nonsense"]], suggest=True)
+	assert unknown == [("Englsh", "English"), ("Nonsense", None)]
+	msg = tags.describe_unknown(unknown)
+	assert "'Englsh' (did you mean 'English'?)" in msg and "'Nonsense'" in msg
+
+def test_split(tags):
+	assert tags.split(" a, ,b ,, c ") == ["a", "b", "c"]
+	assert tags.split("") == []
+
+def test_catalogue_reloads_on_new_version(tags):
+	assert tags.resolve([["Chill"]])[0][1] == [("Chill", None)]
+	tags.db.version, tags.db.tags = 2, TAGS + [("id-chill", "Chill", "")]
+	assert tags.resolve([["Chill"]])[0][1] == [("Chill", None)] # Not rechecked yet
+	tags.invalidate()
+	assert tags.resolve([["Chill"]]) == [(["id-chill"], [])]
+
+def test_catalogue_bodies(tags):
+	cat = tags.current()
+	body = json.loads(cat.bodies["identity"])
+	assert body[0] == ["English", "Speaks English"]
+	assert gzip.decompress(cat.bodies["gzip"]) == cat.bodies["identity"]
+	assert cat.etag("gzip") != cat.etag("identity")
@@ -0,0 +1,235 @@
+import io
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+def read(text, streamed=(), **kw):
+	"""Read a whole object, turning any streamed arrays into lists"""
+	data = text.encode("utf-8") if isinstance(text, str) else text
+	return {k: list(v) if k in streamed else v for k, v in utils.iter_json_object(io.BytesIO(data), streamed, **kw)}
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64])
+def test_numbers_split_across_chunks(chunk_size):
+	doc = {"int": 12345678, "neg": -42, "float": 1.5e-10, "exp": 6.02E+23, "list": [1, 22, 333.25, -4e3]}
+	assert read(json.dumps(doc), chunk_size=chunk_size) == doc
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5])
+def test_literals_split_across_chunks(chunk_size):
+	doc = {"a": True, "b": False, "c": None, "d": [True, None, False]}
+	assert read(json.dumps(doc), chunk_size=chunk_size) == doc
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5])
+def test_multibyte_utf8_split_across_chunks(chunk_size):
+	doc = {"title": "Café ☕ – 🎮 ünïcödé", "tags": ["日本語", "😀"]}
+	text = json.dumps(doc, ensure_ascii=False)
+	assert read(text, chunk_size=chunk_size) == doc
+	assert read(text, ("tags",), chunk_size=chunk_size) == doc
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 64])
+def test_escapes_split_across_chunks(chunk_size):
+	doc = {"s": "quote \" backslash \\ newline \n emoji 😀 é"}
+	assert read(json.dumps(doc), chunk_size=chunk_size) == doc # ASCII-escaped, with surrogate pairs
+
+def test_streamed_arrays():
+	f = io.BytesIO(b'{"setups": [{"title": "a"}, {"title": "b"}], "schedule": ["mon"]}')
+	pairs = utils.iter_json_object(f, ("setups",), chunk_size=4)
+	key, items = next(pairs)
+	assert key == "setups"
+	assert list(items) == [{"title": "a"}, {"title": "b"}]
+	assert next(pairs) == ("schedule", ["mon"]) # Not streamed, so parsed whole
+	assert list(pairs) == []
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 64])
+def test_unconsumed_streamed_array_is_skipped(chunk_size):
+	f = io.BytesIO(b'{"setups": [1, [2, 3], {"x": "]"}], "after": "yes", "empty": []}')
+	pairs = utils.iter_json_object(f, ("setups", "empty"), chunk_size=chunk_size)
+	key, items = next(pairs)
+	assert next(items) == 1 # Take just one, then move on
+	assert next(pairs) == ("after", "yes")
+	key, items = next(pairs)
+	assert key == "empty" # Not consumed at all
+	assert list(pairs) == []
+
+def test_streamed_key_with_non_array_value():
+	f = io.BytesIO(b'{"setups": {"a": 1}}')
+	assert list(utils.iter_json_object(f, ("setups",))) == [("setups", {"a": 1})]
+
+def test_empty_object():
+	assert read("  { }  ") == {}
+
+@pytest.mark.parametrize("text", ['{"a": 1} x', '{"a": 1}{}', '{} []'])
+def test_trailing_data(text):
+	with pytest.raises(ValueError) as e: read(text)
+	assert not isinstance(e.value, utils.JSONTooLarge)
+
+@pytest.mark.parametrize("text", [
+	'{"a": [1, 2 x]}', # Malformed inside a value
+	'{"a": tru}',
+	'{"a": "\\u12G4"}',
+	'{"a": 1, }',
+	'{"a" 1}',
+	'[1, 2]', # Not an object
+	'{"a": [1, 2',  # Cut short
+	'{"a": "unterminated',
+	'',
+])
+def test_bad_json(text):
+	for chunk_size in (1, 3, 64):
+		with pytest.raises(ValueError) as e: read(text, chunk_size=chunk_size)
+		assert not isinstance(e.value, utils.JSONTooLarge)
+
+def test_malformed_value_is_not_reported_as_too_large():
+	# The error is early in a long value; reading on could never fix it
+	text = '{"a": [1, 2 x, ' + ", ".join(["3"] * 1000) + ']}'
+	with pytest.raises(ValueError) as e: read(text, max_value=100, chunk_size=4096)
+	assert not isinstance(e.value, utils.JSONTooLarge)
+
+def test_value_size_limit():
+	text = json.dumps({"big": "x" * 1000})
+	with pytest.raises(utils.JSONTooLarge): read(text, max_value=100, chunk_size=64)
+	assert read(text, max_value=2000, chunk_size=64) == {"big": "x" * 1000}
+
+def test_streamed_items_each_within_value_limit():
+	# The array as a whole is far over the limit, but no one element is
+	doc = {"setups": [{"title": "t" * 50}] * 100}
+	assert read(json.dumps(doc), ("setups",), max_value=100, chunk_size=64) == doc
+
+def test_total_size_limit():
+	text = json.dumps({"setups": ["x" * 50] * 100})
+	with pytest.raises(utils.JSONTooLarge): read(text, ("setups",), limit=1000, chunk_size=64)
+	assert read(text, ("setups",), limit=len(text), chunk_size=64)["setups"] == ["x" * 50] * 100
+
+def test_scheduler_survives_failing_event():
+	sched = utils.Scheduler()
+	done = threading.Event()
+	def fail(): raise RuntimeError("boom")
+	sched.put(time.time(), fail)
+	sched.put(time.time() + 0.01, done.set)
+	assert done.wait(5) # The pump carried on after the failure
+	assert sched.thread.is_alive()
+
+def test_scheduler_limit():
+	sched = utils.Scheduler(limit=3)
+	later = time.time() + 3600
+	ids = [sched.put(later + i, print, i) for i in range(3)]
+	with pytest.raises(queue.Full): sched.put(later + 3, print, "one too many")
+	sched.remove(ids[0]) # Deleted events don't count
+	sched.put(later + 4, print, "fits again")
+	assert sched.depth() == 3
+	assert [a for t, i, a in sorted(sched.search(print))] == [(1,), (2,), ("fits again",)]
+
+def test_prune():
+	now = time.time()
+	cache = {"expired": now - 1, "soon": now + 10, "later": now + 20, "latest": now + 30}
+	dropped = utils.prune(cache, lambda expiry: expiry, 2)
+	assert sorted(dropped) == ["expired", "soon"]
+	assert sorted(cache) == ["later", "latest"]
+	assert utils.prune(cache, lambda expiry: expiry, 2) == []
+
+class Clock:
+	"""Replaces time.time for utils, so tests needn't wait"""
+	def __init__(self): self.now = 1000000.0
+	def __call__(self): return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(utils.time, "time", clock)
+	return clock
+
+def fail_through(breaker, exc=OSError):
+	with pytest.raises(exc):
+		with breaker: raise exc("down")
+
+def test_circuit_breaker_opens_after_threshold(clock):
+	breaker = utils.CircuitBreaker("Svc", failures=(OSError,), threshold=3, cooldown=30)
+	for _ in range(2): fail_through(breaker)
+	assert not breaker.open
+	fail_through(breaker)
+	assert breaker.open
+	with pytest.raises(utils.CircuitOpen) as e:
+		with breaker: pass
+	assert e.value.retry_after == 30 and "Svc" in str(e.value)
+
+def test_circuit_breaker_success_resets_count(clock):
+	breaker = utils.CircuitBreaker("Svc", failures=(OSError,), threshold=3)
+	for _ in range(2): fail_through(breaker)
+	with breaker: pass
+	for _ in range(2): fail_through(breaker)
+	assert not breaker.open
+
+def test_circuit_breaker_ignores_other_exceptions(clock):
+	breaker = utils.CircuitBreaker("Svc", failures=(OSError,), threshold=1)
+	fail_through(breaker, KeyError) # eg a bug in the caller, not the service failing
+	assert not breaker.open
+
+def test_circuit_breaker_half_open_trial(clock):
+	breaker = utils.CircuitBreaker("Svc", failures=(OSError,), threshold=1, cooldown=30)
+	fail_through(breaker)
+	clock.now += 31
+	with breaker: # The trial call is let through...
+		with pytest.raises(utils.CircuitOpen): # ...but only one at a time
+			with breaker: pass
+	assert not breaker.open # and its success closes the circuit
+	with breaker: pass
+
+def test_circuit_breaker_failed_trial_reopens(clock):
+	breaker = utils.CircuitBreaker("Svc", failures=(OSError,), threshold=1, cooldown=30)
+	fail_through(breaker)
+	clock.now += 31
+	fail_through(breaker)
+	assert breaker.open
+	with pytest.raises(utils.CircuitOpen):
+		with breaker: pass
+
+@pytest.fixture
+def monoclock(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(utils.time, "monotonic", clock)
+	return clock
+
+def record(msg="hello %s", args=("world",), source=None, name="mustard", level=logging.INFO):
+	rec = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+	if source is not None: rec.source = source
+	return rec
+
+def test_rate_limit_burst_then_drop(monoclock):
+	filt = utils.RateLimitFilter(rate=1.0, burst=3)
+	assert [filt.filter(record()) for _ in range(5)] == [True, True, True, False, False]
+
+def test_rate_limit_refills_and_reports_dropped(monoclock):
+	filt = utils.RateLimitFilter(rate=1.0, burst=2)
+	for _ in range(4): filt.filter(record())
+	monoclock.now += 1
+	rec = record()
+	assert filt.filter(rec)
+	assert rec.getMessage() == "hello world [2 earlier message(s) from mustard suppressed]"
+	monoclock.now += 1
+	rec = record()
+	assert filt.filter(rec) and rec.getMessage() == "hello world" # Count reported only once
+
+def test_rate_limit_warnings_exempt(monoclock):
+	filt = utils.RateLimitFilter(rate=1.0, burst=2)
+	for _ in range(10): assert filt.filter(record(level=logging.WARNING))
+	assert filt.filter(record()) and filt.filter(record()) # Allowance untouched
+	assert not filt.filter(record())
+	assert filt.filter(record(level=logging.ERROR)) # Still gets through when flooded
+
+def test_rate_limit_per_source(monoclock):
+	filt = utils.RateLimitFilter(rate=1.0, burst=1)
+	assert filt.filter(record(source="a")) and not filt.filter(record(source="a"))
+	assert filt.filter(record(source="b")) # Separate bucket
+	assert filt.filter(record()) and filt.filter(record(name="other")) # Logger name otherwise
+
+def test_rate_limit_bounds_sources(monoclock):
+	filt = utils.RateLimitFilter(rate=1.0, burst=1, sources=2)
+	for src in "abc": filt.filter(record(source=src))
+	assert list(filt.buckets) == ["b", "c"]
+	assert filt.filter(record(source="a")) # Forgotten, so starts afresh
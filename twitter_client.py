@@ -0,0 +1,114 @@
+"""Posting tweets and threads over reused connections
+
+Each credential pair gets its own OAuth1Session (and thus its own keep-alive
+connection pool), kept in a small LRU so that the parts of a thread, and the
+next tweet from the same account, don't each pay for a new TLS handshake.
+Transient failures are retried with backoff; a thread that still fails
+partway reports how far it got, so the remainder can be posted later as
+replies to the last part that made it.
+"""
+import collections
+import logging
+import random
+import threading
+import time
+import requests
+from authlib.integrations.requests_client import OAuth1Session
+import metrics
+import utils
+
+SESSION_CACHE = 100 # Credential pairs to keep connections open for
+RETRIES = 3 # Extra attempts per tweet after a transient failure
+BACKOFF = 1.0 # Seconds before the first retry; doubles each time
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RETRY_ERRORS = {130, 131} # Twitter's "over capacity" and "internal error"
+
+log = logging.getLogger("mustard.twitter")
+tweet_seconds = metrics.Histogram("mustard_tweet_seconds",
+	"Time to post one tweet, including retries", ["outcome"])
+
+class Client:
+	def __init__(self, client_id, client_secret, base, timeout, breaker):
+		self.client_id, self.client_secret = client_id, client_secret
+		self.base, self.timeout, self.breaker = base, timeout, breaker
+		self.sessions = collections.OrderedDict() # (token, secret): OAuth1Session
+		self.lock = threading.Lock()
+
+	def session(self, auth):
+		auth = tuple(auth)
+		with self.lock:
+			sess = self.sessions.get(auth)
+			if sess:
+				self.sessions.move_to_end(auth)
+				return sess
+			sess = self.sessions[auth] = OAuth1Session(self.client_id, self.client_secret, *auth)
+			while len(self.sessions) > SESSION_CACHE:
+				self.sessions.popitem(last=False)[1].close()
+			return sess
+
+	def _attempt(self, auth, status, in_reply_to):
+		"""Try once to post; returns (info, retryable)"""
+		try:
+			with self.breaker, metrics.upstream("twitter"):
+				resp = self.session(auth).post(self.base + "1.1/statuses/update.json", timeout=self.timeout,
+					data={"status": status, "in_reply_to_status_id": in_reply_to})
+				if resp.status_code >= 500: resp.raise_for_status()
+		except utils.CircuitOpen as e:
+			return {"error": "Unable to send tweet: %s" % e}, True
+		except requests.RequestException as e:
+			# Note that a timeout might have happened after Twitter accepted the
+			# tweet; if so, the retry gets rejected as a duplicate status.
+			return {"error": "Unable to send tweet: %s" % e}, True
+		if resp.status_code == 200:
+			r = resp.json()
+			url = "https://twitter.com/%s/status/%s" % (r["user"]["screen_name"], r["id_str"])
+			return {"screen_name": r["user"]["screen_name"], "tweet_id": r["id"], "url": url}, False
+		try:
+			err = resp.json()["errors"][0]
+			return {"error": "Unable to send tweet: " + err["message"]}, (
+				resp.status_code in RETRY_STATUS or err.get("code") in RETRY_ERRORS)
+		except (LookupError, ValueError):
+			log.warning("Unknown response from Twitter: %d %s", resp.status_code, resp.text[:500])
+			return {"error": "Unknown error response from Twitter (see server console)"}, resp.status_code in RETRY_STATUS
+
+	def post(self, auth, status, in_reply_to=None):
+		"""Post one tweet, retrying transient failures
+
+		Returns the tweet's info, or a dict with an "error" key (and whether it
+		might work later), plus the number of attempts made and the time taken.
+		"""
+		start = time.monotonic()
+		for attempt in range(RETRIES + 1):
+			if attempt: time.sleep(BACKOFF * 2 ** (attempt - 1) * random.uniform(0.8, 1.2))
+			info, retryable = self._attempt(auth, status, in_reply_to)
+			if not retryable or self.breaker.open: break
+		if "error" in info: info["retryable"] = retryable
+		info["attempts"] = attempt + 1
+		info["seconds"] = time.monotonic() - start
+		tweet_seconds.observe(info["seconds"], "error" if "error" in info else "ok")
+		return info
+
+	def post_thread(self, auth, parts, in_reply_to=None):
+		"""Post a thread, each part replying to the previous one
+
+		The parts must go one at a time, as each needs its predecessor's ID. The
+		result is the first tweet's info (or the error), with "parts" giving the
+		timing of each part posted. On failure, "posted" counts the parts that
+		made it and "last_id" is the last of them (or in_reply_to, if none did),
+		so that parts[posted:] can later be sent as a reply to last_id.
+		"""
+		ret = None
+		timings = []
+		prev = in_reply_to
+		parts = [p for p in parts if p]
+		for idx, part in enumerate(parts):
+			info = self.post(auth, part, in_reply_to=prev)
+			timings.append({"seconds": info["seconds"], "attempts": info["attempts"]})
+			if "error" in info:
+				ret = dict(info, posted=idx, last_id=prev)
+				break
+			if not ret: ret = info # Return the info for the *first* tweet sent
+			prev = info["tweet_id"]
+		if not ret: return {"error": "Can't send a thread of nothing but empty tweets", "parts": []}
+		ret["parts"] = timings
+		return ret
@@ -1,7 +1,271 @@
+import codecs
+import collections
+import heapq
+import json
+import logging
+import logging.handlers
 import queue
+import re
+import sys
 import threading
 import time
 
+log = logging.getLogger("mustard.utils")
+
+class ChunkBuffer:
+	"""Write-only file-alike that hands back whatever was written to it
+
+	Lets a writer that insists on a file (eg zipfile) feed a streaming
+	response: write to this, then drain() and yield after each step.
+	"""
+	def __init__(self):
+		self.chunks = []
+
+	def write(self, data):
+		self.chunks.append(bytes(data))
+		return len(data)
+
+	def flush(self):
+		pass
+
+	def drain(self):
+		data = b"".join(self.chunks)
+		self.chunks = []
+		return data
+
+class JSONTooLarge(ValueError):
+	"""Streamed JSON exceeded a size limit"""
+
+# Text that could be the start of a value, or the rest of a number, cut off by the end of a chunk
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*\Z")
+LITERALS = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+
+class JSONStream:
+	"""Incremental JSON reader over a binary file
+
+	Holds at most one chunk plus one value in memory: each value is parsed
+	once enough of the file has arrived to hold all of it, and the text
+	before it is discarded. Errors are all ValueError.
+	"""
+	def __init__(self, f, limit=None, max_value=65536, chunk_size=65536):
+		self.f, self.limit, self.max_value, self.chunk_size = f, limit, max_value, chunk_size
+		self.decoder = codecs.getincrementaldecoder("utf-8")()
+		self.json = json.JSONDecoder()
+		self.buf, self.pos, self.read, self.eof = "", 0, 0, False
+
+	def fill(self):
+		"""Read another chunk; False if there's nothing more"""
+		if self.eof: return False
+		data = self.f.read(self.chunk_size)
+		self.read += len(data)
+		if self.limit is not None and self.read > self.limit: raise JSONTooLarge("Too large (limit %d bytes)" % self.limit)
+		self.buf = self.buf[self.pos:] + self.decoder.decode(data, final=not data)
+		self.pos = 0
+		self.eof = not data
+		return True
+
+	def peek(self):
+		"""Skip whitespace and return the next character ("" at end of file)"""
+		while True:
+			while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n": self.pos += 1
+			if self.pos < len(self.buf) or not self.fill(): return self.buf[self.pos:self.pos + 1]
+
+	def expect(self, chars):
+		"""Consume the next character, which must be one of chars"""
+		c = self.peek()
+		if not c or c not in chars: raise ValueError("Expected %s at byte %d" % (" or ".join(map(repr, chars)), self.read))
+		self.pos += 1
+		return c
+
+	def truncated(self, e):
+		"""Whether a decode error could just be the value running past the end of the buffer"""
+		if e.msg.startswith("Unterminated string"): return True
+		rest = self.buf[e.pos:e.pos + 10]
+		# Reported at the "u", which may be the first of a surrogate pair: uXXXX\uXXXX
+		if e.msg.startswith("Invalid \\uXXXX escape"): return len(self.buf) - e.pos < 11
+		if len(rest) > 9: return False # Longer than any literal, and not the end
+		return any(lit.startswith(rest) for lit in LITERALS) or bool(NUMBER_TAIL.match(rest))
+
+	def value(self):
+		"""Parse one complete value"""
+		self.peek()
+		while True:
+			try:
+				value, end = self.json.raw_decode(self.buf, self.pos)
+				# A number running up to the end of the buffer might continue in the next chunk
+				if self.eof or type(value) not in (int, float) or not NUMBER_TAIL.match(self.buf, end):
+					self.pos = end
+					return value
+			except json.JSONDecodeError as e:
+				# Malformed, rather than merely incomplete, is an error however much more there is
+				if self.eof or not self.truncated(e): raise
+			if len(self.buf) - self.pos > self.max_value: raise JSONTooLarge("Value too large (limit %d characters)" % self.max_value)
+			self.fill()
+
+	def items(self):
+		"""Iterate over the elements of an array whose "[" has been consumed"""
+		if self.peek() == "]":
+			self.pos += 1
+			return
+		while True:
+			yield self.value()
+			if self.expect(",]") == "]": return
+
+	def end(self):
+		if self.peek(): raise ValueError("Extra data after JSON at byte %d" % self.read)
+
+def iter_json_object(f, streamed=(), **kw):
+	"""Read a JSON object from a binary file, one member at a time
+
+	Yields (key, value) pairs. For keys in streamed whose value is an array,
+	the value is an iterator over its elements instead, read on demand; like
+	itertools.groupby, it becomes invalid once the next pair is asked for.
+	Takes JSONStream's keyword args; raises ValueError for bad JSON, and its
+	subclass JSONTooLarge if a limit is exceeded.
+	"""
+	stream = JSONStream(f, **kw)
+	stream.expect("{")
+	if stream.peek() == "}": stream.pos += 1
+	else:
+		while True:
+			key = stream.value()
+			if not isinstance(key, str): raise ValueError("Expected a key at byte %d" % stream.read)
+			stream.expect(":")
+			if key in streamed and stream.peek() == "[":
+				stream.pos += 1
+				items = stream.items()
+				yield key, items
+				for _ in items: pass # Skip whatever the caller didn't want
+			else: yield key, stream.value()
+			if stream.expect(",}") == "}": break
+	stream.end()
+
+def prune(cache, expiry, limit):
+	"""Drop expired entries from a dict; then, if still over limit, those expiring soonest
+
+	expiry(value) gives the time at which each entry expires. Returns the keys dropped.
+	"""
+	now = time.time()
+	items = list(cache.items()) # Other threads may be changing it meanwhile
+	dropped = [k for k, v in items if expiry(v) <= now]
+	for key in dropped: cache.pop(key, None)
+	if len(cache) > limit:
+		live = sorted((kv for kv in items if expiry(kv[1]) > now), key=lambda kv: expiry(kv[1]))
+		oldest = [k for k, v in live[:len(cache) - limit]]
+		for key in oldest: cache.pop(key, None)
+		dropped += oldest
+	return dropped
+
+class RateLimitFilter(logging.Filter):
+	"""Token bucket per log source, so that no one source can flood the log
+
+	The source is the record's "source" attribute if given (pass it with
+	extra={"source": ...}), else the logger's name. Each source may log
+	`burst` messages at once, refilling at `rate` per second; the first
+	message let through after some were dropped says how many. Records at
+	or above `exempt` (WARNING) always get through, and don't use up the
+	allowance: the flood to guard against is routine chatter, and it mustn't
+	be able to hide a problem from the same source (eg Flask's app.logger,
+	which shares the "mustard" logger with everything else).
+	"""
+	def __init__(self, rate=1.0, burst=20, sources=1000, exempt=logging.WARNING):
+		super().__init__()
+		self.rate, self.burst, self.max_sources, self.exempt = rate, burst, sources, exempt
+		self.buckets = collections.OrderedDict() # source: [tokens, last_refill, dropped]
+		self.lock = threading.Lock()
+
+	def filter(self, record):
+		if record.levelno >= self.exempt: return True
+		source = getattr(record, "source", record.name)
+		now = time.monotonic()
+		with self.lock:
+			bucket = self.buckets.get(source)
+			if bucket is None:
+				bucket = self.buckets[source] = [self.burst, now, 0]
+				while len(self.buckets) > self.max_sources: self.buckets.popitem(last=False)
+			else: self.buckets.move_to_end(source)
+			bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+			bucket[1] = now
+			if bucket[0] < 1:
+				bucket[2] += 1
+				return False
+			bucket[0] -= 1
+			dropped, bucket[2] = bucket[2], 0
+		if dropped:
+			record.msg = "%s [%d earlier message(s) from %s suppressed]" % (record.getMessage(), dropped, source)
+			record.args = ()
+		return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+	"""Queue handler that drops records rather than block when the queue is full"""
+	dropped = 0
+	def enqueue(self, record):
+		try: self.queue.put_nowait(record)
+		except queue.Full: self.dropped += 1
+
+def setup_logging(level="INFO", maxsize=10000):
+	"""Send all logging through a bounded queue to a background writer
+
+	Callers only pay for formatting the message and queueing it; the actual
+	write to stdout happens on the listener's thread. Returns the handler
+	(its .dropped counts messages lost to a full queue).
+	"""
+	q = queue.Queue(maxsize)
+	handler = DroppingQueueHandler(q)
+	handler.addFilter(RateLimitFilter())
+	out = logging.StreamHandler(sys.stdout)
+	out.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+	logging.handlers.QueueListener(q, out).start()
+	root = logging.getLogger()
+	# Replace any earlier setup (eg inherited across a fork, minus its listener thread)
+	for old in root.handlers[:]:
+		if isinstance(old, DroppingQueueHandler): root.removeHandler(old)
+	root.addHandler(handler)
+	root.setLevel(level)
+	return handler
+
+class CircuitOpen(Exception):
+	"""A circuit breaker is refusing calls - the service is presumed down"""
+	def __init__(self, name, retry_after):
+		super().__init__("%s is currently unavailable" % name)
+		self.name = name
+		self.retry_after = retry_after
+
+class CircuitBreaker:
+	"""Fail fast on a service that keeps failing
+
+	Use as a context manager around each call. After `threshold` consecutive
+	failures (exceptions of the given types), calls are refused with
+	CircuitOpen for `cooldown` seconds; after that, one trial call at a time is
+	let through, and the first success closes the circuit again.
+	"""
+	def __init__(self, name, failures=(Exception,), threshold=5, cooldown=30):
+		self.name = name
+		self.failure_types = failures
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.failures = 0
+		self.retry_at = 0
+
+	@property
+	def open(self):
+		return self.failures >= self.threshold and time.time() < self.retry_at
+
+	def __enter__(self):
+		if self.failures >= self.threshold:
+			now = time.time()
+			if now < self.retry_at: raise CircuitOpen(self.name, self.retry_at - now)
+			# Half open: this call is the trial. Hold everyone else off until it's done.
+			self.retry_at = now + self.cooldown
+		return self
+
+	def __exit__(self, t, v, tb):
+		if t is None:
+			self.failures = 0
+		elif issubclass(t, self.failure_types):
+			self.failures += 1
+			if self.failures >= self.threshold: self.retry_at = time.time() + self.cooldown
+
 class ScheduleQueue(queue.PriorityQueue):
 	"""Variant of queue.PriorityQueue where the priorities are times.
 
@@ -30,29 +294,57 @@ class ScheduleQueue(queue.PriorityQueue):
 			return item
 
 class Scheduler:
-	"""Self-pumping schedule queue"""
-	def __init__(self):
+	"""Self-pumping schedule queue
+
+	If a limit is given, put() raises queue.Full rather than queue more than
+	that many events. An event that raises is logged, and the pump carries on.
+	"""
+	def __init__(self, limit=None):
 		self.queue = ScheduleQueue()
 		self.thread = threading.Thread(target=self.pump)
 		self.thread.daemon = True
 		self.counter = 0
+		self.limit = limit
+		self.queued = set() # IDs of everything in the queue, deleted or not
 		self.deleted = {}
+		self.lag = 0.0 # How late the most recent event fired
 		self.thread.start()
 
 	def pump(self):
 		while True:
 			tm, func, id, args = self.queue.wait()
 			assert tm <= time.time()
+			self.queued.discard(id)
 			if self.deleted.pop(id, False): continue # Deleted event
-			func(*args)
+			self.lag = time.time() - tm
+			try: func(*args)
+			except Exception:
+				log.exception("Scheduled call to %s failed", getattr(func, "__name__", func))
 
 	def put(self, tm, func, *args):
+		if self.limit is not None and len(self.queued) - len(self.deleted) >= self.limit:
+			raise queue.Full("Scheduler is full")
 		self.counter += 1
-		return self.queue.put((tm, func, self.counter, args))
+		self.queued.add(self.counter)
+		self.queue.put((tm, func, self.counter, args))
+		return self.counter
 
 	def search(self, func):
 		"""Return a list of all queued calls to a given function"""
 		return [(t, i, a) for t, f, i, a in self.queue.queue if f is func and i not in self.deleted]
 
+	def depth(self):
+		"""Count the events still waiting to happen"""
+		return sum(1 for t, f, i, a in self.queue.queue if i not in self.deleted)
+
 	def remove(self, id):
+		# Ignore anything not queued (eg already fired), lest it sit in deleted forever
+		if id not in self.queued: return
 		self.deleted[id] = True
+		if len(self.deleted) > 1000 and len(self.deleted) * 2 > len(self.queued):
+			# Mostly tombstones. Rebuild the heap without them.
+			with self.queue.mutex:
+				self.queue.queue[:] = [ev for ev in self.queue.queue if ev[2] not in self.deleted]
+				heapq.heapify(self.queue.queue)
+				self.queued.difference_update(self.deleted)
+				self.deleted.clear()